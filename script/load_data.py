@@ -5,16 +5,14 @@ logging.basicConfig(filename='load_data.log', filemode='w', level=logging.INFO,
 logger = logging.getLogger(__name__)
 
 import yaml
-import json
 from tqdm import tqdm
 import shutil
-import hashlib
-from langchain_community.document_loaders import JSONLoader
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src.utils.ragManager import RAGManager
-from src.utils.bm25Retriever import load_from_chroma_and_save
+from src.utils.indexVersion import ingest_lock
+from src.utils.filingLoader import parse_filing, add_deduplicated, link_chunks, file_order_links, save_displaced_chunks
 
 def load_config(config_path):
     with open(config_path, 'r') as file:
@@ -31,56 +29,26 @@ def import_collection_from_dir(rag_manager, collection_name: str, dir_path: str,
         rag_manager.create_collection(collection_name)
         rag_manager._collections[collection_name].reset_collection()
         content_dict = {}  # Maps content hash to a tuple of (content, metadata)
-
-        def hash_content(content: str) -> str:
-            """Generate a SHA-256 hash of the content."""
-            return hashlib.sha256(content.encode('utf-8')).hexdigest()
+        displaced = {}  # Maps content hash to the metadata of the older filings that also contain it
+        file_links = {}  # Maps filename to the prev / next chunk ids of its chunks in file order
 
         for filename in os.listdir(dir_path):
             if filename.endswith(".json"):
                 json_file = os.path.join(dir_path, filename)
                 print(json_file)
-                loader = JSONLoader(file_path=json_file, jq_schema=".[]", text_content=False)
-                documents = loader.load()
-
-                page_range = json.loads(documents[0].page_content)
-                print(page_range)
-                page_start = page_range['start']
-                page_end = page_range['end']
-                page_date_published = page_range['date_published']
                 count = 0
-                for doc in documents[1:]:
-                    content_dict_data = json.loads(doc.page_content)
-                    content = content_dict_data.get("content", "")
-                    page_number = content_dict_data.get("page_number")
-                    bundle_id = content_dict_data.get("bundle_id", None)
-                    title_summary = content_dict_data.get("title_summary", None)
-
-                    content_hash = hash_content(content)
-                    if int(page_start) <= int(page_number) <= int(page_end) or ignore_range:
-                        metadata = {
-                            "filename": filename,
-                            "page_number": page_number,
-                            "date_published": page_date_published,
-                            "doc_id": content_hash,
-                        }
-                        if bundle_id:
-                            metadata["bundle_id"] = bundle_id
-                        if title_summary:
-                            metadata["title_summary"] = title_summary
-
-                        # Handle duplicates by comparing date_published
-                        if content_hash in content_dict:
-                            existing_content, existing_metadata = content_dict[content_hash]
-                            if page_date_published > existing_metadata["date_published"]:
-                                # Replace older content with newer one
-                                content_dict[content_hash] = (content, metadata)
-                                logger.debug(f"Replacing content file: {existing_metadata['filename']} page: {existing_metadata['page_number']} in {existing_metadata['date_published']} with new version file: {metadata['filename']} page: {metadata['page_number']} in {page_date_published}. Hash: {content_hash}")
-                        else:
-                            # First encounter of this content hash
-                            content_dict[content_hash] = (content, metadata)
-
-                        count += 1
+                chunks = parse_filing(json_file, filename, ignore_range)
+                file_links[filename] = file_order_links(chunks)
+                for content, metadata in chunks:
+                    doc_id = metadata["doc_id"]
+                    previous = content_dict.get(doc_id)
+                    # Handle duplicates by comparing date_published
+                    added = add_deduplicated(content_dict, content, metadata)
+                    # remember the losing filing of a duplicate across files, update_data.py gives the chunk back to it
+                    if previous is not None and previous[1]["filename"] != filename:
+                        loser = previous[1] if added else metadata
+                        displaced.setdefault(doc_id, []).append({**loser, **file_links[loser["filename"]][doc_id]})
+                    count += 1
 
                 logger.info(f"{count} chunks processed in {json_file}.")
         logger.info(f"{len(content_dict)} unique chunks loaded in total.")
@@ -91,17 +59,7 @@ def import_collection_from_dir(rag_manager, collection_name: str, dir_path: str,
         content_hashes_list = [metadata["doc_id"] for metadata in metadata_list]
 
         # Store the previous chunk id and next chunk id in the metadata
-        for i in range(len(metadata_list)):
-            # check if the previous chunk has the same filename
-            if i > 0 and metadata_list[i]["filename"] == metadata_list[i - 1]["filename"]:
-                metadata_list[i]["prev_chunk_id"] = content_hashes_list[i - 1]
-            else:
-                metadata_list[i]["prev_chunk_id"] = ""
-            # check if the next chunk has the same filename
-            if i < len(metadata_list) - 1 and metadata_list[i]["filename"] == metadata_list[i + 1]["filename"]:
-                metadata_list[i]["next_chunk_id"] = content_hashes_list[i + 1]
-            else:
-                metadata_list[i]["next_chunk_id"] = ""
+        link_chunks(metadata_list)
 
         for i in tqdm(range(0, len(content_list), batch_size), desc="Storing database"):
             batch_contents = content_list[i:i + batch_size]
@@ -113,6 +71,8 @@ def import_collection_from_dir(rag_manager, collection_name: str, dir_path: str,
                 ids=batch_doc_ids
             )
 
+        save_displaced_chunks(rag_manager._config['persist_directory'], collection_name, displaced)
+
         logger.info(f"Database stored successfully in {collection_name} collection.")
 
 if __name__ == '__main__':
@@ -135,14 +95,10 @@ if __name__ == '__main__':
     for collection_dir in collection_dirs:
         collection_name = collection_dir.split('/')[-1]
         logger.info(f"Importing collection {collection_name} from {collection_dir}.")
-        # rag.import_collection_from_dir(collection_name, collection_dir, ignore_range=False)
-        import_collection_from_dir(rag, collection_name, collection_dir, BATCH_SIZE,  ignore_range=False)
+        # a running app2.py / retrieval_server.py defers reloads of the collection until the ingest is done
+        with ingest_lock(config['persist_directory'], collection_name):
+            # rag.import_collection_from_dir(collection_name, collection_dir, ignore_range=False)
+            import_collection_from_dir(rag, collection_name, collection_dir, BATCH_SIZE,  ignore_range=False)
 
-        # Get all documents from the collection
-        documents = rag.get_collection_documents(collection_name)
-        
-        # Create BM25 index directory
-        bm25_save_dir = os.path.join(config['persist_directory'], "bm25_index", collection_name)
-        
-        # Save BM25 index
-        load_from_chroma_and_save(documents, bm25_save_dir)
\ No newline at end of file
+            # Build the BM25 index, title summary vectors and chunk store from the stored chunks and bump the index version
+            rag.save_collection_indexes(collection_name)
@@ -0,0 +1,37 @@
+import os
+import sys
+import argparse
+import logging
+logging.basicConfig(filename='update_data.log', filemode='a', level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+import yaml
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.utils.ragManager import RAGManager
+
+def load_config(config_path):
+    with open(config_path, 'r') as file:
+        return yaml.safe_load(file)
+
+if __name__ == '__main__':
+    # Incremental alternative to load_data.py: add, replace or remove single filings without rebuilding the collection
+    parser = argparse.ArgumentParser(description="Add, update or delete one filing in a collection")
+    parser.add_argument("collection", help="collection name")
+    parser.add_argument("action", choices=["upsert", "delete"])
+    parser.add_argument("target", help="filing json file for upsert, filename (e.g. report.json) for delete")
+    parser.add_argument("--config", default="../config/config_vllm.yaml")
+    parser.add_argument("--ignore-range", action="store_true", help="keep chunks outside the page range of the filing")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    rag = RAGManager(config)
+    rag.create_collection(args.collection)
+
+    if args.action == "upsert":
+        result = rag.upsert_filing(args.collection, args.target, ignore_range=args.ignore_range)
+    else:
+        result = rag.delete_filing(args.collection, args.target)
+    logger.info(f"{args.action} {args.target} in {args.collection}: {result}")
+    print(result)
@@ -14,6 +14,8 @@ from openai import OpenAI
 import whisper
 
 from utils.ragManager import RAGManager
+from utils.retrievalService import RetrievalClient
+from utils.retrievalTrace import configure_tracing
 from utils.vllmChatService import ChatService
 
 from gpu_log import log_gpu_usage
@@ -96,7 +98,10 @@ def api_chat():
         question = data.get('question')
         internal_input = data.get('internal_input', None)  # Get internal assistant input
         interrupt_index = data.get('interrupt_index', None)  # Get interrupt index
+        filters = data.get('filters', None)  # Optional metadata filter, e.g. {"filename": [...], "date_published": [start, end]}
         session_id = session.get('session_id1')
+        # full retrieval / rerank trace of this request on demand, written to the retrieval_trace path
+        trace_id = request.headers.get('X-Trace-Id') if admin_authorized() else None
 
         if not question:
             return GlobalResponseHandler.error(message="Question not provided")        
@@ -107,7 +112,9 @@ def api_chat():
                     question,
                     session_id,
                     internal_input,
-                    interrupt_index
+                    interrupt_index,
+                    filters,
+                    trace_id
                 )
             ),
             content_type='text/event-stream'
@@ -120,6 +127,28 @@ def api_chat():
         logger.error("".join(traceback.format_exception(etype=type(e), value=e, tb=e.__traceback__)))
         return GlobalResponseHandler.error(message=str(e))
 
+def admin_authorized() -> bool:
+    # with an admin_token configured it must be sent in X-Admin-Token, otherwise only local calls are allowed
+    admin_token = config.get('admin_token')
+    if admin_token:
+        return request.headers.get('X-Admin-Token') == admin_token
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    if not admin_authorized():
+        return GlobalResponseHandler.error(message="Forbidden", status_code=403)
+    data = request.get_json(silent=True) or {}
+    # load the persisted indexes in the background, requests keep being served by the current snapshot
+    rag_manager.reload(data.get('collections', None), force=data.get('force', False))
+    return GlobalResponseHandler.success(data=rag_manager.index_status(), message="Reload started", status_code=202)
+
+@app.route('/admin/index_version', methods=['GET'])
+def admin_index_version():
+    if not admin_authorized():
+        return GlobalResponseHandler.error(message="Forbidden", status_code=403)
+    return GlobalResponseHandler.success(data=rag_manager.index_status())
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     logger.error(f"An unexpected error occurred: {str(e)}")
@@ -186,12 +215,17 @@ if __name__ == "__main__":
     )
     logger = logging.getLogger(__name__)
     print(f'log level {log_level}, numeric level: {numeric_level}, log file: app_rag.log')
+    configure_tracing(config.get('retrieval_trace'))
 
 
     collections = {'lotus': 10, 'lotus_car_stats': 0, 'lotus_brand_info': 0}
 
     # Creat Beans
-    rag_manager = RAGManager(config=config, collections=collections)
+    if config.get('retrieval_server_url'):
+        # indexes are loaded once by retrieval_server.py and shared by all workers
+        rag_manager = RetrievalClient(config['retrieval_server_url'], admin_token=config.get('admin_token'))
+    else:
+        rag_manager = RAGManager(config=config, collections=collections)
     chat_service = ChatService(config=config, rag_manager=rag_manager)
 
     log_gpu_usage('warm up')
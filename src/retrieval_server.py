@@ -0,0 +1,132 @@
+import os
+import json
+import logging
+import yaml
+from flask import Flask, request, Response
+
+from utils.ragManager import RAGManager
+from utils.retrievalService import RetrievalBatcher, INDEX_VERSIONS_HEADER, served_versions
+from utils.retrievalTrace import configure_tracing, trace_request
+
+# One process holds the embedding model and the FAISS / BM25 / title summary indexes, any number of
+# app2.py workers on the same box connect to it with utils.retrievalService.RetrievalClient.
+# Listens on localhost only.
+
+app = Flask(__name__)
+
+
+def load_config(config_path: str):
+    with open(config_path, 'r') as file:
+        return yaml.safe_load(file)
+
+
+def respond(data=None, message="Success", status_code=200):
+    # same envelope as GlobalResponseHandler in app2.py
+    status = "success" if status_code < 400 else "error"
+    response = {"status": status, "message": message, "data": data}
+    return Response(response=json.dumps(response), status=status_code, mimetype='application/json')
+
+
+def admin_authorized() -> bool:
+    admin_token = config.get('admin_token')
+    if admin_token:
+        return request.headers.get('X-Admin-Token') == admin_token
+    return True
+
+
+@app.after_request
+def report_index_versions(response):
+    # lets RetrievalClient keep its collection list until a reload swaps in other indexes
+    response.headers[INDEX_VERSIONS_HEADER] = served_versions(rag_manager._retrievers)
+    return response
+
+
+@app.route('/collections', methods=['GET'])
+def collections_served():
+    return respond(data=[
+        {"collection_name": retriever.collection_name, "index_version": retriever.index_version, "k": retriever.k}
+        for retriever in rag_manager._retrievers
+    ])
+
+
+@app.route('/retrieve', methods=['POST'])
+def retrieve():
+    data = request.json
+    if not data or 'input' not in data:
+        return respond(message="input not provided", status_code=400)
+    # requests are traced only if the calling worker traces them
+    trace = data.get('trace')
+    with trace_request(trace['request_id'] if trace else None, force=bool(trace and trace['force']), sampled=trace is not None):
+        # without a collection the candidates of all collections are merged, see RAGManager.retrieve_all
+        chunks = batcher.retrieve(data['input'], data.get('hyde_chunks') or [], data.get('filters'), data.get('collection'))
+    return respond(data=chunks)
+
+
+@app.route('/similarity', methods=['POST'])
+def similarity():
+    data = request.json
+    mtx = rag_manager.compute_similarity_mtx(data['chunks'], data.get('doc_ids'))
+    return respond(data=mtx.cpu().tolist() if hasattr(mtx, 'cpu') else mtx.tolist())
+
+
+@app.route('/query_similarity', methods=['POST'])
+def query_similarity():
+    data = request.json
+    return respond(data=rag_manager.compute_query_similarity(data['query'], data['chunks'], data.get('doc_ids')).tolist())
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return respond(data={
+        "batching": batcher.stats(),
+        "embedding_cache": rag_manager.embedding_cache_stats(),
+        "retrieval_cache": rag_manager.retrieval_cache_stats(),
+    })
+
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    if not admin_authorized():
+        return respond(message="Forbidden", status_code=403)
+    data = request.get_json(silent=True) or {}
+    rag_manager.reload(data.get('collections', None), force=data.get('force', False))
+    return respond(data=rag_manager.index_status(), message="Reload started", status_code=202)
+
+
+@app.route('/admin/index_version', methods=['GET'])
+def admin_index_version():
+    if not admin_authorized():
+        return respond(message="Forbidden", status_code=403)
+    return respond(data=rag_manager.index_status())
+
+
+@app.errorhandler(Exception)
+def handle_exception(e):
+    logger.error(f"An unexpected error occurred: {str(e)}")
+    return respond(message=f"Internal Server Error: {str(e)}", status_code=500)
+
+
+if __name__ == "__main__":
+    config_path = os.getenv('CONFIG_PATH', '../config/config_vllm.yaml')
+    config = load_config(config_path)
+
+    logging.basicConfig(
+        filename='retrieval_server.log',
+        filemode='w',
+        level=getattr(logging, config.get('log_level', 'INFO').upper()),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    logger = logging.getLogger(__name__)
+    configure_tracing(config.get('retrieval_trace'))
+
+    # same collections as app2.py
+    collections = {'lotus': 10, 'lotus_car_stats': 0, 'lotus_brand_info': 0}
+
+    rag_manager = RAGManager(config=config, collections=collections)
+    batcher = RetrievalBatcher(
+        rag_manager,
+        max_batch=config.get('retrieval_batch_size', 16),
+        max_wait_ms=config.get('retrieval_batch_wait_ms', 5),
+    )
+
+    app.run(host='127.0.0.1', port=config.get('retrieval_server_port', 6010), threaded=True)
@@ -0,0 +1,62 @@
+import os
+import sys
+import json
+import yaml
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from utils.ragManager import RAGManager
+from utils.faissRetriever import FaissRetriever
+
+# Compare approximate FAISS index and vector storage settings against exact float32 flat search for one collection.
+# Queries are the questions in QUESTION_JSON if it exists, otherwise NUM_SAMPLED_QUERIES stored chunk vectors.
+COLLECTION = "lotus"
+QUESTION_JSON = "/root/autodl-tmp/RAG_Agent_vllm_tzh/src/test/test_questions/14m.json"
+NUM_SAMPLED_QUERIES = 200
+TOPK = 10
+INDEX_CONFIGS = [
+    {'type': 'flat', 'use_gpu': False},
+    {'type': 'hnsw', 'use_gpu': False, 'hnsw_m': 32, 'ef_construction': 200, 'ef_search': 64},
+    {'type': 'hnsw', 'use_gpu': False, 'hnsw_m': 32, 'ef_construction': 200, 'ef_search': 128},
+    {'type': 'ivfpq', 'use_gpu': False, 'nlist': 1024, 'pq_m': 64, 'pq_nbits': 8, 'nprobe': 16},
+    {'type': 'ivfpq', 'use_gpu': False, 'nlist': 1024, 'pq_m': 64, 'pq_nbits': 8, 'nprobe': 64},
+    {'type': 'flat', 'use_gpu': False, 'storage': 'fp16'},
+    {'type': 'flat', 'use_gpu': False, 'storage': 'int8'},
+    {'type': 'flat', 'use_gpu': False, 'storage': 'int8', 'rescore': True, 'rescore_factor': 4},
+    {'type': 'hnsw', 'use_gpu': False, 'hnsw_m': 32, 'ef_construction': 200, 'ef_search': 128, 'storage': 'int8'},
+    {'type': 'hnsw', 'use_gpu': False, 'hnsw_m': 32, 'ef_construction': 200, 'ef_search': 128, 'storage': 'int8', 'rescore': True},
+]
+
+
+if __name__ == "__main__":
+    config_path = os.getenv('CONFIG_PATH', os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+        'config',
+        'config_vllm.yaml'
+    ))
+
+    with open(config_path, 'r') as file:
+        config = yaml.safe_load(file)
+
+    rag_manager = RAGManager(config=config)
+    rag_manager.create_collection(COLLECTION)
+    embeddings = rag_manager._collections[COLLECTION].get(include=["embeddings"])['embeddings']
+    embeddings = np.array(embeddings, dtype=np.float32)
+    # exact float32 baseline shared by every config
+    exact_vectors = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    query_vector = None
+    for index_config in INDEX_CONFIGS:
+        retriever = FaissRetriever(embeddings, rag_manager.embeddings, index_config=index_config)
+        if query_vector is None:
+            if os.path.exists(QUESTION_JSON):
+                with open(QUESTION_JSON, 'r', encoding='utf-8') as f:
+                    questions = [item['question'] for item in json.load(f)]
+                query_vector = retriever.embed_queries(questions)
+            else:
+                rng = np.random.default_rng(0)
+                sample = rng.choice(len(exact_vectors), size=min(NUM_SAMPLED_QUERIES, len(exact_vectors)), replace=False)
+                query_vector = exact_vectors[sample]
+
+        report = retriever.recall_report(query_vector, TOPK, exact_vectors=exact_vectors)
+        print(json.dumps({**index_config, **report}))
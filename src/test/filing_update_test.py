@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import yaml
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.ragManager import RAGManager
+
+# Incremental filing updates (update_data.py) must leave a collection as a fresh load_data.py run of the same files would.
+# Runs against a throwaway collection of the configured persist_directory and removes it afterwards.
+COLLECTION = "filing_update_test"
+
+
+def load_config(config_path):
+    with open(config_path, 'r') as file:
+        return yaml.safe_load(file)
+
+
+def write_filing(dir_path, filename, date_published, contents):
+    chunks = [{"start": 1, "end": 1, "date_published": date_published}]
+    chunks.extend({"content": content, "page_number": 1} for content in contents)
+    json_file = os.path.join(dir_path, filename)
+    with open(json_file, 'w', encoding='utf-8') as f:
+        json.dump(chunks, f)
+    return json_file
+
+
+def collection_state(rag_manager):
+    """(content, filename, previous content, next content) of every chunk, by doc_id."""
+    stored = rag_manager._collections[COLLECTION].get(include=["metadatas", "documents"])
+    contents = dict(zip(stored['ids'], stored['documents']))
+    return {
+        doc_id: (contents[doc_id], metadata['filename'], contents.get(metadata['prev_chunk_id']), contents.get(metadata['next_chunk_id']))
+        for doc_id, metadata in zip(stored['ids'], stored['metadatas'])
+    }
+
+
+def test_delete_newer_filing(rag_manager, dir_path):
+    """upsert A, upsert a newer B sharing chunks with A, delete B: A gets its chunks back in file order."""
+    filing_a = write_filing(dir_path, "A.json", "2024-01-01", ["a0", "shared 1", "shared 2", "a3", "shared 4"])
+    filing_b = write_filing(dir_path, "B.json", "2024-06-01", ["b0", "shared 1", "shared 2", "b3", "shared 4"])
+
+    rag_manager.upsert_filing(COLLECTION, filing_a)
+    only_a = collection_state(rag_manager)
+    rag_manager.upsert_filing(COLLECTION, filing_b)
+    assert {filename for _, filename, _, _ in collection_state(rag_manager).values()} == {"A.json", "B.json"}
+    result = rag_manager.delete_filing(COLLECTION, "B.json")
+
+    assert result["restored"] == 3, result
+    assert collection_state(rag_manager) == only_a, collection_state(rag_manager)
+    rag_manager.delete_filing(COLLECTION, "A.json")
+    assert collection_state(rag_manager) == {}
+    print("test_delete_newer_filing passed")
+
+
+def test_replace_newer_filing(rag_manager, dir_path):
+    """A chunk dropped from a new version of the newer filing goes back to the older one."""
+    filing_a = write_filing(dir_path, "A.json", "2024-01-01", ["a0", "shared 1", "shared 2", "a3"])
+    filing_b = write_filing(dir_path, "B.json", "2024-06-01", ["b0", "shared 1", "shared 2"])
+
+    rag_manager.upsert_filing(COLLECTION, filing_a)
+    only_a = collection_state(rag_manager)
+    rag_manager.upsert_filing(COLLECTION, filing_b)
+    filing_b = write_filing(dir_path, "B.json", "2024-06-01", ["b0", "shared 2"])
+    rag_manager.upsert_filing(COLLECTION, filing_b)
+
+    owners = {content: filename for content, filename, _, _ in collection_state(rag_manager).values()}
+    assert owners == {"a0": "A.json", "shared 1": "A.json", "shared 2": "B.json", "a3": "A.json", "b0": "B.json"}, owners
+    rag_manager.delete_filing(COLLECTION, "B.json")
+    assert collection_state(rag_manager) == only_a, collection_state(rag_manager)
+    rag_manager.delete_filing(COLLECTION, "A.json")
+    print("test_replace_newer_filing passed")
+
+
+if __name__ == "__main__":
+    config_path = os.getenv('CONFIG_PATH', os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+        'config',
+        'config_vllm.yaml'
+    ))
+    config = load_config(config_path)
+    rag_manager = RAGManager(config)
+    rag_manager.create_collection(COLLECTION)
+
+    dir_path = tempfile.mkdtemp()
+    try:
+        test_delete_newer_filing(rag_manager, dir_path)
+        test_replace_newer_filing(rag_manager, dir_path)
+    finally:
+        shutil.rmtree(dir_path)
+        rag_manager._collections.pop(COLLECTION).delete_collection()
+        for index_dir in ("bm25_index", "title_summary_index", "chunk_store", "index_version", "displaced_chunks"):
+            for path in (os.path.join(config['persist_directory'], index_dir, COLLECTION),
+                         os.path.join(config['persist_directory'], index_dir, f"{COLLECTION}.json")):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
@@ -120,23 +120,12 @@ if __name__ == "__main__":
             print("hyde_chunks length:", len(hyde_chunks))
             print("hyde_chunks: ", hyde_chunks)
 
-            all_chunks = []
+            print(f"Processing question {idx+1}, sub-questions: {questions}")
+            # all sub-questions are embedded and searched together, chunks already found for an earlier sub-question are dropped
+            chunk_lists = rag_manager._retrievers[0].invoke_batch(questions, [hyde_chunks] * len(questions), dedup=True)
+            chunks = [chunk for chunk_list in chunk_lists for chunk in chunk_list]
 
-            for q in questions:
-                print(f"Processing question {idx+1}, sub-question: {q}")
-                current_chunks = rag_manager._retrievers[0].invoke(q, hyde_chunks)
-                all_chunks.extend(current_chunks)
-
-            seen = set()
-            chunks = []
-            
-            for chunk in all_chunks:
-                chunk_id = (chunk['page_content'], chunk['metadata']['doc_id'])
-                if chunk_id not in seen:
-                    seen.add(chunk_id)
-                    chunks.append(chunk)
-
-            print(f"Chunks before deduplication: {len(all_chunks)}; Chunks after deduplication: {len(chunks)}")
+            print(f"Chunks after deduplication: {len(chunks)}")
 
             effective_chunks = chunks
             
@@ -0,0 +1,73 @@
+import os
+import sys
+import json
+import time
+import yaml
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from utils.ragManager import RAGManager
+from utils.rerankers import create_reranker
+
+# Throughput of each reranker backend on the [question, chunk] pairs retrieved for the questions in QUESTION_JSON.
+# Each entry of BACKENDS overrides the config; the score cache is disabled so every pair reaches the model.
+# Top-CHUNK_TOPK agreement is measured against the first backend that loads, normally the GPU FlagLLMReranker.
+COLLECTION = "lotus"
+QUESTION_JSON = "/root/autodl-tmp/RAG_Agent_vllm_tzh/src/test/test_questions/14m.json"
+TOPK = 20
+CHUNK_TOPK = 5
+NUM_QUESTIONS = 50
+BACKENDS = [
+    {'rerank_backend': 'flag_llm'},
+    {'rerank_backend': 'cross_encoder', 'rerank_model': 'BAAI/bge-reranker-v2-m3', 'rerank_quantize': False},
+    {'rerank_backend': 'cross_encoder', 'rerank_model': 'BAAI/bge-reranker-v2-m3', 'rerank_quantize': True},
+    {'rerank_backend': 'onnx', 'rerank_model': 'BAAI/bge-reranker-v2-m3'},
+    {'rerank_backend': 'bi_encoder'},
+    {'rerank_backend': 'none'},
+]
+
+
+def top_indices(scores, k):
+    return set(sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k])
+
+
+if __name__ == "__main__":
+    config_path = os.getenv('CONFIG_PATH', os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+        'config',
+        'config_vllm.yaml'
+    ))
+
+    with open(config_path, 'r') as file:
+        config = yaml.safe_load(file)
+
+    rag_manager = RAGManager(config=config, collections={COLLECTION: TOPK})
+    retriever = rag_manager._retrievers[0]
+
+    with open(QUESTION_JSON, 'r', encoding='utf-8') as f:
+        questions = [item['question'] for item in json.load(f)][:NUM_QUESTIONS]
+    pair_lists = [[[question, chunk['page_content']] for chunk in retriever.invoke(question, [])] for question in questions]
+    pair_lists = [pairs for pairs in pair_lists if pairs]
+    num_pairs = sum(len(pairs) for pairs in pair_lists)
+    print(f"{len(pair_lists)} questions, {num_pairs} pairs")
+
+    reference = None
+    for backend in BACKENDS:
+        backend_config = dict(config, rerank_cache_size=0, **backend)
+        try:
+            reranker = create_reranker(backend_config, embeddings=rag_manager.embeddings)
+        except Exception as e:
+            print(f"{backend}: could not be loaded: {e}")
+            continue
+        # warm up
+        reranker.compute_score(pair_lists[0])
+
+        start_time = time.perf_counter()
+        scores = [reranker.compute_score(pairs) for pairs in pair_lists]
+        elapsed_time = time.perf_counter() - start_time
+
+        tops = [top_indices(question_scores, CHUNK_TOPK) for question_scores in scores]
+        if reference is None:
+            reference = tops
+        agreement = sum(len(top & ref) / len(ref) for top, ref in zip(tops, reference)) / len(tops)
+        print(f"{backend}: {num_pairs / elapsed_time:.1f} pairs/s, {elapsed_time / len(pair_lists) * 1000:.1f} ms/question, "
+              f"top-{CHUNK_TOPK} agreement {agreement:.4f}, padding efficiency {reranker.padding_stats()['padding_efficiency']:.3f}")
@@ -0,0 +1,72 @@
+import os
+import sys
+import json
+import yaml
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from utils.ragManager import RAGManager
+from utils.vllmManager import ChatManager
+from utils.rerankers import create_reranker
+
+# Recall loss of the two-stage rerank (rerank_prefilter_bundles) against reranking every retrieved chunk.
+# For each question the bundles selected by the full rerank are the reference, each PREFILTER_BUNDLES setting
+# reports the share of them it still selects and how many pairs it sent to the reranker.
+# Scores are cached by the shared CachedReranker, so the cascade runs reuse the scores of the full run.
+COLLECTION = "lotus"
+QUESTION_JSON = "/root/autodl-tmp/RAG_Agent_vllm_tzh/src/test/test_questions/14m.json"
+TOPK = 40
+CHUNK_TOPK = 5
+PREFILTER_BUNDLES = [5, 10, 20, 40]
+
+
+if __name__ == "__main__":
+    config_path = os.getenv('CONFIG_PATH', os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+        'config',
+        'config_vllm.yaml'
+    ))
+
+    with open(config_path, 'r') as file:
+        config = yaml.safe_load(file)
+
+    rag_manager = RAGManager(config=config, collections={COLLECTION: TOPK})
+    retriever = rag_manager._retrievers[0]
+    reranker = create_reranker(config, embeddings=rag_manager.embeddings)
+
+    full_manager = ChatManager("full", config.get('ollama_base_url'), config.get('llm'), reranker, chunk_topk=CHUNK_TOPK)
+    cascade_managers = {
+        n: ChatManager(f"prefilter_{n}", config.get('ollama_base_url'), config.get('llm'), reranker, chunk_topk=CHUNK_TOPK, prefilter_bundles=n)
+        for n in PREFILTER_BUNDLES
+    }
+
+    with open(QUESTION_JSON, 'r', encoding='utf-8') as f:
+        questions = [item['question'] for item in json.load(f)]
+
+    query_time = datetime.now()
+    evaluated = 0
+    full_pairs = 0
+    recall = {n: 0.0 for n in PREFILTER_BUNDLES}
+    pairs = {n: 0 for n in PREFILTER_BUNDLES}
+    for question in questions:
+        chunks = retriever.invoke(question, [])
+        if not chunks:
+            continue
+        bundle_map = {}
+        for idx, chunk in enumerate(chunks):
+            bundle_map.setdefault(chunk['bundle_id'], []).append(idx)
+
+        evaluated += 1
+        reference = set(full_manager.rank_chunk(chunks, question, query_time, retriever))
+        full_pairs += len(chunks)
+        for n, chat_manager in cascade_managers.items():
+            selected = set(chat_manager.rank_chunk(chunks, question, query_time, retriever))
+            candidates = chat_manager.prefilter_candidates(chunks, question, bundle_map, retriever)
+            pairs[n] += len(chunks) if candidates is None else len(candidates)
+            recall[n] += len(selected & reference) / len(reference) if reference else 1.0
+
+    print(f"{evaluated} questions, full rerank: {full_pairs} pairs")
+    for n in PREFILTER_BUNDLES:
+        print(f"prefilter_bundles={n}: recall@{CHUNK_TOPK} vs full rerank {recall[n] / evaluated:.4f}, "
+              f"pairs reranked {pairs[n]} ({pairs[n] / full_pairs:.1%})")
+    print("rerank cache:", reranker.stats())
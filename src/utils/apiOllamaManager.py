@@ -11,6 +11,7 @@ from transformers import AutoModelForSequenceClassification, AutoTokenizer
 import torch
 import pandas as pd
 
+from .retrievalTrace import current_trace
 
 class ChatManager:
     def __init__(self, session_id, base_url, model_name, reranker, chunk_topk = 5, history_limit=20):
@@ -177,13 +178,8 @@ class ChatManager:
             bundle_map.setdefault(chunk['bundle_id'], []).append(idx)
             
         pairs = [[question, chunk['page_content']] for chunk in chunks]
-        # Batch the pairs for reranker
-        BATCH_SIZE = 8
-        scores = []
-        for i in range(0, len(pairs), BATCH_SIZE):
-            batch_pairs = pairs[i:i+BATCH_SIZE]
-            batch_scores = self.reranker.compute_score(batch_pairs)
-            scores.extend(batch_scores)
+        # the CachedReranker shared by all sessions only sends unscored pairs to the model, in batches
+        scores = self.reranker.compute_score(pairs, doc_ids=[chunk['metadata'].get('doc_id') for chunk in chunks])
         scores = torch.tensor(scores)
         # scores = torch.tensor(self.reranker.compute_score(pairs))
 
@@ -195,9 +191,10 @@ class ChatManager:
         #只有chunk content的 list
         chunk_content_list = []
         chunk_content_list.extend(chunk['page_content'] for chunk in chunks)
+        chunk_doc_ids = [chunk['metadata'].get('doc_id') for chunk in chunks]
 
+        similar_skipped = []
         for idx in ranked_indices:
-            logger.info(f"chunk {idx} bundle {chunks[idx]['bundle_id']} score: {scores[idx].item()}")
             bundle_id = chunks[idx]['bundle_id']
             bundle = bundle_map[bundle_id]
             # if bunleid is selected, skip
@@ -205,14 +202,25 @@ class ChatManager:
                 continue
             # remove the similar chunk
             
-            similarity = retriever.compute_similarity(chunk_content_list, selected_indices, idx)
+            similarity = retriever.compute_similarity(chunk_content_list, selected_indices, idx, chunk_doc_ids)
             if torch.any(similarity > self.similar_threshhold):
-                print(f"chunk{idx} is skip due to similarity")
+                similar_skipped.append(idx)
                 continue
             selected_indices.append(bundle_id)
             current_size += len(bundle)
             
         logger.info(f"reverse ranked bundle indices: {selected_indices[::-1]}")
+        trace = current_trace()
+        if trace is not None:
+            trace.add(
+                "rerank",
+                question=question,
+                doc_ids=chunk_doc_ids,
+                bundle_ids=[chunk['bundle_id'] for chunk in chunks],
+                reranker_scores=scores,
+                similar_skipped=similar_skipped,
+                selected_bundles=selected_indices[::-1],
+            )
         torch.cuda.empty_cache()
         return selected_indices[::-1]
 
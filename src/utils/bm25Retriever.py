@@ -5,12 +5,15 @@ from langchain_core.retrievers import BaseRetriever
 from langchain_core.documents import Document
 from langchain_core.callbacks import CallbackManagerForRetrieverRun
 from langchain_chroma import Chroma
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import numpy as np
 import bm25s
 from langchain_core.pydantic_v1 import PrivateAttr
 import Stemmer
 
+from .metadataColumns import MetadataColumns
+from .versionedDir import new_version_dir, publish_version, resolve_version_dir
+
 def load_from_chroma_and_save(documents: List[Document], save_dir: str):
 
     corpus = [doc.page_content for doc in documents]
@@ -19,9 +22,12 @@ def load_from_chroma_and_save(documents: List[Document], save_dir: str):
     corpus_tokens = bm25s.tokenize(corpus, stopwords="english", stemmer=stemmer)
     retriever = bm25s.BM25()
     retriever.index(corpus_tokens)
-    retriever.save(save_dir, corpus=doc_ids)
+    # a new version directory behind the CURRENT pointer, readers never load a half-written index
+    version_dir = new_version_dir(save_dir)
+    retriever.save(version_dir, corpus=doc_ids)
+    publish_version(save_dir, version_dir)
 
-    logging.info(f"{len(documents)} documents saved to {save_dir}")
+    logging.info(f"{len(documents)} documents saved to {version_dir}")
 
 class BM25Retriever:
     """BM25 retriever compatible with LangChain that supports metadata filtering."""
@@ -31,24 +37,32 @@ class BM25Retriever:
         dir_path: str,
         load_corpus: bool = True,
         min_score: Optional[float] = None,
-        stemmer: str = "english"
+        stemmer: str = "english",
+        metadata_columns: Optional[MetadataColumns] = None,
     ):
         """Initialize the BM25 retriever.
         
         Args:
-            documents: List of LangChain Document objects
-            dir_path: Path to the BM25 index
-            k: Number of documents to retrieve
+            dir_path: Path to the BM25 index, the version its CURRENT pointer names is loaded
             load_corpus: Whether to load the corpus from the index
             min_score: Minimum score threshold for retrieval
             stemmer: Stemmer to use, default is "english"
+            metadata_columns: Precomputed metadata columns of the indexed chunks, required for metadata filtering
         """
         super().__init__()
         
         self.min_score = min_score
-        self._bm25_engine = bm25s.BM25.load(dir_path, load_corpus=load_corpus)
+        self._bm25_engine = bm25s.BM25.load(resolve_version_dir(dir_path), load_corpus=load_corpus)
         self._stemmer = Stemmer.Stemmer(stemmer)
-        self.doc_len = len(self._bm25_engine.corpus)
+        self.doc_len = self._bm25_engine.scores['num_docs']
+        self.metadata_columns = metadata_columns
+
+    def get_scores(self, query: str) -> np.ndarray:
+        """BM25 scores of every indexed document for the query."""
+        query_tokens = bm25s.tokenize([query], stopwords="english", stemmer=self._stemmer, return_ids=False, show_progress=False)[0]
+        if len(query_tokens) == 0:
+            return np.zeros(self.doc_len, dtype=np.float32)
+        return self._bm25_engine.get_scores(query_tokens)
 
     def invoke(
         self,
@@ -60,76 +74,59 @@ class BM25Retriever:
         
         Args:
             query: String query to search for
-            run_manager: CallbackManager for the retriever run
-            metadata_filters: Optional dict of metadata field-value pairs to filter on
+            k: Number of documents to retrieve
+            metadata_filters: Optional filters on filename, date_published and page_number, see MetadataColumns
             
         Returns:
-            List of relevant Document objects (doc_id)
+            (ids, scores) of the top k documents, best first; ids are the row ids of the documents in the index
         """
+        scores = self.get_scores(query)
+        mask = self._get_filter_mask(metadata_filters)
+        return self._top_k(scores, k, mask)
 
-        query_tokens = bm25s.tokenize([query], stopwords="english", stemmer=self._stemmer)
-        
-        # Get BM25 scores
-        if metadata_filters:
-            raise NotImplementedError("Metadata filtering is not supported yet.")
-            # doc_ids = self._get_filtered_doc_ids(query_tokens, metadata_filters)
-        else:
-            # docs: {'id': bm25_id, 'text': doc_id}
-            docs, scores = self._bm25_engine.retrieve(
-                query_tokens,
-                k=k,
-                return_as="tuple"
-            )
-            
-            docs, scores = docs[0], scores[0]
-
-            if self.min_score is not None:
-                docs = [doc for doc, score in zip(docs, scores) if score >= self.min_score]
+    def invoke_batch(
+        self,
+        queries: List[str],
+        k: int,
+        metadata_filters: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """invoke for several queries, tokenised in one pass and sharing one filter mask.
 
-            ids = [doc['id'] for doc in docs]
-            return ids, scores
-        
+        Returns:
+            (ids, scores) of the top k documents of each query
+        """
+        mask = self._get_filter_mask(metadata_filters)
+        query_tokens = bm25s.tokenize(queries, stopwords="english", stemmer=self._stemmer, return_ids=False, show_progress=False)
+        results = []
+        for tokens in query_tokens:
+            if len(tokens) == 0:
+                scores = np.zeros(self.doc_len, dtype=np.float32)
+            else:
+                scores = self._bm25_engine.get_scores(tokens)
+            results.append(self._top_k(scores, k, mask))
+        return results
 
-    # TODO: support metadata filtering
-    def _get_filtered_doc_ids(
-        self,
-        query_tokens: List[str],
-        metadata_filters: Optional[Dict[str, Any]] = None
-    ):
-        docs, scores = self._bm25_engine.retrieve(
-            query_tokens,
-            return_as="tuple",
-            k=self.doc_len
-        )
-        
-        docs, scores = docs[0], scores[0]
+    def _get_filter_mask(self, metadata_filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        if not metadata_filters:
+            return None
+        if self.metadata_columns is None:
+            raise ValueError("Metadata filtering needs the metadata_columns of the indexed documents")
+        return self.metadata_columns.mask(metadata_filters)
 
-        doc_ids = [doc['text'] for doc in docs]
-        
-        # Create mask for filtered documents
-        mask = np.ones(self.doc_len, dtype=bool)
-            
-        # Apply metadata filters if provided
-        if metadata_filters:
-            for field, value in metadata_filters.items():
-                field_mask = np.array([
-                    doc.metadata.get(field) == value
-                    for doc in self.documents
-                ])
-                mask &= field_mask
-                
-        # Apply score threshold
+    def _top_k(self, scores: np.ndarray, k: int, mask: Optional[np.ndarray] = None):
+        """Partial selection of the k best scores, restricted to mask and min_score."""
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
         if self.min_score is not None:
-            mask &= (scores >= self.min_score)
-            
-        # Get filtered scores and documents
-        filtered_scores = scores[mask]
-        filtered_docs = np.array(doc_ids)[mask]
-        
-        # Sort by score and get top k
-        if len(filtered_scores) == 0:
-            return []
-            
-        top_k_indices = np.argsort(filtered_scores)[-self.k:][::-1]
-        
-        return [filtered_docs[i] for i in top_k_indices]
\ No newline at end of file
+            scores = np.where(scores >= self.min_score, scores, -np.inf)
+
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=scores.dtype)
+        top_k_ids = np.argpartition(-scores, k - 1)[:k]
+        top_k_ids = top_k_ids[np.argsort(-scores[top_k_ids], kind='stable')]
+        top_k_scores = scores[top_k_ids]
+
+        # documents removed by the filter or the score threshold
+        keep = top_k_scores != -np.inf
+        return top_k_ids[keep], top_k_scores[keep]
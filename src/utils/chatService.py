@@ -10,9 +10,10 @@ from typing import Dict
 
 from .apiOllamaManager import ChatManager
 from .ragManager import RAGManager
+from .rerankers import create_reranker
+from .rerankExecutor import RerankExecutor
 from gpu_log import log_gpu_usage
 from transformers import AutoModelForCausalLM, AutoTokenizer
-from FlagEmbedding import FlagLLMReranker
 
 
 def select_most_recent_time(time_info):
@@ -54,13 +55,27 @@ class ChatService:
         self.base_url: str = config.get('ollama_base_url')
         self.model_name: str = config.get('llm')
         
-        self.reranker = FlagLLMReranker(config.get('rerank_model'), use_fp16=True) 
+        # one score cache (and batching executor) in front of the reranker, shared by every session
+        # a RetrievalClient has no local embeddings, bi_encoder then scores through the retrieval server
+        self.reranker = create_reranker(
+            config, embeddings=getattr(rag_manager, 'embeddings', None), query_similarity=rag_manager.compute_query_similarity
+        )
 
         if not self.model_name or not self.base_url:
             logging.error("LLM model name/base_url is not configured.")
             sys.exit(1)
         logging.info(f"Using model: {self.model_name}, URL: {self.base_url}")
 
+    def rerank_cache_stats(self):
+        """Size, hits, misses and hit rate of the shared reranker score cache, None if it is disabled."""
+        return self.reranker.stats()
+
+    def rerank_batching_stats(self):
+        """Batch size and padding efficiency of the reranker calls, with queue depth if rerank_batching is on."""
+        if isinstance(self.reranker.reranker, RerankExecutor):
+            return self.reranker.reranker.stats()
+        return self.reranker.padding_stats()
+
     def get_or_create_chat_manager(self, session_id: str) -> ChatManager:
         if session_id not in self.api_chat_manager:
             self.api_chat_manager[session_id] = ChatManager(session_id, self.base_url, self.model_name, self.reranker)
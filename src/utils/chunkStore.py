@@ -0,0 +1,178 @@
+import os
+import json
+import mmap
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from collections.abc import Sequence
+from typing import List, Dict, Tuple, Any, Iterable
+
+from .versionedDir import new_version_dir, publish_version, resolve_version_dir
+
+META_FILE = "meta.json"
+INT_COLUMN = "int"
+STR_COLUMN = "str"
+JSON_COLUMN = "json"
+
+def _column_kind(values: List[Any]) -> str:
+    present = [value for value in values if value is not None]
+    if all(isinstance(value, int) and not isinstance(value, bool) for value in present):
+        return INT_COLUMN
+    if all(isinstance(value, str) for value in present):
+        return STR_COLUMN
+    return JSON_COLUMN
+
+def _save_blob(save_dir: str, name: str, strings: Iterable[str]):
+    """Save strings as one utf-8 blob plus an int64 offsets array of length n + 1."""
+    offsets = [0]
+    with open(os.path.join(save_dir, f"{name}.bin"), 'wb') as f:
+        for string in strings:
+            data = string.encode('utf-8')
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(save_dir, f"{name}_offsets.npy"), np.array(offsets, dtype=np.int64))
+
+def save_chunk_store(documents: List[str], metadatas: List[Dict[str, Any]], save_dir: str):
+    """Save chunk contents and metadata column by column, row i being the i-th chunk of the collection.
+
+    Rows must be in the same order as the FAISS / BM25 indexes, i.e. the order of chroma.get().
+    Every metadata key becomes a column with a presence mask, so missing keys stay missing on read.
+    Each save writes a new version directory inside save_dir and then atomically replaces the CURRENT
+    pointer, so save_dir always holds a complete store, even if the process dies halfway.
+    """
+    tmp_dir = new_version_dir(save_dir)
+
+    _save_blob(tmp_dir, "documents", documents)
+
+    keys = list(dict.fromkeys(key for metadata in metadatas for key in metadata))
+    columns = {}
+    for i, key in enumerate(keys):
+        name = f"col_{i}"
+        values = [metadata.get(key, None) for metadata in metadatas]
+        kind = _column_kind(values)
+        np.save(os.path.join(tmp_dir, f"{name}_present.npy"), np.array([value is not None for value in values], dtype=bool))
+        if kind == INT_COLUMN:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), np.array([value if value is not None else 0 for value in values], dtype=np.int64))
+        elif kind == STR_COLUMN:
+            _save_blob(tmp_dir, name, (value if value is not None else "" for value in values))
+        else:
+            _save_blob(tmp_dir, name, (json.dumps(value) if value is not None else "" for value in values))
+        columns[key] = {"name": name, "kind": kind}
+
+    with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+        json.dump({"num_rows": len(documents), "columns": columns}, f)
+
+    # swap the finished store in so concurrent readers never see a half-written or missing store
+    publish_version(save_dir, tmp_dir)
+    logger.info(f"{len(documents)} chunks saved to chunk store {save_dir} version {os.path.basename(tmp_dir)}")
+
+def chunk_store_exists(dir_path: str) -> bool:
+    """True if dir_path holds a complete chunk store."""
+    return os.path.exists(os.path.join(resolve_chunk_store_dir(dir_path), META_FILE))
+
+def resolve_chunk_store_dir(dir_path: str) -> str:
+    """Directory of the version a chunk store currently serves, dir_path itself for stores saved before versioning."""
+    return resolve_version_dir(dir_path)
+
+class _StringColumn:
+    """Memory-mapped utf-8 blob with int64 offsets."""
+
+    def __init__(self, dir_path: str, name: str):
+        self.offsets = np.load(os.path.join(dir_path, f"{name}_offsets.npy"), mmap_mode='r')
+        with open(os.path.join(dir_path, f"{name}.bin"), 'rb') as f:
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] > 0 else b""
+
+    def take(self, rows: List[int]) -> List[str]:
+        starts = self.offsets[rows].tolist()
+        ends = self.offsets[np.asarray(rows, dtype=np.int64) + 1].tolist()
+        return [self.blob[start:end].decode('utf-8') for start, end in zip(starts, ends)]
+
+class ChunkStore:
+    """Read-optimised, memory-mapped store of chunk contents and metadata indexed by row id.
+
+    Chroma stays the system of record, this store is written at ingest by save_chunk_store and only read here.
+    """
+
+    def __init__(self, dir_path: str, max_attempts: int = 3):
+        for attempt in range(max_attempts):
+            version_dir = resolve_chunk_store_dir(dir_path)
+            try:
+                self._open(version_dir)
+                return
+            except FileNotFoundError:
+                # a newer save removed this version while it was opened, follow the pointer again
+                if attempt == max_attempts - 1 or resolve_chunk_store_dir(dir_path) == version_dir:
+                    raise
+
+    def _open(self, dir_path: str):
+        with open(os.path.join(dir_path, META_FILE), 'r') as f:
+            meta = json.load(f)
+        self.dir_path = dir_path
+        self.num_rows = meta["num_rows"]
+        self._documents = _StringColumn(dir_path, "documents")
+        self._columns = {}
+        for key, column in meta["columns"].items():
+            name, kind = column["name"], column["kind"]
+            present = np.load(os.path.join(dir_path, f"{name}_present.npy"), mmap_mode='r')
+            if kind == INT_COLUMN:
+                values = np.load(os.path.join(dir_path, f"{name}.npy"), mmap_mode='r')
+            else:
+                values = _StringColumn(dir_path, name)
+            self._columns[key] = (kind, present, values)
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def column(self, key: str) -> List[Any]:
+        """All values of one metadata column, None where the key is missing."""
+        kind, present, values = self._columns[key]
+        rows = list(range(self.num_rows))
+        return self._take_column(kind, present, values, rows)
+
+    @staticmethod
+    def _take_column(kind: str, present: np.ndarray, values, rows: List[int]) -> List[Any]:
+        mask = present[rows].tolist()
+        if kind == INT_COLUMN:
+            taken = values[rows].tolist()
+        else:
+            taken = values.take(rows)
+            if kind == JSON_COLUMN:
+                taken = [json.loads(value) if is_present else None for value, is_present in zip(taken, mask)]
+        return [value if is_present else None for value, is_present in zip(taken, mask)]
+
+    def get(self, rows: List[int], exclude: Tuple[str, ...] = ()) -> Tuple[List[str], List[Dict[str, Any]]]:
+        """Documents and metadata dicts of rows, in the order of rows.
+
+        Args:
+            rows: row ids (FAISS / BM25 ids)
+            exclude: metadata keys that are not decoded
+        """
+        rows = [int(row) for row in rows]
+        documents = self._documents.take(rows)
+        metadatas = [{} for _ in rows]
+        for key, (kind, present, values) in self._columns.items():
+            if key in exclude:
+                continue
+            for metadata, value in zip(metadatas, self._take_column(kind, present, values, rows)):
+                if value is not None:
+                    metadata[key] = value
+        return documents, metadatas
+
+class MetadataView(Sequence):
+    """Read-only list of metadata dicts decoded row by row from a ChunkStore, for callers written against a list."""
+
+    def __init__(self, chunk_store: ChunkStore):
+        self.chunk_store = chunk_store
+
+    def __getitem__(self, row: int) -> Dict[str, Any]:
+        if isinstance(row, slice):
+            return self.chunk_store.get(range(*row.indices(len(self))))[1]
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return self.chunk_store.get([row])[1][0]
+
+    def __len__(self) -> int:
+        return len(self.chunk_store)
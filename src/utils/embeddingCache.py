@@ -0,0 +1,67 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from .lruCache import LRUCache
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that caches query vectors by (model id, whitespace-normalised text).
+
+    One instance is shared by every retriever of the RAGManager, so repeated questions and HyDE passages
+    are embedded once across sessions. Only queries (embed_query / embed_queries) are cached, document
+    embedding for ingest (Chroma, title summaries, upsert_filing) passes straight through so bulk loads
+    never evict them. Vectors are kept as float32 arrays.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_id: str, max_size: int = 10000, ttl: Optional[float] = None):
+        """
+        Args:
+            embeddings: the wrapped embedding model
+            model_id: id of the embedding model, part of every cache key
+            max_size: maximum number of cached vectors
+            ttl: seconds a cached vector stays valid, None to keep it until evicted
+        """
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.cache = LRUCache(max_size=max_size, ttl=ttl)
+
+    def _key(self, text: str):
+        return (self.model_id, " ".join(text.split()))
+
+    def embed_queries(self, texts: List[str]) -> np.ndarray:
+        """Cached vectors of texts embedded as retrieval queries, a float32 array of shape (len(texts), dimension).
+
+        HuggingFaceEmbeddings encodes queries and documents the same way unless query_encode_kwargs is set,
+        missing texts are embedded in one embed_documents call.
+        """
+        keys = [self._key(text) for text in texts]
+        vectors = [self.cache.get(key) for key in keys]
+
+        # embed each distinct missing text once
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], i)
+        if missing:
+            missing_vectors = np.array(self.embeddings.embed_documents([texts[i] for i in missing.values()]), dtype=np.float32)
+            computed = dict(zip(missing.keys(), missing_vectors))
+            for key, vector in computed.items():
+                self.cache.put(key, vector)
+            vectors = [vector if vector is not None else computed[key] for key, vector in zip(keys, vectors)]
+        if not vectors:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack(vectors)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0].tolist()
+
+    def stats(self):
+        return self.cache.stats()
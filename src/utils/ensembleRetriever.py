@@ -1,8 +1,13 @@
+import time
 import logging
+import tempfile
+import contextvars
 import torch
+import numpy as np
 logger = logging.getLogger(__name__)
 
-from typing import Dict, List, Optional, Set, Union, Any
+from typing import Dict, List, Optional, Set, Union, Any, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_chroma import Chroma
@@ -10,257 +15,662 @@ from langchain_core.documents import Document
 
 from .bm25Retriever import BM25Retriever
 from .faissRetriever import FaissRetriever
+from .titleSummaryIndex import hash_title_summary, load_title_summary_embeddings
+from .chunkStore import ChunkStore, MetadataView, save_chunk_store, chunk_store_exists
+from .metadataColumns import MetadataColumns, DocIdIndex
+from .lruCache import LRUCache
+from .indexVersion import UNVERSIONED
+from .retrievalTrace import current_trace
+
+def chunk_list_nbytes(chunk_list: List[Dict]) -> int:
+    """Rough memory footprint of a chunk_list returned by EnsembleRetriever.invoke, used as retrieval cache budget."""
+    nbytes = 0
+    for chunk in chunk_list:
+        nbytes += 400 + len(chunk['page_content']) + sum(len(str(key)) + len(str(value)) + 100 for key, value in chunk['metadata'].items())
+    return nbytes
+
+def _copy_chunk_list(chunk_list: List[Dict]) -> List[Dict]:
+    return [{**chunk, "metadata": dict(chunk["metadata"])} for chunk in chunk_list]
 
 class EnsembleRetriever:
     """Base class for retriever wrappers that handle document content retrieval"""
     
-    def __init__(self, bm25_dir: str, chroma: Chroma, k: int, embeddings: HuggingFaceEmbeddings):
+    def __init__(
+        self,
+        bm25_dir: str,
+        chroma: Chroma,
+        k: int,
+        embeddings: HuggingFaceEmbeddings,
+        embed_batch_size: int = 32,
+        expansion_mode: str = "targeted",
+        index_config: Optional[Dict[str, Any]] = None,
+        title_summary_dir: Optional[str] = None,
+        embeddings_model_name: Optional[str] = None,
+        chunk_store_dir: Optional[str] = None,
+        parallel_paths: bool = False,
+        path_workers: int = 6,
+        result_cache: Optional[LRUCache] = None,
+        collection_name: str = "",
+        index_version: str = UNVERSIONED,
+        rebuild_version: str = UNVERSIONED,
+        previous: Optional["EnsembleRetriever"] = None,
+    ):
+        """
+        Args:
+            embed_batch_size: max number of texts per query embedding call
+            expansion_mode: how prev/next chunks are scored during chunk expansion.
+                "targeted" searches only the top k and scores candidate neighbours directly,
+                "sweep" searches the top 2048 and only knows the scores of neighbours within them.
+            index_config: `faiss_index` config section for the chunk index, see faissRetriever.build_index.
+                The title summary index is always a flat index, with the same vector storage and re-scoring settings.
+            title_summary_dir: directory of the title summary vectors saved at ingest, only new summaries are embedded
+            embeddings_model_name: id of the embedding model, stored vectors of another model are ignored
+            chunk_store_dir: directory of the columnar chunk store chunk contents are read from,
+                (re)built from chroma when missing or out of date with the collection
+            parallel_paths: run the dense, title summary and BM25 searches concurrently on a thread pool
+            path_workers: size of that thread pool, shared by all concurrent invoke calls
+            result_cache: optional cache of invoke results, may be shared by the retrievers of several collections
+            collection_name: name of the collection, namespaces the entries of result_cache
+            index_version: version stamp of the persisted indexes (see indexVersion), part of every result_cache key
+                so results of an older index are never served
+            rebuild_version: version stamp of the last full rebuild the persisted indexes derive from
+            previous: the retriever this one replaces when only single filing updates happened since it was loaded,
+                its chunk FAISS index is updated with the added and removed rows instead of rebuilt (see FaissRetriever)
+        """
         super().__init__()
+        if expansion_mode not in ("targeted", "sweep"):
+            raise ValueError(f"Unknown expansion_mode: {expansion_mode}")
         self.embeddings = embeddings
         self.k = k
+        self.expansion_mode = expansion_mode
         self.chroma = chroma
+        self.result_cache = result_cache
+        self.collection_name = collection_name
+        self.index_version = index_version
+        self.rebuild_version = rebuild_version
+        self._path_executor = ThreadPoolExecutor(max_workers=path_workers, thread_name_prefix="retrieval_path") if parallel_paths else None
         docs = chroma.get(include=["metadatas", "embeddings"])
 
-        self.bm25_retriever = BM25Retriever(bm25_dir)
-        self.faiss_retriever = FaissRetriever(docs['embeddings'], embeddings)
-        
-        # save all metadata except title_summary
-        self.chunk_metadata = docs['metadatas']
-        
-        # self.chunk_metadata = [{**metadata, 'chunk_num': 1} for metadata in docs['metadatas']]
-        self.docid2idx = {doc['doc_id']: idx for idx, doc in enumerate(self.chunk_metadata)}
-        self.num_chunk = len(docs['metadatas'])
-
-        title_summaries = set()
-
-        # get all unique title_summary and embed into faiss index
-        for metadata in docs['metadatas']:
-            title_summary = metadata.get('title_summary', '')
-            if title_summary != '':
-                title_summaries.add(title_summary)
-
-        self.title_summaries = list(title_summaries)
-        logger.info(f"Building title summary FAISS index with {len(docs['metadatas'])} vectors")
-        title_summary_embeddings = embeddings.embed_documents(title_summaries)
-        self.title_summary_faiss_retriever = FaissRetriever(title_summary_embeddings, embeddings)
+        # compact numpy columns of the metadata (filters, neighbour rows, bundles, title summaries),
+        # shared by the sparse and dense paths; the metadata dicts themselves are only kept in the chunk store
+        self.metadata_columns = MetadataColumns(docs['metadatas'])
+        self.bm25_retriever = BM25Retriever(bm25_dir, load_corpus=False, metadata_columns=self.metadata_columns)
+        doc_ids = [metadata['doc_id'] for metadata in docs['metadatas']]
+        previous_rows = previous.metadata_columns.rows_of(doc_ids) if previous is not None else None
+        self.faiss_retriever = FaissRetriever(
+            docs['embeddings'], embeddings, embed_batch_size, index_config,
+            previous=previous.faiss_retriever if previous is not None else None, previous_rows=previous_rows,
+        )
+        self.num_chunk = self.metadata_columns.num_rows
+
+        del docs
+        self.chunk_store = self._load_chunk_store(chunk_store_dir, doc_ids)
+        del doc_ids
+
+        self.title_summaries = self.metadata_columns.title_summaries
+        # position of each chunk's title_summary in self.title_summaries, -1 if it has none
+        self.chunk_title_codes = self.metadata_columns.title_codes
+        logger.info(f"Building title summary FAISS index with {len(self.title_summaries)} vectors")
+        title_summary_embeddings = self._get_title_summary_embeddings(title_summary_dir, embeddings_model_name)
+        title_index_config = {
+            key: value for key, value in (index_config or {}).items()
+            if key in ('use_gpu', 'storage', 'rescore', 'rescore_factor', 'rescore_dir')
+        }
+        self.title_summary_faiss_retriever = FaissRetriever(title_summary_embeddings, embeddings, embed_batch_size, title_index_config)
         logger.info("title summary FAISS index built")
-        
-    
+
+    def close(self):
+        """Release what a swapped out retriever holds outside the Python heap, see FaissRetriever.close."""
+        self.faiss_retriever.close()
+        self.title_summary_faiss_retriever.close()
+
+    @property
+    def docid2idx(self) -> DocIdIndex:
+        """doc_id -> row mapping, backed by the sorted doc_id column."""
+        return DocIdIndex(self.metadata_columns)
+
+    @property
+    def chunk_metadata(self) -> MetadataView:
+        """Metadata dict of every row, decoded from the chunk store on access."""
+        return MetadataView(self.chunk_store)
+
+    def _load_chunk_store(self, chunk_store_dir: Optional[str], doc_ids: List[str]) -> ChunkStore:
+        """Open the chunk store if it matches the collection (doc_ids in row order), otherwise rebuild it from chroma."""
+        if chunk_store_dir is not None and chunk_store_exists(chunk_store_dir):
+            chunk_store = ChunkStore(chunk_store_dir)
+            if len(chunk_store) == self.num_chunk and chunk_store.column('doc_id') == doc_ids:
+                logger.info(f"Chunk store loaded from {chunk_store_dir}")
+                return chunk_store
+            logger.warning(f"Chunk store in {chunk_store_dir} does not match the collection, rebuilding it")
+
+        docs = self.chroma.get(include=["documents", "metadatas"])
+        if [metadata['doc_id'] for metadata in docs['metadatas']] != doc_ids:
+            raise RuntimeError("Chroma returned the collection in a different order, cannot align chunk store rows with the FAISS index")
+        if chunk_store_dir is None:
+            chunk_store_dir = tempfile.mkdtemp(prefix="chunk_store_")
+        save_chunk_store(docs['documents'], docs['metadatas'], chunk_store_dir)
+        return ChunkStore(chunk_store_dir)
+
+    def _get_title_summary_embeddings(self, title_summary_dir: Optional[str], embeddings_model_name: Optional[str]) -> np.ndarray:
+        """Vectors of self.title_summaries, read from the stored index where possible and embedded otherwise."""
+        key2row, stored_vectors = {}, None
+        if title_summary_dir is not None:
+            key2row, stored_vectors = load_title_summary_embeddings(title_summary_dir, embeddings_model_name)
+
+        rows = [key2row.get(hash_title_summary(title_summary), -1) for title_summary in self.title_summaries]
+        missing = [i for i, row in enumerate(rows) if row == -1]
+        if len(missing) == len(self.title_summaries):
+            return np.array(self.embeddings.embed_documents(self.title_summaries), dtype=np.float32)
+
+        title_summary_embeddings = np.empty((len(self.title_summaries), stored_vectors.shape[1]), dtype=np.float32)
+        found = [i for i, row in enumerate(rows) if row != -1]
+        title_summary_embeddings[found] = stored_vectors[[rows[i] for i in found]]
+        if missing:
+            title_summary_embeddings[missing] = self.embeddings.embed_documents([self.title_summaries[i] for i in missing])
+        logger.info(f"{len(found)} title summary embeddings loaded from {title_summary_dir}, {len(missing)} embedded")
+        return title_summary_embeddings
+
+    def _gather_bundle(self, idx: int, mask: Optional[np.ndarray] = None) -> List[int]:
+        """Return the rows of the bundle that chunk idx belongs to, or [idx] if it has no bundle_id.
+
+        Rows outside the metadata filter mask are left out.
+        """
+        if self.metadata_columns.bundle_codes[idx] < 0:
+            return [idx]
+        idxs = self.metadata_columns.bundle_rows(idx)
+        if mask is not None:
+            idxs = idxs[mask[idxs]]
+        return idxs.tolist()
+
+    def _title_mask(self, mask: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """Title summaries that have at least one chunk inside the metadata filter mask."""
+        if mask is None:
+            return None
+        title_mask = np.zeros(len(self.title_summaries), dtype=bool)
+        title_mask[self.chunk_title_codes[mask & (self.chunk_title_codes >= 0)]] = True
+        return title_mask
+
+    def _neighbour_score(self, effective_ids: Dict[int, float], query_vector: np.ndarray, idx: int) -> float:
+        """Score of chunk idx for the query, computed on demand in targeted mode and cached in effective_ids."""
+        score = effective_ids.get(idx, None)
+        if score is None:
+            if self.expansion_mode == "sweep":
+                return 0
+            score = float(self.faiss_retriever.score(query_vector, [idx])[0])
+            effective_ids[idx] = score
+        return score
+
+    @staticmethod
+    def _timed(timings: Dict[str, float], name: str, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            timings[name] = time.perf_counter() - start
+
+    def _search_paths(
+        self,
+        input: str,
+        inputs: List[str],
+        filters: Optional[Dict[str, Any]],
+        mask: Optional[np.ndarray],
+        timings: Dict[str, float],
+        query_vectors: Optional[np.ndarray] = None,
+    ):
+        """Run the dense, title summary and BM25 searches, concurrently if parallel_paths is set.
+
+        inputs are embedded unless their normalised query_vectors are given.
+
+        Returns:
+            (query_vectors, (faiss_ids_list, faiss_scores_list), (title_summary_ids, title_summary_scores), (bm25_ids, bm25_scores))
+        """
+        # only the top k are used as seeds, a wide sweep is needed only to look up neighbour scores
+        search_k = 2048 if self.expansion_mode == "sweep" else self.k
+        title_mask = self._title_mask(mask)
+
+        if self._path_executor is None:
+            # embed the question and all hyde chunks in one batched pass, the question vector is reused for title summaries
+            if query_vectors is None:
+                query_vectors = self._timed(timings, "embed", self.faiss_retriever.embed_queries, inputs)
+            faiss_result = self._timed(timings, "faiss", self.faiss_retriever.search, query_vectors, search_k, mask)
+            title_result = self._timed(timings, "title_summary", self.title_summary_faiss_retriever.search, query_vectors[:1], 5, title_mask)
+            bm25_result = self._timed(timings, "bm25", self.bm25_retriever.invoke, input, self.k, filters)
+            return query_vectors, faiss_result, title_result, bm25_result
+
+        # BM25 does not need the query vectors, start it before embedding
+        bm25_future = self._path_executor.submit(self._timed, timings, "bm25", self.bm25_retriever.invoke, input, self.k, filters)
+        if query_vectors is None:
+            query_vectors = self._timed(timings, "embed", self.faiss_retriever.embed_queries, inputs)
+        faiss_future = self._path_executor.submit(self._timed, timings, "faiss", self.faiss_retriever.search, query_vectors, search_k, mask)
+        title_future = self._path_executor.submit(self._timed, timings, "title_summary", self.title_summary_faiss_retriever.search, query_vectors[:1], 5, title_mask)
+        return query_vectors, faiss_future.result(), title_future.result(), bm25_future.result()
+
     def invoke(
         self,
         input: str,
         hyde_chunks: list[str],
+        filters: Optional[Dict[str, Any]] = None,
+        timings: Optional[Dict[str, float]] = None,
+        query_vectors: Optional[np.ndarray] = None,
+    ) -> List[Dict]:
+        """Get documents with their content
+
+        Args:
+            input: the question
+            hyde_chunks: hypothetical passages generated for the question
+            filters: optional metadata filter (filename, date_published / page_number ranges, see MetadataColumns),
+                applied inside the dense, title summary and BM25 searches
+            timings: optional dict filled with the seconds spent per path (embed, faiss, title_summary, bm25)
+                and in merging their results (merge)
+            query_vectors: optional normalised vectors of [input] + hyde_chunks, e.g. embedded once for several collections
+        """
+        timings = {} if timings is None else timings
+        if self.result_cache is None:
+            return self._invoke(input, hyde_chunks, filters, timings, query_vectors)
+
+        start_time = time.perf_counter()
+        key = self._cache_key(input, hyde_chunks, self.metadata_columns.filter_key(filters))
+        chunk_list = self.result_cache.get(key)
+        if chunk_list is not None:
+            timings["total"] = time.perf_counter() - start_time
+            logger.info(f"Retrieval cache hit ({len(chunk_list)} chunks), {timings['total'] * 1000:.1f}ms")
+            self._trace_cached(input, hyde_chunks, chunk_list)
+            return _copy_chunk_list(chunk_list)
+
+        chunk_list = self._invoke(input, hyde_chunks, filters, timings, query_vectors)
+        self.result_cache.put(key, _copy_chunk_list(chunk_list))
+        return chunk_list
+
+    def invoke_batch(
+        self,
+        queries: List[str],
+        hyde_per_query: Optional[List[List[str]]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        dedup: bool = False,
+        timings: Optional[Dict[str, float]] = None,
+        query_vectors: Optional[List[np.ndarray]] = None,
+        contexts: Optional[List[contextvars.Context]] = None,
+    ) -> List[List[Dict]]:
+        """invoke for several questions at once.
+
+        The questions and hyde chunks of the whole batch are embedded together and searched with one FAISS
+        search per index, BM25 tokenises all questions in one pass. Cached results are reused per question.
+
+        Args:
+            queries: the questions
+            hyde_per_query: hyde chunks of each question, None if there are none
+            filters: metadata filter shared by all questions, see invoke
+            dedup: drop chunks whose doc_id was already returned for an earlier question of the batch
+            timings: optional dict filled with the seconds spent per path for the whole batch, see invoke
+            query_vectors: optional normalised vectors of [queries[i]] + hyde_per_query[i] per question, see invoke
+            contexts: optional context per question to record its retrieval trace in, e.g. of the request that asked it
+
+        Returns:
+            one chunk list per question, before dedup the same as invoke(queries[i], hyde_per_query[i], filters)
+        """
+        timings = {} if timings is None else timings
+        start_time = time.perf_counter()
+        if hyde_per_query is None:
+            hyde_per_query = [[] for _ in queries]
+        if len(hyde_per_query) != len(queries):
+            raise ValueError(f"Got {len(hyde_per_query)} hyde chunk lists for {len(queries)} queries")
+        hyde_per_query = [list(hyde_chunks) for hyde_chunks in hyde_per_query]
+
+        results = [None] * len(queries)
+        keys = [None] * len(queries)
+        if self.result_cache is not None:
+            filter_key = self.metadata_columns.filter_key(filters)
+            for i, (input, hyde_chunks) in enumerate(zip(queries, hyde_per_query)):
+                keys[i] = self._cache_key(input, hyde_chunks, filter_key)
+                chunk_list = self.result_cache.get(keys[i])
+                if chunk_list is not None:
+                    results[i] = _copy_chunk_list(chunk_list)
+                    self._run_in(contexts, i, self._trace_cached, input, hyde_chunks, chunk_list)
+
+        todo = [i for i, chunk_list in enumerate(results) if chunk_list is None]
+        if todo:
+            chunk_lists = self._invoke_batch(
+                [queries[i] for i in todo], [hyde_per_query[i] for i in todo], filters, timings,
+                None if query_vectors is None else [query_vectors[i] for i in todo],
+                None if contexts is None else [contexts[i] for i in todo],
+            )
+            for i, chunk_list in zip(todo, chunk_lists):
+                results[i] = chunk_list
+                if self.result_cache is not None:
+                    self.result_cache.put(keys[i], _copy_chunk_list(chunk_list))
+
+        if dedup:
+            seen_doc_ids = set()
+            for i, chunk_list in enumerate(results):
+                results[i] = [chunk for chunk in chunk_list if chunk['metadata'].get('doc_id') not in seen_doc_ids]
+                seen_doc_ids.update(chunk['metadata'].get('doc_id') for chunk in chunk_list)
+
+        timings["total"] = time.perf_counter() - start_time
+        logger.info(f"Batch retrieval of {len(queries)} queries ({len(queries) - len(todo)} cached): " + ", ".join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in timings.items()))
+        return results
+
+    def _cache_key(self, input: str, hyde_chunks: List[str], filter_key) -> tuple:
+        return (
+            self.collection_name, self.index_version, self.k, self.expansion_mode,
+            input, tuple(hyde_chunks), filter_key,
+        )
+
+    def _invoke_batch(
+        self,
+        queries: List[str],
+        hyde_per_query: List[List[str]],
+        filters: Optional[Dict[str, Any]],
+        timings: Dict[str, float],
+        vectors_per_query: Optional[List[np.ndarray]] = None,
+        contexts: Optional[List[contextvars.Context]] = None,
+    ) -> List[List[Dict]]:
+        mask = self.metadata_columns.mask(filters)
+        inputs_list = [[input] + hyde_chunks for input, hyde_chunks in zip(queries, hyde_per_query)]
+        # texts shared by several questions (e.g. the same hyde chunks) are embedded and searched once
+        text_rows = {}
+        for inputs in inputs_list:
+            for text in inputs:
+                text_rows.setdefault(text, len(text_rows))
+
+        search_k = 2048 if self.expansion_mode == "sweep" else self.k
+        if vectors_per_query is None:
+            query_vectors = self._timed(timings, "embed", self.faiss_retriever.embed_queries, list(text_rows))
+        else:
+            query_vectors = np.empty((len(text_rows), self.faiss_retriever.dimension), dtype=np.float32)
+            for inputs, vectors in zip(inputs_list, vectors_per_query):
+                query_vectors[[text_rows[text] for text in inputs]] = vectors
+        faiss_ids, faiss_scores = self._timed(timings, "faiss", self.faiss_retriever.search, query_vectors, search_k, mask)
+        question_rows = [text_rows[input] for input in queries]
+        title_ids, title_scores = self._timed(
+            timings, "title_summary", self.title_summary_faiss_retriever.search, query_vectors[question_rows], 5, self._title_mask(mask)
+        )
+        bm25_results = self._timed(timings, "bm25", self.bm25_retriever.invoke_batch, queries, self.k, filters)
+
+        merge_start_time = time.perf_counter()
+        chunk_lists = []
+        for i, inputs in enumerate(inputs_list):
+            rows = [text_rows[text] for text in inputs]
+            chunk_lists.append(self._run_in(
+                contexts, i, self._merge_paths,
+                inputs, query_vectors[rows], (faiss_ids[rows], faiss_scores[rows]),
+                (title_ids[i:i + 1], title_scores[i:i + 1]), bm25_results[i], mask,
+            ))
+        timings["merge"] = time.perf_counter() - merge_start_time
+        return chunk_lists
+
+    def _invoke(
+        self,
+        input: str,
+        hyde_chunks: List[str],
+        filters: Optional[Dict[str, Any]],
+        timings: Dict[str, float],
+        query_vectors: Optional[np.ndarray] = None,
     ) -> List[Dict]:
-        """Get documents with their content"""
+        start_time = time.perf_counter()
+        mask = self.metadata_columns.mask(filters)
+
+        inputs = [input] + hyde_chunks
+        query_vectors, faiss_result, title_result, bm25_result = self._search_paths(input, inputs, filters, mask, timings, query_vectors)
+        merge_start_time = time.perf_counter()
+        chunk_list = self._merge_paths(inputs, query_vectors, faiss_result, title_result, bm25_result, mask)
 
+        timings["merge"] = time.perf_counter() - merge_start_time
+        timings["total"] = time.perf_counter() - start_time
+        logger.info("Retrieval timings: " + ", ".join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in timings.items()))
+        return chunk_list
+
+    def _merge_paths(
+        self,
+        inputs: List[str],
+        query_vectors: np.ndarray,
+        faiss_result: Tuple[np.ndarray, np.ndarray],
+        title_result: Tuple[np.ndarray, np.ndarray],
+        bm25_result: Tuple[np.ndarray, np.ndarray],
+        mask: Optional[np.ndarray],
+    ) -> List[Dict]:
+        """Turn the search results of one question ([question] + hyde chunks) into its chunk list."""
         seen_ids = set()
         chunk_list = []
         bundle_cnt = 0
 
-        inputs = [input] + hyde_chunks
-        faiss_ids_list, faiss_scores_list = self.faiss_retriever.invoke(inputs, 2048)
-        for inp, faiss_ids, faiss_scores in zip(inputs, faiss_ids_list, faiss_scores_list):
+        # merge the paths in a fixed order (faiss, title summary, BM25) so seen_ids precedence never depends on timing
+        faiss_ids_list, faiss_scores_list = faiss_result
+        for query_vector, faiss_ids, faiss_scores in zip(query_vectors, faiss_ids_list, faiss_scores_list):
             effective_ids = {idx: score for idx, score in zip(faiss_ids, faiss_scores)}
             # augment retrieved content with precious and next chunk
             top_k_ids, top_k_scores = faiss_ids[:self.k], faiss_scores[:self.k]
-            logger.info(f"Input: {inp}")
-            logger.info(f"Top {self.k} FAISS results:")
             for idx, score in zip(top_k_ids, top_k_scores):
-                if idx in seen_ids:
+                # faiss pads with -1 when the index holds fewer than k vectors
+                if idx < 0 or idx in seen_ids:
                     continue
                 seen_ids.add(idx)
                 ids = [idx]
-                doc_metadata = self.chunk_metadata[idx]
                 # gather bundle if bundle_id is not null
-                if doc_metadata.get('bundle_id', None) != None:
-                    bundle_id = doc_metadata['bundle_id']
-                    # find corresponding bundle_id from self.chunk_metadata
-                    bundle_ids = [idx for idx, metadata in enumerate(self.chunk_metadata) if metadata.get('bundle_id', None) == bundle_id]
-                    ids = bundle_ids
-                    seen_ids.update(bundle_ids)
+                if self.metadata_columns.bundle_codes[idx] >= 0:
+                    ids = self._gather_bundle(idx, mask)
+                    seen_ids.update(ids)
 
                 # expand chunk if score is high
                 if score > 0.72:
-                    prev_doc_id = doc_metadata['prev_chunk_id']
-                    next_doc_id = doc_metadata['next_chunk_id']
+                    # neighbour rows, -1 if there is none in the collection
+                    prev_id = int(self.metadata_columns.prev_rows[idx])
+                    next_id = int(self.metadata_columns.next_rows[idx])
                     while len(ids) < 4:
                         flag = False
-                        if prev_doc_id != "" and self.docid2idx.get(prev_doc_id, -1) != -1:
-                            prev_id = self.docid2idx[prev_doc_id]
-                            if effective_ids.get(prev_id, 0) > 0.66 and prev_id not in seen_ids:
+                        if prev_id != -1:
+                            if prev_id not in seen_ids and (mask is None or mask[prev_id]) and self._neighbour_score(effective_ids, query_vector, prev_id) > 0.66:
                                 flag = True
                                 # doc_metadata['chunk_num'] += 1
                                 seen_ids.add(prev_id)
                                 ids.insert(0, prev_id)
-                                prev_doc_id = self.chunk_metadata[prev_id]['prev_chunk_id']
+                                prev_id = int(self.metadata_columns.prev_rows[prev_id])
 
-                        if next_doc_id != "" and self.docid2idx.get(next_doc_id, -1) != -1:
-                            next_id = self.docid2idx[next_doc_id]
-                            if effective_ids.get(next_id, 0) > 0.66 and next_id not in seen_ids:
+                        if next_id != -1:
+                            if next_id not in seen_ids and (mask is None or mask[next_id]) and self._neighbour_score(effective_ids, query_vector, next_id) > 0.66:
                                 flag = True
                                 # doc_metadata['chunk_num'] += 1
                                 seen_ids.add(next_id)
                                 ids.append(next_id)
-                                next_doc_id = self.chunk_metadata[next_id]['next_chunk_id']
+                                next_id = int(self.metadata_columns.next_rows[next_id])
                         if not flag:
                             break
 
-                doc_ids = [self.chunk_metadata[idx]['doc_id'] for idx in ids]
-                    
-                docs_dict = self.chroma.get(ids=doc_ids, include=['documents', 'metadatas'])
+                documents, metadatas = self.chunk_store.get(ids, exclude=('title_summary',))
 
                 # candidate chunks bring the whole bundle
-                logger.info(f"Bundle {bundle_cnt}")
-                for idx in range(len(docs_dict['documents'])):
-                    logger.info(f"{len(chunk_list)} chunk score: {effective_ids.get(self.docid2idx[docs_dict['metadatas'][idx]['doc_id']], 0)}")
-                    logger.info(f"{len(chunk_list)} chunk doc_id: {docs_dict['metadatas'][idx].get('doc_id', '')}")
-                    logger.info(f"{len(chunk_list)} chunk content: {docs_dict['documents'][idx]}")
-
-                    metadata_copy = docs_dict['metadatas'][idx].copy()
-                    metadata_copy.pop('title_summary', None)                   
+                for document, metadata in zip(documents, metadatas):
                     chunk_list.append(
 
                         {   "retriever": "faiss",
-                            "page_content": docs_dict['documents'][idx],
-                            "metadata": metadata_copy,
+                            "page_content": document,
+                            "metadata": metadata,
                             "bundle_id": bundle_cnt
                         }
                     )
                     
                 bundle_cnt += 1
 
-        title_summary_ids, title_summary_scores = self.title_summary_faiss_retriever.invoke([input], 5)
+        title_summary_ids, title_summary_scores = title_result
         title_summary_ids, title_summary_scores = title_summary_ids[0], title_summary_scores[0]
-        logger.info(f"Top {self.k} Title Summary FAISS results:")
         for title_idx, score in zip(title_summary_ids, title_summary_scores):
-            title_summary = self.title_summaries[title_idx]
-            # find corresponding chunk idx from self.chunk_metadata
-            chunk_idxs = [idx for idx, metadata in enumerate(self.chunk_metadata) if metadata.get('title_summary', '') == title_summary]
-            logger.info("score: {score} title_summary: {title_summary}".format(score=score, title_summary=title_summary.replace('\n', ' ')))
+            if title_idx < 0:
+                continue
+            # find the chunk rows carrying this title summary
+            chunk_idxs = self.metadata_columns.title_rows(title_idx)
+            if mask is not None:
+                chunk_idxs = chunk_idxs[mask[chunk_idxs]]
+            chunk_idxs = chunk_idxs.tolist()
             for idx in chunk_idxs:
                 if idx in seen_ids:
                     continue
                 seen_ids.add(idx)
                 ids = [idx]
-                doc_metadata = self.chunk_metadata[idx]
                 # gather bundle if bundle_id is not null
-                if doc_metadata.get('bundle_id', None) != None:
-                    bundle_id = doc_metadata['bundle_id']
-                    # find corresponding bundle_id from self.chunk_metadata
-                    bundle_ids = [idx for idx, metadata in enumerate(self.chunk_metadata) if metadata.get('bundle_id', None) == bundle_id]
-                    ids = bundle_ids
-                    seen_ids.update(bundle_ids)
+                if self.metadata_columns.bundle_codes[idx] >= 0:
+                    ids = self._gather_bundle(idx, mask)
+                    seen_ids.update(ids)
 
                 # get content of ids
-                doc_ids = [self.chunk_metadata[idx]['doc_id'] for idx in ids]
-                docs_dict = self.chroma.get(ids=doc_ids, include=['documents', 'metadatas'])
-                doc_content = "\n".join(docs_dict['documents'])
-                title_summary = doc_metadata.get('title_summary', '').replace('\n', ' ')
+                documents, metadatas = self.chunk_store.get(ids, exclude=('title_summary',))
 
                 # candidate chunks bring the whole bundle
-                logger.info(f"Bundle {bundle_cnt}")
-                for idx in range(len(docs_dict['documents'])):
-                    logger.info(f"{len(chunk_list)} chunk doc_id: {docs_dict['metadatas'][idx].get('doc_id', '')}")
-                    logger.info(f"{len(chunk_list)} chunk content: {docs_dict['documents'][idx]}")
-                    metadata_copy = docs_dict['metadatas'][idx].copy()
-                    metadata_copy.pop('title_summary', None)
+                for document, metadata in zip(documents, metadatas):
                     chunk_list.append(
                         {
                             "retriever": "title_summary_faiss",
-                            "page_content": docs_dict['documents'][idx],
-                            "metadata": metadata_copy,
+                            "page_content": document,
+                            "metadata": metadata,
                             "bundle_id": bundle_cnt
                         }
                     )
 
                 bundle_cnt += 1
 
-        bm25_ids, bm25_scores = self.bm25_retriever.invoke(input, self.num_chunk)
-        top_k_ids, top_k_scores = bm25_ids[:self.k], bm25_scores[:self.k]
-        
-        logger.info(f"Top {self.k} BM25 results:")
+        top_k_ids, top_k_scores = bm25_result
         for idx, score in zip(top_k_ids, top_k_scores):
             if idx in seen_ids:
                 continue
             seen_ids.add(idx)
             ids = [idx]
-            doc_metadata = self.chunk_metadata[idx]
             # gather bundle if bundle_id is not null
-            if doc_metadata.get('bundle_id', None) != None:
-                bundle_id = doc_metadata['bundle_id']
-                # find corresponding bundle_id from self.chunk_metadata
-                bundle_ids = [idx for idx, metadata in enumerate(self.chunk_metadata) if metadata.get('bundle_id', None) == bundle_id]
-                ids = bundle_ids
-                seen_ids.update(bundle_ids)
+            if self.metadata_columns.bundle_codes[idx] >= 0:
+                ids = self._gather_bundle(idx, mask)
+                seen_ids.update(ids)
 
             # get content of ids
-            doc_ids = [self.chunk_metadata[idx]['doc_id'] for idx in ids]
-            docs_dict = self.chroma.get(ids=doc_ids, include=['documents', 'metadatas'])
+            documents, metadatas = self.chunk_store.get(ids, exclude=('title_summary',))
 
             # candidate chunks bring the whole bundle
-            logger.info(f"Bundle {bundle_cnt} score: {score}")
-            for idx in range(len(docs_dict['documents'])):
-                logger.info(f"{len(chunk_list)} chunk doc_id: {docs_dict['metadatas'][idx].get('doc_id', '')}")
-                logger.info(f"{len(chunk_list)} chunk content: {docs_dict['documents'][idx]}")
-                metadata_copy = docs_dict['metadatas'][idx].copy()
-                metadata_copy.pop('title_summary', None)  
+            for document, metadata in zip(documents, metadatas):
                 chunk_list.append(
                     {
                         "retriever": "BM25",
-                        "page_content": docs_dict['documents'][idx],
-                        "metadata": metadata_copy,
+                        "page_content": document,
+                        "metadata": metadata,
                         "bundle_id": bundle_cnt                       
                     }
                 )
 
             bundle_cnt += 1
-            
+
+        trace = current_trace()
+        if trace is not None:
+            trace.add(
+                "retrieve",
+                collection=self.collection_name,
+                index_version=self.index_version,
+                inputs=inputs,
+                faiss=(faiss_ids_list[:, :self.k], faiss_scores_list[:, :self.k]),
+                title_summary=(title_summary_ids, title_summary_scores),
+                bm25=(top_k_ids, top_k_scores),
+                chunks=self._trace_chunks(chunk_list, trace.include_content),
+            )
         return chunk_list
 
-    def compute_similarity(self, chunks: List[str], selected_indices: List[int], candidate_index: int) -> List[float]:
+    @staticmethod
+    def _run_in(contexts: Optional[List[contextvars.Context]], i: int, fn, *args):
+        return fn(*args) if contexts is None else contexts[i].run(fn, *args)
+
+    def _trace_cached(self, input: str, hyde_chunks: List[str], chunk_list: List[Dict]):
+        trace = current_trace()
+        if trace is not None:
+            trace.add("retrieve", collection=self.collection_name, index_version=self.index_version, inputs=[input] + hyde_chunks,
+                      cached=True, chunks=self._trace_chunks(chunk_list, trace.include_content))
+
+    @staticmethod
+    def _trace_chunks(chunk_list: List[Dict], include_content: bool) -> List[Dict]:
+        return [
+            {
+                "retriever": chunk["retriever"],
+                "bundle_id": chunk["bundle_id"],
+                "doc_id": chunk["metadata"].get("doc_id"),
+                **({"page_content": chunk["page_content"]} if include_content else {}),
+            }
+            for chunk in chunk_list
+        ]
+
+    def get_chunk_vectors(self, chunks: List[str], doc_ids: Optional[List[str]] = None) -> np.ndarray:
         """
-        计算 candidate_index 对应 chunk 和 selected_indices 对应 chunks 的相似度（GPU 加速）。
+        获取 chunks 的归一化嵌入向量：优先按 doc_id 读取 FAISS 索引中已存储的向量，只有找不到的 chunk 才重新嵌入。
         
         参数:
             chunks (List[str]): 文档块的字符串列表。
-            selected_indices (List[int]): 选定的索引列表。
-            candidate_index (int): 候选索引。
+            doc_ids (Optional[List[str]]): 与 chunks 一一对应的 doc_id，为 None 时全部重新嵌入。
             
         返回:
-            List[float]: candidate_index 对应 chunk 和 selected_indices 对应 chunks 的相似度列表。
+            np.ndarray: 形状为 (len(chunks), dimension) 的 float32 向量。
         """
-        # 将字符串转化为嵌入向量
-        embeddings = torch.stack([torch.tensor(self.embeddings.embed_query(chunk), device='cuda') for chunk in chunks])
-        
-        # 提取 candidate_index 对应的嵌入向量
-        candidate_embedding = embeddings[candidate_index].unsqueeze(0)  # 添加 batch 维度
+        rows = self.metadata_columns.rows_of(doc_ids).tolist() if doc_ids is not None else [-1] * len(chunks)
+        stored = [i for i, row in enumerate(rows) if row != -1]
+        missing = [i for i, row in enumerate(rows) if row == -1]
+
+        vectors = np.empty((len(chunks), self.faiss_retriever.dimension), dtype=np.float32)
+        if stored:
+            vectors[stored] = self.faiss_retriever.get_vectors([rows[i] for i in stored])
+        if missing:
+            vectors[missing] = self.faiss_retriever.embed_queries([chunks[i] for i in missing])
+        return vectors
+
+    def compute_query_similarity(self, query: str, chunks: List[str], doc_ids: Optional[List[str]] = None) -> np.ndarray:
+        """
+        计算 query 与每个 chunk 的余弦相似度（双塔向量），用作重排前的廉价预筛分数。
         
-        # 提取 selected_indices 对应的嵌入向量
-        selected_embeddings = embeddings[selected_indices]
+        参数:
+            query (str): 问题，经过 embedding 缓存，检索时已嵌入过的问题不会重新计算。
+            chunks (List[str]): 文档块的字符串列表。
+            doc_ids (Optional[List[str]]): 与 chunks 一一对应的 doc_id，用于复用已存储的向量。
+            
+        返回:
+            np.ndarray: 形状为 (len(chunks),) 的相似度。
+        """
+        query_vector = self.faiss_retriever.embed_queries([query])[0]
+        return self.get_chunk_vectors(chunks, doc_ids) @ query_vector
+
+    @staticmethod
+    def _to_similarity_tensor(vectors: np.ndarray, other: np.ndarray) -> torch.Tensor:
+        """vectors 与 other 的点积：有 GPU 时用 torch 在 GPU 上计算，否则用 numpy 在 CPU 上计算。"""
+        if torch.cuda.is_available():
+            return torch.matmul(torch.from_numpy(vectors).cuda(), torch.from_numpy(other).cuda().T)
+        return torch.from_numpy(vectors @ other.T)
 
-        # 归一化嵌入向量
-        candidate_embedding = torch.nn.functional.normalize(candidate_embedding, dim=-1)
-        selected_embeddings = torch.nn.functional.normalize(selected_embeddings, dim=-1)
+    def compute_similarity(self, chunks: List[str], selected_indices: List[int], candidate_index: int, doc_ids: Optional[List[str]] = None) -> torch.Tensor:
+        """
+        计算 candidate_index 对应 chunk 和 selected_indices 对应 chunks 的相似度。
+        
+        参数:
+            chunks (List[str]): 文档块的字符串列表。
+            selected_indices (List[int]): 选定的索引列表。
+            candidate_index (int): 候选索引。
+            doc_ids (Optional[List[str]]): 与 chunks 一一对应的 doc_id，用于复用已存储的向量。
+            
+        返回:
+            torch.Tensor: candidate_index 对应 chunk 和 selected_indices 对应 chunks 的相似度列表。
+        """
+        # 只取需要的 chunk 的向量（已归一化）
+        needed = list(selected_indices) + [candidate_index]
+        vectors = self.get_chunk_vectors(
+            [chunks[i] for i in needed],
+            [doc_ids[i] for i in needed] if doc_ids is not None else None
+        )
         
         # 计算余弦相似度 (使用点积)
-        similarity = torch.matmul(selected_embeddings, candidate_embedding.T).squeeze(-1)
+        similarity = self._to_similarity_tensor(vectors[:-1], vectors[-1:]).squeeze(-1)
         
         return similarity
     
-    def compute_similarity_mtx(self, chunks: List[str]) -> torch.Tensor:
+    def compute_similarity_mtx(self, chunks: List[str], doc_ids: Optional[List[str]] = None) -> torch.Tensor:
         """
-        计算 chunks 两两之间的相似度矩阵（GPU 加速）。
+        计算 chunks 两两之间的相似度矩阵。
         
         参数:
             chunks (List[str]): 文档块的字符串列表。
+            doc_ids (Optional[List[str]]): 与 chunks 一一对应的 doc_id，用于复用 FAISS 索引中已存储的向量。
             
         返回:
             torch.Tensor: chunks 两两之间的相似度矩阵。
         """
-        embeddings = torch.stack([torch.tensor(self.embeddings.embed_query(chunk), device='cuda') for chunk in chunks])
-        
-        embeddings = torch.nn.functional.normalize(embeddings, dim=-1)
+        embeddings = self.get_chunk_vectors(chunks, doc_ids)
         
-        similarity_mtx = torch.matmul(embeddings, embeddings.T)
+        similarity_mtx = self._to_similarity_tensor(embeddings, embeddings)
         
         return similarity_mtx
@@ -1,4 +1,7 @@
+import time
 import logging
+import tempfile
+import threading
 logger = logging.getLogger(__name__)
 
 import faiss
@@ -7,39 +10,399 @@ from langchain_huggingface import HuggingFaceEmbeddings
 
 from typing import List, Dict, Any, Optional
 
+from .embeddingCache import CachedEmbeddings
+
+INDEX_TYPES = ("flat", "hnsw", "ivfpq")
+# bytes per dimension of each vector storage type
+STORAGE_TYPES = {"float32": 4, "fp16": 2, "int8": 1}
+
+def gpu_available() -> bool:
+    return hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0
+
+def storage_type(index_config: Optional[Dict[str, Any]]) -> str:
+    """Vector storage of an index config, IVF-PQ always keeps its own PQ codes plus memory-mapped float32 vectors."""
+    index_config = index_config or {}
+    storage = index_config.get('storage', 'float32')
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Unknown faiss vector storage: {storage}, expected one of {tuple(STORAGE_TYPES)}")
+    if index_config.get('type', 'flat') == "ivfpq":
+        return "float32"
+    return storage
+
+def is_product_quantized(index) -> bool:
+    """True for CPU and GPU IVF-PQ indexes, whose search scores are approximate inner products."""
+    return isinstance(index, faiss.IndexIVFPQ) or type(index).__name__ == "GpuIndexIVFPQ"
+
+def _scalar_quantizer(storage: str):
+    return faiss.ScalarQuantizer.QT_fp16 if storage == "fp16" else faiss.ScalarQuantizer.QT_8bit
+
+def build_index(x: np.ndarray, index_config: Optional[Dict[str, Any]] = None):
+    """Build an inner product index over normalised vectors x.
+
+    Args:
+        x: float32 array of shape (n, dimension), already L2-normalised
+        index_config: the `faiss_index` section of the config, keys:
+            type: flat | hnsw | ivfpq, default flat
+            use_gpu: move the index to GPU 0, defaults to True when a GPU is visible (hnsw stays on CPU)
+            hnsw_m, ef_construction, ef_search: HNSW graph degree and build / search beam width
+            nlist, nprobe: IVF cells and cells visited per query
+            filter_brute_force_rows: filtered searches matching at most this many rows scan them exactly
+            pq_m, pq_nbits: PQ sub-quantizers and bits per code
+            storage: float32 | fp16 | int8, vectors of flat and HNSW indexes are scalar quantised when not float32
+            rescore, rescore_factor, rescore_dir: see FaissRetriever
+
+    Returns:
+        (index, gpu_resources) where gpu_resources is None for CPU indexes
+    """
+    index_config = index_config or {}
+    index_type = index_config.get('type', 'flat')
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown faiss index type: {index_type}, expected one of {INDEX_TYPES}")
+    storage = storage_type(index_config)
+    if storage != index_config.get('storage', 'float32'):
+        logger.warning(f"storage {index_config.get('storage')} does not apply to {index_type} indexes, they keep PQ codes")
+    num_vectors, dimension = x.shape
+
+    if index_type == "ivfpq":
+        nlist = index_config.get('nlist', 1024)
+        pq_nbits = index_config.get('pq_nbits', 8)
+        # IVF-PQ needs enough training points for both the coarse and the PQ codebooks
+        if num_vectors < max(nlist, 2 ** pq_nbits):
+            logger.warning(f"Only {num_vectors} vectors, too few to train IVF-PQ with nlist={nlist}, falling back to flat index")
+            index_type = "flat"
+
+    use_gpu = index_config.get('use_gpu', gpu_available())
+    if use_gpu:
+        if index_type == "hnsw":
+            logger.warning("HNSW index has no GPU implementation, keeping it on CPU")
+            use_gpu = False
+        elif not gpu_available():
+            logger.warning("use_gpu is set but no GPU is available, keeping FAISS index on CPU")
+            use_gpu = False
+        elif storage == "int8":
+            logger.warning("int8 flat index has no GPU implementation, keeping it on CPU")
+            use_gpu = False
+
+    if index_type == "flat":
+        # fp16 on GPU is a float32 flat index cloned with float16 storage
+        if storage == "float32" or use_gpu:
+            index = faiss.IndexFlatIP(dimension)
+        else:
+            index = faiss.IndexScalarQuantizer(dimension, _scalar_quantizer(storage), faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "hnsw":
+        if storage == "float32":
+            index = faiss.IndexHNSWFlat(dimension, index_config.get('hnsw_m', 32), faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexHNSWSQ(dimension, _scalar_quantizer(storage), index_config.get('hnsw_m', 32), faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = index_config.get('ef_construction', 200)
+        index.hnsw.efSearch = index_config.get('ef_search', 128)
+    else:
+        quantizer = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, index_config.get('pq_m', 64), pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = index_config.get('nprobe', 32)
+
+    # IVF-PQ learns its codebooks, int8 scalar quantisation learns per-dimension ranges
+    if not index.is_trained:
+        index.train(x)
+    index.add(x)
+
+    res = None
+    if use_gpu:
+        res = faiss.StandardGpuResources()
+        if storage == "fp16":
+            options = faiss.GpuClonerOptions()
+            options.useFloat16 = True
+            index = faiss.index_cpu_to_gpu(res, 0, index, options)
+        else:
+            index = faiss.index_cpu_to_gpu(res, 0, index)
+
+    logger.info(f"Built {index_type} FAISS index with {num_vectors} {storage} vectors of dimension {dimension} on {'GPU' if res is not None else 'CPU'}")
+    return index, res
+
+def update_index(previous_index, previous_rows: np.ndarray, x: np.ndarray, index_config: Optional[Dict[str, Any]] = None):
+    """Copy of a CPU index built by build_index, with the rows that changed since it was built removed and added.
+
+    Args:
+        previous_index: the index to update, it is left untouched for the searches it still serves
+        previous_rows: for every row of x, the row it had in previous_index, -1 for new rows
+        x: float32 array of all current vectors, already L2-normalised
+        index_config: the index_config previous_index was built with
+
+    Returns:
+        the updated index, or None when it has to be rebuilt with build_index: HNSW graphs cannot remove
+        vectors, and flat ids are storage positions, so surviving rows must keep their order with new rows last
+    """
+    index_config = index_config or {}
+    kept = previous_rows >= 0
+    survivors = previous_rows[kept]
+    removed = np.setdiff1d(np.arange(previous_index.ntotal, dtype=np.int64), survivors)
+    added = np.flatnonzero(~kept)
+
+    if isinstance(previous_index, faiss.IndexIVFPQ):
+        # IVF lists store their ids, so the trained codebooks are reused and only the ids are renumbered
+        index = faiss.clone_index(previous_index)
+        index.remove_ids(removed)
+        new_rows = np.full(previous_index.ntotal, -1, dtype=np.int64)
+        new_rows[survivors] = np.flatnonzero(kept)
+        invlists = index.invlists
+        for list_no in range(invlists.nlist):
+            size = invlists.list_size(list_no)
+            if size == 0:
+                continue
+            ids = new_rows[faiss.rev_swig_ptr(invlists.get_ids(list_no), size)]
+            codes = invlists.get_codes(list_no)
+            invlists.update_entries(list_no, 0, size, faiss.swig_ptr(ids), codes)
+            invlists.release_codes(list_no, codes)
+        index.add_with_ids(x[added], added.astype(np.int64))
+    elif isinstance(previous_index, (faiss.IndexFlat, faiss.IndexScalarQuantizer)):
+        # an ivfpq config that fell back to flat is rebuilt once there are enough vectors to train
+        if index_config.get('type', 'flat') == "ivfpq":
+            return None
+        if not (np.all(kept[:len(survivors)]) and np.all(np.diff(survivors) > 0)):
+            return None
+        index = faiss.clone_index(previous_index)
+        index.remove_ids(removed)
+        index.add(x[added])
+    else:
+        return None
+
+    logger.info(f"Updated {type(index).__name__} FAISS index in place: {len(removed)} vectors removed, {len(added)} added, {index.ntotal} in total")
+    return index
+
+def _flat_storage_view(index, num_vectors: int, dimension: int) -> Optional[np.ndarray]:
+    """Read-only numpy view of the float32 vectors inside a CPU flat / HNSW flat index, None for other indexes."""
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    if not isinstance(index, faiss.IndexFlat):
+        return None
+    view = faiss.rev_swig_ptr(index.get_xb(), num_vectors * dimension).reshape(num_vectors, dimension)
+    view.flags.writeable = False
+    return view
+
 class FaissRetriever:
-    """Faiss retriever compatible with LangChain that supports metadata filtering."""
-    
-    def __init__(self, embeddings, embedding_fn: HuggingFaceEmbeddings):
+    """Faiss retriever compatible with LangChain that supports metadata filtering.
+
+    With `storage: fp16 | int8` in index_config the vectors only live scalar-quantised in the index.
+    With `rescore: true` the normalised float32 vectors are also written to a memory-mapped file
+    (in `rescore_dir`, default the temp directory; RAGManager uses persist_directory/rescore_vectors) and the top k * `rescore_factor` candidates of
+    every search are re-scored exactly, so only the pages of those candidates become resident.
+    IVF-PQ indexes always re-score from the memory-mapped file, their PQ distances are too coarse for
+    the similarity thresholds EnsembleRetriever applies to search scores.
+    Given the retriever of an earlier version of the same rows as `previous`, its CPU flat or IVF-PQ index
+    is updated with update_index instead of being rebuilt; HNSW and GPU indexes are always rebuilt.
+    """
+
+    def __init__(self, embeddings, embedding_fn: HuggingFaceEmbeddings, embed_batch_size: int = 32, index_config: Optional[Dict[str, Any]] = None,
+                 previous: Optional["FaissRetriever"] = None, previous_rows: Optional[np.ndarray] = None):
         super().__init__()
         self.embeddings = embedding_fn
-        embeddings = np.array(embeddings)
-        dimension = embeddings.shape[1]
+        self.embed_batch_size = embed_batch_size
+        # convert straight to float32, never through a float64 copy of the lists chroma returns
+        x = np.array(embeddings, dtype=np.float32)
+        faiss.normalize_L2(x)
+        self.num_vectors, self.dimension = x.shape
 
-        res = faiss.StandardGpuResources()
-        index = faiss.IndexFlatIP(dimension)
-        self.index = faiss.index_cpu_to_gpu(res, 0, index)
+        self.index_config = index_config or {}
+        self.storage = storage_type(self.index_config)
+        index = None
+        if previous is not None and previous._gpu_res is None and previous.index_config == self.index_config and previous.dimension == self.dimension:
+            index = update_index(previous.index, previous_rows, x, self.index_config)
+        if index is not None:
+            self.index, self._gpu_res = index, None
+        else:
+            self.index, self._gpu_res = build_index(x, self.index_config)
+        # GPU indexes must not be searched from several threads at once
+        self._gpu_lock = threading.Lock()
 
-        x = embeddings.astype('float32')
-        faiss.normalize_L2(x)
+        self.rescore = is_product_quantized(self.index) or (self.storage != "float32" and self.index_config.get('rescore', False))
+        self._float_vectors = self._save_float_vectors(x) if self.rescore else None
 
-        self.index.add(x)
+        # float32 vectors are kept so single rows can be scored without a full index sweep, as a view
+        # into the index where it holds them as plain floats; quantised storage keeps no float copy in memory
+        self._shares_index_memory = False
+        if self.storage == "float32" and not is_product_quantized(self.index):
+            self.vectors = _flat_storage_view(self.index, self.num_vectors, self.dimension) if self._gpu_res is None else None
+            self._shares_index_memory = self.vectors is not None
+            if self.vectors is None:
+                self.vectors = x
+        else:
+            self.vectors = None
         
-        logger.info(f"Building FAISS index with {len(embeddings)} vectors of dimension {dimension}")
         logger.debug(f"embeddings shape: {x.shape}")
         # logger.debug(f"first 10 id2uuid: {list(self.id2uuid.items())[:10]}")
 
+    def _save_float_vectors(self, x: np.ndarray) -> np.ndarray:
+        """Write x to an unlinked temporary file and memory-map it read-only."""
+        with tempfile.NamedTemporaryFile(dir=self.index_config.get('rescore_dir', None), suffix=".npy") as f:
+            np.save(f, x)
+            f.flush()
+            # the mapping keeps the data reachable after the file is removed
+            return np.load(f.name, mmap_mode='r')
+
+    def close(self):
+        """Drop the memory-mapped float vectors of a retriever that is no longer served.
+
+        Their unlinked file is freed as soon as no search still reads them. A search that still arrives
+        afterwards is answered with the index's own (approximate) scores.
+        """
+        self.rescore = False
+        self._float_vectors = None
+
+    def get_vectors(self, ids) -> np.ndarray:
+        """Normalised float32 vectors of rows ids, exact unless the index is quantised and nothing is kept for re-scoring."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.vectors is not None:
+            return self.vectors[ids]
+        if self._float_vectors is not None:
+            return np.asarray(self._float_vectors[ids], dtype=np.float32)
+        if len(ids) == 0:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        if self._gpu_res is not None:
+            with self._gpu_lock:
+                return self.index.reconstruct_batch(ids)
+        return self.index.reconstruct_batch(ids)
+
+    def vector_bytes(self) -> int:
+        """Resident bytes of the stored vectors: index codes plus any in-memory float32 copy (HNSW graph links not included)."""
+        if is_product_quantized(self.index):
+            code_bytes = self.num_vectors * self.index_config.get('pq_m', 64) * self.index_config.get('pq_nbits', 8) // 8
+        else:
+            code_bytes = self.num_vectors * self.dimension * STORAGE_TYPES[self.storage]
+        if self.vectors is not None and not self._shares_index_memory:
+            code_bytes += self.vectors.nbytes
+        return code_bytes
+
+    def embed_queries(self, querys: List[str]) -> np.ndarray:
+        """Embed querys with batched calls of at most embed_batch_size texts, through the query cache if embeddings is a CachedEmbeddings.
+
+        Returns:
+            L2-normalised float32 array of shape (len(querys), dimension)
+        """
+        embed = self.embeddings.embed_queries if isinstance(self.embeddings, CachedEmbeddings) else self.embeddings.embed_documents
+        query_vec_list = []
+        for i in range(0, len(querys), self.embed_batch_size):
+            query_vec_list.extend(embed(querys[i:i + self.embed_batch_size]))
+        query_vector = np.array(query_vec_list).astype('float32')
+        faiss.normalize_L2(query_vector)
+        return query_vector
+
+    def search(self, query_vector: np.ndarray, k: int, mask: Optional[np.ndarray] = None):
+        """Search the index with already embedded (normalised) query vectors.
+
+        Args:
+            query_vector: normalised query vectors of shape (num_queries, dimension)
+            k: number of neighbours per query, missing neighbours are padded with id -1
+            mask: optional boolean mask over rows, only rows where it is True are returned
+        """
+        if not self.rescore:
+            return self._search(query_vector, k, mask)
+        candidate_ids, _ = self._search(query_vector, k * self.index_config.get('rescore_factor', 4), mask)
+        return self._rescore(query_vector, candidate_ids, k)
+
+    def _rescore(self, query_vector: np.ndarray, candidate_ids: np.ndarray, k: int):
+        """Exact float32 scores of the candidates of each query, top k of them in descending order."""
+        indices = np.full((len(query_vector), k), -1, dtype=np.int64)
+        distances = np.full((len(query_vector), k), -np.inf, dtype=np.float32)
+        for i, (query, ids) in enumerate(zip(query_vector, candidate_ids)):
+            ids = ids[ids >= 0]
+            scores = self.get_vectors(ids) @ query
+            order = np.argsort(-scores, kind='stable')[:k]
+            indices[i, :len(order)] = ids[order]
+            distances[i, :len(order)] = scores[order]
+        return indices, distances
+
+    def _search(self, query_vector: np.ndarray, k: int, mask: Optional[np.ndarray] = None):
+        if mask is None:
+            if self._gpu_res is not None:
+                with self._gpu_lock:
+                    distances, indices = self.index.search(query_vector, k)
+            else:
+                distances, indices = self.index.search(query_vector, k)
+            return indices, distances
+
+        rows = np.flatnonzero(mask)
+        # GPU indexes do not take ID selectors, and for selective filters scanning the subset is cheaper and exact;
+        # quantised CPU indexes always take the selector instead of decoding the subset
+        if self._gpu_res is not None or (self.vectors is not None and len(rows) <= self.index_config.get('filter_brute_force_rows', 50000)):
+            return self._search_rows(query_vector, k, rows)
+
+        bitmap = np.packbits(mask, bitorder='little')
+        selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+        if isinstance(self.index, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=self.index.hnsw.efSearch)
+        elif isinstance(self.index, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=self.index.nprobe)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        distances, indices = self.index.search(query_vector, k, params=params)
+        return indices, distances
+
+    def _search_rows(self, query_vector: np.ndarray, k: int, rows: np.ndarray, block_size: int = 16384):
+        """Exact search restricted to rows, padded like faiss when fewer than k rows are available."""
+        indices = np.full((len(query_vector), k), -1, dtype=np.int64)
+        distances = np.full((len(query_vector), k), -np.inf, dtype=np.float32)
+        top = min(k, len(rows))
+        if top == 0:
+            return indices, distances
+        # vectors are gathered block by block so decoding a quantised index never materialises all rows at once
+        scores = np.concatenate([
+            query_vector @ self.get_vectors(rows[i:i + block_size]).T for i in range(0, len(rows), block_size)
+        ], axis=1)
+        top_k = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+        top_k_scores = np.take_along_axis(scores, top_k, axis=1)
+        order = np.argsort(-top_k_scores, axis=1, kind='stable')
+        indices[:, :top] = rows[np.take_along_axis(top_k, order, axis=1)]
+        distances[:, :top] = np.take_along_axis(top_k_scores, order, axis=1)
+        return indices, distances
+
+    def score(self, query_vector: np.ndarray, ids: List[int]) -> np.ndarray:
+        """Inner product of one normalised query vector with the stored vectors of ids."""
+        return self.get_vectors(ids) @ query_vector
+
     def invoke(
             self,
             querys: list[str],
             k: int
         ):
-        query_vec_list = [self.embeddings.embed_query(q) for q in querys]
-        query_vector = np.array(query_vec_list).astype('float32')
-        faiss.normalize_L2(query_vector)
-        
-        distances, indices = self.index.search(query_vector, k)
-        return indices, distances
+        return self.search(self.embed_queries(querys), k)
+
+    def recall_report(self, query_vector: np.ndarray, k: int = 10, exact_vectors: Optional[np.ndarray] = None) -> Dict[str, float]:
+        """Compare the index against exact flat search.
+
+        Args:
+            query_vector: normalised query vectors of shape (num_queries, dimension)
+            k: cut-off used for recall@k
+            exact_vectors: normalised float32 vectors of all rows for the exact baseline,
+                default the vectors returned by get_vectors (decoded codes for quantised storage without rescore)
+
+        Returns:
+            recall@k of the index, the mean per-query latency of both searches in milliseconds and the resident vector memory
+        """
+        k = min(k, self.num_vectors)
+        if exact_vectors is None:
+            exact_vectors = self.get_vectors(np.arange(self.num_vectors))
+
+        start = time.perf_counter()
+        exact_scores = query_vector @ exact_vectors.T
+        exact_ids = np.argpartition(-exact_scores, k - 1, axis=1)[:, :k]
+        exact_ms = (time.perf_counter() - start) * 1000 / len(query_vector)
+
+        start = time.perf_counter()
+        approx_ids, _ = self.search(query_vector, k)
+        index_ms = (time.perf_counter() - start) * 1000 / len(query_vector)
+
+        hits = sum(len(set(exact) & set(approx)) for exact, approx in zip(exact_ids.tolist(), approx_ids.tolist()))
+        return {
+            "index_type": type(self.index).__name__,
+            "storage": self.storage,
+            "rescore": self.rescore,
+            "vector_mb": self.vector_bytes() / 2 ** 20,
+            "k": k,
+            "num_queries": len(query_vector),
+            "recall": hits / (k * len(query_vector)),
+            "index_ms_per_query": index_ms,
+            "flat_ms_per_query": exact_ms,
+        }
 
 
 
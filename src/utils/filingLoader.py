@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+from typing import List, Dict, Tuple, Any
+from langchain_community.document_loaders import JSONLoader
+
+def hash_content(content: str) -> str:
+    """Generate a SHA-256 hash of the content, used as doc_id."""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def parse_filing(json_file: str, filename: str, ignore_range: bool = False) -> List[Tuple[str, Dict[str, Any]]]:
+    """Read the chunks of one filing json file.
+
+    The first element of the file holds the page range and date_published of the filing,
+    the others are chunks. Chunks outside the page range are dropped unless ignore_range is set.
+
+    Returns:
+        (content, metadata) of every chunk in file order, prev_chunk_id / next_chunk_id are not set
+    """
+    loader = JSONLoader(file_path=json_file, jq_schema=".[]", text_content=False)
+    documents = loader.load()
+
+    page_range = json.loads(documents[0].page_content)
+    page_start = page_range['start']
+    page_end = page_range['end']
+    page_date_published = page_range['date_published']
+
+    chunks = []
+    for doc in documents[1:]:
+        content_dict_data = json.loads(doc.page_content)
+        content = content_dict_data.get("content", "")
+        page_number = content_dict_data.get("page_number")
+        bundle_id = content_dict_data.get("bundle_id", None)
+        title_summary = content_dict_data.get("title_summary", None)
+
+        if int(page_start) <= int(page_number) <= int(page_end) or ignore_range:
+            metadata = {
+                "filename": filename,
+                "page_number": page_number,
+                "date_published": page_date_published,
+                "doc_id": hash_content(content),
+            }
+            if bundle_id:
+                metadata["bundle_id"] = bundle_id
+            if title_summary:
+                metadata["title_summary"] = title_summary
+            chunks.append((content, metadata))
+    return chunks
+
+def add_deduplicated(content_dict: Dict[str, Tuple[str, Dict[str, Any]]], content: str, metadata: Dict[str, Any]) -> bool:
+    """Add a chunk to content_dict (doc_id -> (content, metadata)), the newer date_published wins on duplicates.
+
+    Returns:
+        True if the chunk was added or replaced an older duplicate
+    """
+    content_hash = metadata["doc_id"]
+    if content_hash in content_dict:
+        existing_content, existing_metadata = content_dict[content_hash]
+        if metadata["date_published"] > existing_metadata["date_published"]:
+            # Replace older content with newer one
+            content_dict[content_hash] = (content, metadata)
+            logger.debug(f"Replacing content file: {existing_metadata['filename']} page: {existing_metadata['page_number']} in {existing_metadata['date_published']} with new version file: {metadata['filename']} page: {metadata['page_number']} in {metadata['date_published']}. Hash: {content_hash}")
+            return True
+        return False
+    # First encounter of this content hash
+    content_dict[content_hash] = (content, metadata)
+    return True
+
+def link_chunks(metadata_list: List[Dict[str, Any]]):
+    """Set prev_chunk_id / next_chunk_id between neighbouring chunks of the same filename, in list order."""
+    for i in range(len(metadata_list)):
+        # check if the previous chunk has the same filename
+        if i > 0 and metadata_list[i]["filename"] == metadata_list[i - 1]["filename"]:
+            metadata_list[i]["prev_chunk_id"] = metadata_list[i - 1]["doc_id"]
+        else:
+            metadata_list[i]["prev_chunk_id"] = ""
+        # check if the next chunk has the same filename
+        if i < len(metadata_list) - 1 and metadata_list[i]["filename"] == metadata_list[i + 1]["filename"]:
+            metadata_list[i]["next_chunk_id"] = metadata_list[i + 1]["doc_id"]
+        else:
+            metadata_list[i]["next_chunk_id"] = ""
+
+def file_order_links(chunks: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, Dict[str, str]]:
+    """prev_chunk_id / next_chunk_id of every chunk of one filing in file order, before deduplication."""
+    links = {}
+    for i, (_, metadata) in enumerate(chunks):
+        links.setdefault(metadata["doc_id"], {
+            "prev_chunk_id": chunks[i - 1][1]["doc_id"] if i > 0 else "",
+            "next_chunk_id": chunks[i + 1][1]["doc_id"] if i < len(chunks) - 1 else "",
+        })
+    return links
+
+def _displaced_path(persist_directory: str, collection_name: str) -> str:
+    return os.path.join(persist_directory, "displaced_chunks", f"{collection_name}.json")
+
+def read_displaced_chunks(persist_directory: str, collection_name: str) -> Dict[str, List[Dict[str, Any]]]:
+    """Metadata of the older filings that also contain a chunk stored under a newer filing, by doc_id.
+
+    Incremental updates keep these so deleting the newer filing can give the chunk back to an older one.
+    """
+    try:
+        with open(_displaced_path(persist_directory, collection_name), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_displaced_chunks(persist_directory: str, collection_name: str, displaced: Dict[str, List[Dict[str, Any]]]):
+    path = _displaced_path(persist_directory, collection_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(displaced, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def drop_displaced_owner(displaced: Dict[str, List[Dict[str, Any]]], filename: str):
+    """Forget every chunk filename was displaced from, e.g. because the filing is replaced or deleted."""
+    for doc_id in list(displaced):
+        displaced[doc_id] = [metadata for metadata in displaced[doc_id] if metadata["filename"] != filename]
+        if not displaced[doc_id]:
+            del displaced[doc_id]
@@ -0,0 +1,89 @@
+import os
+import uuid
+import fcntl
+import logging
+logger = logging.getLogger(__name__)
+
+from contextlib import contextmanager
+from datetime import datetime
+
+UNVERSIONED = "unversioned"
+
+def _version_path(persist_directory: str, collection_name: str) -> str:
+    return os.path.join(persist_directory, "index_version", collection_name)
+
+def read_index_version(persist_directory: str, collection_name: str) -> str:
+    """Version stamp of the persisted indexes of a collection, UNVERSIONED if load_data never stamped it."""
+    try:
+        with open(_version_path(persist_directory, collection_name), 'r') as f:
+            return f.read().strip() or UNVERSIONED
+    except FileNotFoundError:
+        return UNVERSIONED
+
+def loaded_index_version(persisted: str) -> str:
+    """Version a retriever loaded from persisted indexes serves under, the result cache is keyed by it.
+
+    Unstamped indexes get a new in-process version on every load, so results cached before a reload are never served after it.
+    """
+    if persisted != UNVERSIONED:
+        return persisted
+    return f"{UNVERSIONED}-{uuid.uuid4().hex[:8]}"
+
+def persisted_index_version(loaded: str) -> str:
+    """Persisted version stamp a loaded_index_version came from."""
+    return UNVERSIONED if loaded.startswith(f"{UNVERSIONED}-") else loaded
+
+def read_rebuild_version(persist_directory: str, collection_name: str) -> str:
+    """Version stamp of the last full rebuild of a collection, UNVERSIONED if none was recorded.
+
+    Versions bumped by single filing updates keep it, so a served retriever whose rebuild version is
+    still current may update its trained FAISS index instead of rebuilding it.
+    """
+    try:
+        with open(f"{_version_path(persist_directory, collection_name)}.rebuilt", 'r') as f:
+            return f.read().strip() or UNVERSIONED
+    except FileNotFoundError:
+        return UNVERSIONED
+
+def _write_atomic(path: str, content: str):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def bump_index_version(persist_directory: str, collection_name: str, full_rebuild: bool = True) -> str:
+    """Give the persisted indexes of a collection a new version stamp, call after every rebuild or update.
+
+    Args:
+        full_rebuild: False for single filing updates, which leave the rebuild version unchanged
+    """
+    path = _version_path(persist_directory, collection_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    version = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    if full_rebuild:
+        _write_atomic(f"{path}.rebuilt", version)
+    _write_atomic(path, version)
+    logger.info(f"Index version of {collection_name} bumped to {version}")
+    return version
+
+@contextmanager
+def ingest_lock(persist_directory: str, collection_name: str, shared: bool = False):
+    """Inter-process lock of the persisted indexes of a collection.
+
+    Ingests (load_data.py, update_data.py) hold it exclusively from the first Chroma write until the index
+    version is bumped, reloads hold it shared while they load, so they wait for a running ingest to finish
+    instead of loading its half-written state.
+    """
+    path = os.path.join(persist_directory, "index_version", f"{collection_name}.lock")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(f, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info(f"Waiting for the {'ingest' if shared else 'reloads and ingests'} holding the index lock of {collection_name}")
+            fcntl.flock(f, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
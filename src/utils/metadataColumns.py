@@ -0,0 +1,196 @@
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from collections import OrderedDict
+from collections.abc import Mapping
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Tuple, Iterable
+
+FILTER_FIELDS = ("filename", "date_published", "page_number")
+
+def date_to_ordinal(date_str: Optional[str]) -> int:
+    """Day ordinal of a YYYY-MM-DD date, -1 if missing or malformed."""
+    try:
+        return datetime.strptime(date_str, "%Y-%m-%d").toordinal()
+    except (TypeError, ValueError):
+        return -1
+
+def _parse_range(value, parse) -> Tuple[Optional[int], Optional[int]]:
+    """Parse an inclusive (start, end) range, either bound may be None."""
+    if not isinstance(value, (list, tuple)) or len(value) != 2:
+        raise ValueError(f"Expected a (start, end) range, got {value!r}")
+    start, end = value
+    return (None if start is None else parse(start)), (None if end is None else parse(end))
+
+def _parse_date(date_str: str) -> int:
+    ordinal = date_to_ordinal(date_str)
+    if ordinal == -1:
+        raise ValueError(f"Expected a YYYY-MM-DD date, got {date_str!r}")
+    return ordinal
+
+def _group_rows(codes: np.ndarray, num_codes: int) -> Tuple[np.ndarray, np.ndarray]:
+    """CSR grouping of rows by code: rows of code c are rows[offsets[c]:offsets[c + 1]], ascending. Negative codes are left out."""
+    order = np.argsort(codes, kind='stable')
+    rows = order[codes[order] >= 0].astype(np.int32)
+    counts = np.bincount(codes[codes >= 0], minlength=num_codes)
+    offsets = np.zeros(num_codes + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return rows, offsets
+
+class MetadataColumns:
+    """Compact numpy columns of the chunk metadata used by retrieval, instead of one dict per chunk.
+
+    Row i describes the i-th chunk of the collection (the FAISS / BM25 row id).
+    Strings are dictionary-encoded (filename, bundle_id, title_summary), dates are day ordinals,
+    neighbour links are int32 rows (-1 for none) and doc_ids are a sorted byte-string array.
+    The full metadata dicts stay in the chunk store.
+
+    Supported filters, all optional and combined with AND:
+        filename: a filename or a collection of filenames
+        date_published: inclusive (start, end) range of YYYY-MM-DD strings, either bound may be None
+        page_number: inclusive (start, end) range of page numbers, either bound may be None
+    """
+
+    def __init__(self, metadatas: List[Dict[str, Any]], mask_cache_size: int = 64):
+        filenames = [metadata.get('filename', '') for metadata in metadatas]
+        self.filename_vocab = {filename: code for code, filename in enumerate(dict.fromkeys(filenames))}
+        self.filename_codes = np.array([self.filename_vocab[filename] for filename in filenames], dtype=np.int32)
+
+        # parse each distinct date once, a collection only has a handful of publication dates
+        dates = [metadata.get('date_published', None) for metadata in metadatas]
+        date_ordinals = {date: date_to_ordinal(date) for date in set(dates)}
+        self.date_ordinals = np.array([date_ordinals[date] for date in dates], dtype=np.int32)
+
+        page_numbers = []
+        for metadata in metadatas:
+            try:
+                page_numbers.append(int(metadata.get('page_number', -1)))
+            except (TypeError, ValueError):
+                page_numbers.append(-1)
+        self.page_numbers = np.array(page_numbers, dtype=np.int32)
+
+        self.num_rows = len(metadatas)
+
+        # doc_id -> row by binary search over the sorted ids, far smaller than a dict of 64-char hex strings
+        doc_ids = np.array([metadata.get('doc_id', '').encode('utf-8') for metadata in metadatas], dtype=bytes)
+        self._doc_id_order = np.argsort(doc_ids, kind='stable').astype(np.int32)
+        self._sorted_doc_ids = doc_ids[self._doc_id_order]
+        del doc_ids
+        self.prev_rows = self.rows_of(metadata.get('prev_chunk_id', '') for metadata in metadatas).astype(np.int32)
+        self.next_rows = self.rows_of(metadata.get('next_chunk_id', '') for metadata in metadatas).astype(np.int32)
+
+        bundle_ids = [metadata.get('bundle_id', None) for metadata in metadatas]
+        bundle_vocab = {bundle_id: code for code, bundle_id in enumerate(dict.fromkeys(bundle_id for bundle_id in bundle_ids if bundle_id is not None))}
+        self.bundle_codes = np.array([-1 if bundle_id is None else bundle_vocab[bundle_id] for bundle_id in bundle_ids], dtype=np.int32)
+        self._bundle_rows, self._bundle_offsets = _group_rows(self.bundle_codes, len(bundle_vocab))
+        del bundle_ids, bundle_vocab
+
+        # unique title summaries in order of first appearance, the rows of the title summary index
+        titles = [metadata.get('title_summary', '') for metadata in metadatas]
+        title_vocab = {title: code for code, title in enumerate(dict.fromkeys(title for title in titles if title != ''))}
+        self.title_summaries = list(title_vocab)
+        self.title_codes = np.array([-1 if title == '' else title_vocab[title] for title in titles], dtype=np.int32)
+        self._title_rows, self._title_offsets = _group_rows(self.title_codes, len(title_vocab))
+        del titles, title_vocab
+
+        self._mask_cache = OrderedDict()
+        self._mask_cache_size = mask_cache_size
+        self._lock = threading.Lock()
+
+    def rows_of(self, doc_ids: Iterable[Optional[str]]) -> np.ndarray:
+        """Rows of doc_ids as an int64 array, -1 for empty or unknown ids."""
+        keys = np.array([(doc_id or '').encode('utf-8') for doc_id in doc_ids], dtype=bytes)
+        if self.num_rows == 0 or len(keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._sorted_doc_ids, keys), self.num_rows - 1)
+        found = (self._sorted_doc_ids[positions] == keys) & (keys != b'')
+        return np.where(found, self._doc_id_order[positions], -1).astype(np.int64)
+
+    def row_of(self, doc_id: Optional[str]) -> int:
+        """Row of doc_id, -1 if it is not in the collection."""
+        return int(self.rows_of([doc_id])[0])
+
+    def bundle_rows(self, row: int) -> np.ndarray:
+        """Ascending rows of the bundle that row belongs to, [row] if it has no bundle_id."""
+        code = self.bundle_codes[row]
+        if code < 0:
+            return np.array([row], dtype=np.int32)
+        return self._bundle_rows[self._bundle_offsets[code]:self._bundle_offsets[code + 1]]
+
+    def title_rows(self, code: int) -> np.ndarray:
+        """Ascending rows of the chunks carrying title summary self.title_summaries[code]."""
+        return self._title_rows[self._title_offsets[code]:self._title_offsets[code + 1]]
+
+    def _normalise(self, filters: Dict[str, Any]) -> Tuple:
+        unknown = set(filters) - set(FILTER_FIELDS)
+        if unknown:
+            raise ValueError(f"Unsupported metadata filters: {sorted(unknown)}, expected any of {FILTER_FIELDS}")
+
+        filenames = filters.get('filename', None)
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        filenames = None if filenames is None else frozenset(filenames)
+        date_range = None if filters.get('date_published') is None else _parse_range(filters['date_published'], _parse_date)
+        page_range = None if filters.get('page_number') is None else _parse_range(filters['page_number'], int)
+        return filenames, date_range, page_range
+
+    def filter_key(self, filters: Optional[Dict[str, Any]]) -> Optional[Tuple]:
+        """Hashable normalised form of filters, equal for filters that select the same rows by construction."""
+        if not filters:
+            return None
+        return self._normalise(filters)
+
+    def mask(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Boolean mask over all rows of the chunks matching filters, None if there is nothing to filter on."""
+        if not filters:
+            return None
+        key = self._normalise(filters)
+        with self._lock:
+            if key in self._mask_cache:
+                self._mask_cache.move_to_end(key)
+                return self._mask_cache[key]
+
+        filenames, date_range, page_range = key
+        mask = np.ones(self.num_rows, dtype=bool)
+        if filenames is not None:
+            codes = [self.filename_vocab[filename] for filename in filenames if filename in self.filename_vocab]
+            mask &= np.isin(self.filename_codes, np.array(codes, dtype=np.int32))
+        for column, value_range in ((self.date_ordinals, date_range), (self.page_numbers, page_range)):
+            if value_range is None:
+                continue
+            start, end = value_range
+            # rows without a usable value never match a range filter
+            mask &= column >= 0
+            if start is not None:
+                mask &= column >= start
+            if end is not None:
+                mask &= column <= end
+        mask.flags.writeable = False
+
+        with self._lock:
+            self._mask_cache[key] = mask
+            if len(self._mask_cache) > self._mask_cache_size:
+                self._mask_cache.popitem(last=False)
+        logger.debug(f"Metadata filter {filters} matches {int(mask.sum())} of {self.num_rows} chunks")
+        return mask
+
+class DocIdIndex(Mapping):
+    """Read-only doc_id -> row mapping backed by MetadataColumns, for callers written against a dict."""
+
+    def __init__(self, metadata_columns: MetadataColumns):
+        self.metadata_columns = metadata_columns
+
+    def __getitem__(self, doc_id: str) -> int:
+        row = self.metadata_columns.row_of(doc_id)
+        if row == -1:
+            raise KeyError(doc_id)
+        return row
+
+    def __iter__(self):
+        for doc_id in self.metadata_columns._sorted_doc_ids[np.argsort(self.metadata_columns._doc_id_order)]:
+            yield doc_id.decode('utf-8')
+
+    def __len__(self) -> int:
+        return self.metadata_columns.num_rows
@@ -1,17 +1,35 @@
 import os
+import time
 import yaml
+import threading
+import contextvars
 import logging
+import numpy as np
 logger = logging.getLogger(__name__)
 
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Set, Union, Any
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
 
-from .ensembleRetriever import EnsembleRetriever
+from .ensembleRetriever import EnsembleRetriever, chunk_list_nbytes
+from .embeddingCache import CachedEmbeddings
+from .lruCache import LRUCache
+from .indexVersion import read_index_version, read_rebuild_version, bump_index_version, loaded_index_version, persisted_index_version, ingest_lock
+from .bm25Retriever import load_from_chroma_and_save
+from .titleSummaryIndex import save_title_summary_embeddings
+from .chunkStore import save_chunk_store
+from .filingLoader import (
+    parse_filing, add_deduplicated, link_chunks, file_order_links,
+    read_displaced_chunks, save_displaced_chunks, drop_displaced_owner,
+)
 import GPUtil
 
+# swapped out retrievers keep serving the requests that started on them for this long before they are released
+RETIRED_RETRIEVER_GRACE_SECONDS = 60
+
 class RAGManager:
     """Singleton class for managing RAG collections"""
     _collections: Dict[str, Chroma] = {}
@@ -47,9 +65,32 @@ class RAGManager:
             # print("Full model config:", st_model._modules['0'].auto_model.config)
             # print("Model files:", st_model._modules['0'].auto_model._parameters)
             logger.info("Embedding model loaded successfully.")
+            # one cache in front of the model, shared by every retriever and session
+            cache_size = config.get('embedding_cache_size', 10000)
+            if cache_size > 0:
+                self.embeddings = CachedEmbeddings(
+                    self.embeddings,
+                    self.embeddings_model_name,
+                    max_size=cache_size,
+                    ttl=config.get('embedding_cache_ttl', None),
+                )
         except Exception as e:
             logger.error(f"Failed to load embedding model: {e}")
 
+        # retrieval results of all collections, keyed by collection and index version
+        retrieval_cache_mb = config.get('retrieval_cache_mb', 256)
+        self.retrieval_cache = None
+        if retrieval_cache_mb > 0:
+            self.retrieval_cache = LRUCache(max_size=None, max_bytes=int(retrieval_cache_mb * 2 ** 20), sizeof=chunk_list_nbytes)
+
+        # serialises snapshot builds, readers never take it
+        self._reload_lock = threading.Lock()
+        self.reload_status = {"state": "idle", "started_at": None, "finished_at": None, "error": None}
+
+        self._collection_executor = ThreadPoolExecutor(
+            max_workers=config.get('collection_workers', 8), thread_name_prefix="collection_retrieval"
+        )
+
         if collections is not None:
             for collection, top_k in collections.items():
                 if top_k <= 0:
@@ -86,14 +127,482 @@ class RAGManager:
         ]
         return documents
 
-    def create_retriever(self, k: int, collection_name: str, retriever_type: str = "chroma"):
-        """Create a specific retriever for a collection"""
+    def save_collection_indexes(self, collection_name: str, full_rebuild: bool = True) -> str:
+        """Rebuild the persisted BM25 index, title summary vectors and chunk store of a collection from Chroma.
+
+        Chunks are not re-embedded, only title summaries that are not stored yet. Callers hold the exclusive
+        ingest_lock of the collection across their Chroma writes and this rebuild, see refresh_collection.
+        Single filing updates pass full_rebuild=False, so reloads update the served FAISS index instead of rebuilding it.
+
+        Returns:
+            the new index version of the collection
+        """
+        documents = self.get_collection_documents(collection_name)
+        persist_directory = self._config['persist_directory']
+        load_from_chroma_and_save(documents, os.path.join(persist_directory, "bm25_index", collection_name))
+        save_title_summary_embeddings(
+            documents, self.embeddings, os.path.join(persist_directory, "title_summary_index", collection_name), self.embeddings_model_name
+        )
+        save_chunk_store(
+            [doc.page_content for doc in documents], [doc.metadata for doc in documents], os.path.join(persist_directory, "chunk_store", collection_name)
+        )
+        return bump_index_version(persist_directory, collection_name, full_rebuild)
+
+    def upsert_filing(self, collection_name: str, json_file: str, ignore_range: bool = False) -> Dict[str, Any]:
+        """Add a filing to a collection, or replace the chunks of a filing with the same filename.
+
+        Duplicated content follows the load_data rule: the chunk with the newer date_published wins.
+        Chunks taken over from another filing are unlinked from its prev/next chain, the chunks of this
+        filing are linked in file order. The losing filing of every duplicate is remembered, so a chunk
+        this filing no longer contains goes back to it instead of leaving the collection. Only chunks
+        without a stored embedding are embedded, then the derived indexes are refreshed and served
+        retrievers of the collection reloaded.
+        """
+        self.create_collection(collection_name)
+        chroma = self._collections[collection_name]
+        filename = os.path.basename(json_file)
+        persist_directory = self._config['persist_directory']
+        with ingest_lock(persist_directory, collection_name):
+            displaced = read_displaced_chunks(persist_directory, collection_name)
+            # the old version of this filing loses its claims, the new one makes its own below
+            drop_displaced_owner(displaced, filename)
+
+            chunks = parse_filing(json_file, filename, ignore_range)
+            file_links = file_order_links(chunks)
+            content_dict = {}
+            for content, metadata in chunks:
+                add_deduplicated(content_dict, content, metadata)
+
+            old = chroma.get(where={"filename": filename}, include=["metadatas", "embeddings", "documents"])
+            existing = chroma.get(ids=list(content_dict), include=["metadatas", "embeddings"]) if content_dict else {"ids": [], "metadatas": [], "embeddings": []}
+            stored_embeddings = dict(zip(old['ids'], old['embeddings']))
+            stored_embeddings.update(zip(existing['ids'], existing['embeddings']))
+
+            # every chunk of the old version of the filing leaves its chain, so do chunks taken over from other filings
+            removed = {metadata['doc_id']: metadata for metadata in old['metadatas']}
+            skipped = 0
+            for metadata in existing['metadatas']:
+                if metadata['filename'] == filename:
+                    continue
+                if content_dict[metadata['doc_id']][1]['date_published'] > metadata['date_published']:
+                    # this filing is newer, it takes the chunk over
+                    removed[metadata['doc_id']] = metadata
+                    displaced.setdefault(metadata['doc_id'], []).append(metadata)
+                else:
+                    displaced.setdefault(metadata['doc_id'], []).append({**content_dict[metadata['doc_id']][1], **file_links[metadata['doc_id']]})
+                    del content_dict[metadata['doc_id']]
+                    skipped += 1
+
+            metadata_list = [metadata for _, metadata in content_dict.values()]
+            link_chunks(metadata_list)
+            deleted = [doc_id for doc_id in removed if doc_id not in content_dict]
+            # chunks the old version held over an older filing go back to it
+            restored = self._take_displaced(displaced, deleted, old)
+            deleted = [doc_id for doc_id in deleted if doc_id not in restored]
+
+            missing = [doc_id for doc_id in content_dict if doc_id not in stored_embeddings]
+            batch_size = self._config.get('embed_batch_size', 32)
+            for i in range(0, len(missing), batch_size):
+                batch = missing[i:i + batch_size]
+                stored_embeddings.update(zip(batch, self.embeddings.embed_documents([content_dict[doc_id][0] for doc_id in batch])))
+
+            if deleted:
+                chroma.delete(ids=deleted)
+            if content_dict:
+                doc_ids = list(content_dict)
+                chroma._collection.upsert(
+                    ids=doc_ids,
+                    embeddings=[stored_embeddings[doc_id] for doc_id in doc_ids],
+                    metadatas=metadata_list,
+                    documents=[content_dict[doc_id][0] for doc_id in doc_ids],
+                )
+            self._relink_neighbours(chroma, removed, set(content_dict) | set(restored))
+            self._restore_displaced(chroma, restored)
+            save_displaced_chunks(persist_directory, collection_name, displaced)
+
+            logger.info(f"Filing {filename} upserted into {collection_name}: {len(content_dict)} chunks written ({len(missing)} embedded), {len(deleted)} deleted, {len(restored)} restored to older filings, {skipped} kept from newer filings")
+            # writes and derived indexes are in place before the reload takes the lock shared
+            version = self.save_collection_indexes(collection_name, full_rebuild=False)
+        self._reload([collection_name], force=True)
+        return {"written": len(content_dict), "embedded": len(missing), "deleted": len(deleted), "restored": len(restored), "skipped": skipped, "version": version}
+
+    def delete_filing(self, collection_name: str, filename: str) -> Dict[str, Any]:
+        """Remove every chunk of a filing from a collection and close the gaps in the prev/next chains it leaves.
+
+        Chunks the filing had taken over from older filings go back to the newest of them, as a fresh load_data would.
+        """
+        chroma = self._collections[collection_name]
+        persist_directory = self._config['persist_directory']
+        with ingest_lock(persist_directory, collection_name):
+            displaced = read_displaced_chunks(persist_directory, collection_name)
+            drop_displaced_owner(displaced, filename)
+
+            old = chroma.get(where={"filename": filename}, include=["metadatas", "embeddings", "documents"])
+            removed = {metadata['doc_id']: metadata for metadata in old['metadatas']}
+            restored = self._take_displaced(displaced, list(removed), old)
+            deleted = [doc_id for doc_id in removed if doc_id not in restored]
+            if deleted:
+                chroma.delete(ids=deleted)
+            if removed:
+                self._relink_neighbours(chroma, removed, set(restored))
+            self._restore_displaced(chroma, restored)
+            save_displaced_chunks(persist_directory, collection_name, displaced)
+
+            logger.info(f"Filing {filename} deleted from {collection_name}: {len(deleted)} chunks deleted, {len(restored)} restored to older filings")
+            # writes and derived indexes are in place before the reload takes the lock shared
+            version = self.save_collection_indexes(collection_name, full_rebuild=False)
+        self._reload([collection_name], force=True)
+        return {"deleted": len(deleted), "restored": len(restored), "version": version}
+
+    @staticmethod
+    def _take_displaced(displaced: Dict[str, List[Dict[str, Any]]], doc_ids: List[str], stored: Dict[str, List]) -> Dict[str, tuple]:
+        """Pop the newest older owner of each chunk in doc_ids that has one.
+
+        Returns:
+            doc_id -> (content, metadata of the older owner, embedding), content and embedding taken from stored (a chroma.get result)
+        """
+        rows = {doc_id: (content, embedding) for doc_id, content, embedding in zip(stored['ids'], stored['documents'], stored['embeddings'])}
+        restored = {}
+        for doc_id in doc_ids:
+            if doc_id not in displaced or doc_id not in rows:
+                continue
+            owners = displaced[doc_id]
+            metadata = max(owners, key=lambda owner: owner['date_published'])
+            owners.remove(metadata)
+            if not owners:
+                del displaced[doc_id]
+            restored[doc_id] = (rows[doc_id][0], dict(metadata), rows[doc_id][1])
+        return restored
+
+    @staticmethod
+    def _restore_displaced(chroma: Chroma, restored: Dict[str, tuple]):
+        """Write chunks back under their older filing and splice them into its prev/next chain.
+
+        A chunk goes back after its former previous chunk, or before its former next chunk, if that still belongs
+        to the same filing; otherwise it is restored unlinked.
+        """
+        if not restored:
+            return
+        neighbour_ids = list({
+            metadata.get(key, "") for _, metadata, _ in restored.values() for key in ('prev_chunk_id', 'next_chunk_id')
+        } - {""})
+        current = chroma.get(ids=neighbour_ids, include=["metadatas"]) if neighbour_ids else {"ids": [], "metadatas": []}
+        # working copies of every chain member touched, restored chunks replace their stored metadata once spliced in
+        metadatas = dict(zip(current['ids'], current['metadatas']))
+
+        def load(doc_id: str) -> Optional[Dict[str, Any]]:
+            if doc_id not in metadatas:
+                found = chroma.get(ids=[doc_id], include=["metadatas"])
+                metadatas[doc_id] = found['metadatas'][0] if found['ids'] else None
+            return metadatas[doc_id]
+
+        def chain_member(doc_id: str, filename: str) -> Optional[Dict[str, Any]]:
+            metadata = load(doc_id) if doc_id != "" else None
+            return metadata if metadata is not None and metadata['filename'] == filename else None
+
+        changed = set()
+        pending = dict(restored)
+        while pending:
+            # a chunk waits for its former previous chunk if that is restored too
+            ready = [doc_id for doc_id, (_, metadata, _) in pending.items() if metadata.get('prev_chunk_id', "") not in pending]
+            for doc_id in ready or [next(iter(pending))]:
+                _, metadata, _ = pending.pop(doc_id)
+                filename = metadata['filename']
+                prev_chunk = chain_member(metadata.get('prev_chunk_id', ""), filename)
+                next_chunk = chain_member(metadata.get('next_chunk_id', ""), filename)
+                if prev_chunk is not None:
+                    prev_id, next_id = prev_chunk['doc_id'], prev_chunk.get('next_chunk_id', "")
+                elif next_chunk is not None:
+                    prev_id, next_id = next_chunk.get('prev_chunk_id', ""), next_chunk['doc_id']
+                else:
+                    prev_id = next_id = ""
+                metadata.update(prev_chunk_id=prev_id, next_chunk_id=next_id)
+                metadatas[doc_id] = metadata
+                if prev_id != "":
+                    load(prev_id)['next_chunk_id'] = doc_id
+                    changed.add(prev_id)
+                if next_id != "":
+                    load(next_id)['prev_chunk_id'] = doc_id
+                    changed.add(next_id)
+
+        doc_ids = list(restored)
+        chroma._collection.upsert(
+            ids=doc_ids,
+            embeddings=[restored[doc_id][2] for doc_id in doc_ids],
+            metadatas=[metadatas[doc_id] for doc_id in doc_ids],
+            documents=[restored[doc_id][0] for doc_id in doc_ids],
+        )
+        updated = [doc_id for doc_id in changed if doc_id not in restored]
+        if updated:
+            chroma._collection.update(ids=updated, metadatas=[metadatas[doc_id] for doc_id in updated])
+
+    @staticmethod
+    def _relink_neighbours(chroma: Chroma, removed: Dict[str, Dict[str, Any]], rewritten: Set[str]):
+        """Link the surviving neighbours of removed chunks to each other, skipping over runs of removed chunks."""
+        def surviving(doc_id: str, key: str) -> str:
+            while doc_id in removed:
+                doc_id = removed[doc_id][key]
+            return doc_id
+
+        links = {}
+        for metadata in removed.values():
+            prev_id = surviving(metadata.get('prev_chunk_id', ""), 'prev_chunk_id')
+            next_id = surviving(metadata.get('next_chunk_id', ""), 'next_chunk_id')
+            if prev_id != "":
+                links.setdefault(prev_id, {})['next_chunk_id'] = next_id
+            if next_id != "":
+                links.setdefault(next_id, {})['prev_chunk_id'] = prev_id
+
+        # chunks written in this update already carry their new links
+        doc_ids = [doc_id for doc_id in links if doc_id not in rewritten]
+        if not doc_ids:
+            return
+        neighbours = chroma.get(ids=doc_ids, include=["metadatas"])
+        if not neighbours['ids']:
+            return
+        chroma._collection.update(
+            ids=neighbours['ids'],
+            metadatas=[{**metadata, **links[doc_id]} for doc_id, metadata in zip(neighbours['ids'], neighbours['metadatas'])],
+        )
+
+    def refresh_collection(self, collection_name: str) -> str:
+        """Rebuild the derived indexes of a collection after Chroma changed and swap in retrievers serving the new version.
+
+        Returns:
+            the new index version of the collection
+        """
+        with ingest_lock(self._config['persist_directory'], collection_name):
+            version = self.save_collection_indexes(collection_name)
+        self._reload([collection_name], force=True)
+        return version
+
+    def active_versions(self) -> Dict[str, str]:
+        """Index version served for each collection."""
+        return {retriever.collection_name: retriever.index_version for retriever in self._retrievers}
+
+    def index_status(self) -> Dict[str, Any]:
+        """Served and persisted index versions of every collection, and the state of the last reload."""
+        return {
+            "active": self.active_versions(),
+            "persisted": {
+                retriever.collection_name: read_index_version(self._config['persist_directory'], retriever.collection_name)
+                for retriever in self._retrievers
+            },
+            "reload": dict(self.reload_status),
+        }
+
+    def reload(self, collections: Optional[List[str]] = None, force: bool = False, background: bool = True) -> Optional[threading.Thread]:
+        """Load the persisted indexes into new retrievers and swap them in atomically.
+
+        Only collections whose persisted index version differs from the served one are rebuilt, unless force is set.
+        Requests keep using the snapshot they started with, so nothing is interrupted while the new one is built.
+
+        Args:
+            collections: collections to reload, None for all served collections
+            force: rebuild even if the persisted version did not change
+            background: build on a background thread and return it, otherwise block until the swap is done
+        """
+        if not background:
+            self._reload(collections, force)
+            return None
+        thread = threading.Thread(target=self._reload, args=(collections, force), name="index_reload", daemon=True)
+        thread.start()
+        return thread
+
+    def _reload(self, collections: Optional[List[str]], force: bool):
+        with self._reload_lock:
+            self.reload_status = {"state": "loading", "started_at": datetime.now().isoformat(), "finished_at": None, "error": None}
+            try:
+                retrievers = []
+                for retriever in self._retrievers:
+                    name = retriever.collection_name
+                    persisted = read_index_version(self._config['persist_directory'], name)
+                    if (collections is not None and name not in collections) or (not force and persisted == persisted_index_version(retriever.index_version)):
+                        retrievers.append(retriever)
+                        continue
+                    logger.info(f"Loading {name} index version {persisted}, serving {retriever.index_version}")
+                    retrievers.append(self._build_consistent_retriever(retriever.k, name, previous=retriever))
+
+                # rebind instead of mutating, in-flight requests keep iterating over the old list
+                retired = [retriever for retriever in self._retrievers if all(retriever is not new for new in retrievers)]
+                RAGManager._retrievers = retrievers
+                self._retire(retired)
+                self._discard_stale_results()
+                self.reload_status.update(state="idle", finished_at=datetime.now().isoformat())
+                logger.info(f"Index snapshot swapped in: {self.active_versions()}")
+            except Exception as e:
+                logger.error(f"Index reload failed, still serving {self.active_versions()}: {e}")
+                self.reload_status.update(state="failed", finished_at=datetime.now().isoformat(), error=str(e))
+                raise
+
+    def _build_consistent_retriever(self, k: int, collection_name: str, max_attempts: int = 3, previous: Optional[EnsembleRetriever] = None) -> EnsembleRetriever:
+        """Build a retriever while no ingest is writing the collection, again if its index version changed while it was loading."""
+        for _ in range(max_attempts):
+            # waits for a running ingest, which holds the lock from its first Chroma write to the version bump
+            with ingest_lock(self._config['persist_directory'], collection_name, shared=True):
+                retriever = self.create_retriever(k, collection_name, retriever_type="ensemble", previous=previous)
+            if read_index_version(self._config['persist_directory'], collection_name) == persisted_index_version(retriever.index_version):
+                return retriever
+            logger.warning(f"Index of {collection_name} changed while loading, loading it again")
+        raise RuntimeError(f"Index of {collection_name} kept changing during {max_attempts} load attempts")
+
+    def _retire(self, retrievers: List[EnsembleRetriever]):
+        """Release the memory-mapped vectors of swapped out retrievers once the requests that started on them are done."""
+        if not retrievers:
+            return
+        def close():
+            for retriever in retrievers:
+                retriever.close()
+            logger.info(f"Released {len(retrievers)} swapped out retrievers")
+        timer = threading.Timer(RETIRED_RETRIEVER_GRACE_SECONDS, close)
+        timer.daemon = True
+        timer.start()
+
+    def _discard_stale_results(self):
+        """Drop cached retrieval results of index versions that are no longer served."""
+        if self.retrieval_cache is None:
+            return
+        active = {(retriever.collection_name, retriever.index_version) for retriever in self._retrievers}
+        stale = self.retrieval_cache.discard_if(lambda key: (key[0], key[1]) not in active)
+        if stale:
+            logger.info(f"Dropped {stale} cached retrieval results of indexes no longer served")
+
+    def retrieve(self, input: str, hyde_chunks: List[str], filters: Optional[Dict[str, Any]] = None) -> List[List[Dict]]:
+        """Retrieve candidate chunks from every collection retriever.
+
+        Args:
+            input: the question
+            hyde_chunks: hypothetical passages generated for the question
+            filters: optional metadata filter, e.g. {'filename': [...], 'date_published': ('2024-11-01', '2024-11-30')}
+
+        Returns:
+            one chunk list per retriever, in the order of self._retrievers
+        """
+        return [retriever.invoke(input, hyde_chunks, filters) for retriever in self._retrievers]
+
+    def retrieve_all(
+        self,
+        input: str,
+        hyde_chunks: List[str],
+        filters: Optional[Dict[str, Any]] = None,
+        retrievers: Optional[List[EnsembleRetriever]] = None,
+        query_vectors: Optional[np.ndarray] = None,
+    ) -> List[Dict]:
+        """Retrieve from every collection concurrently and merge the candidates into one list for a single rerank.
+
+        The question and hyde chunks are embedded once and shared by all collections, so latency follows the
+        slowest collection. bundle_ids are renumbered to stay unique across collections and every chunk
+        gets a 'collection' key. retrievers pins an index snapshot (a former self._retrievers), default the current one.
+        query_vectors are the normalised vectors of [input] + hyde_chunks if they were already embedded.
+        """
+        retrievers = list(self._retrievers if retrievers is None else retrievers)
+        if not retrievers:
+            return []
+        start_time = time.perf_counter()
+        if query_vectors is None:
+            query_vectors = retrievers[0].faiss_retriever.embed_queries([input] + hyde_chunks)
+        embed_time = time.perf_counter() - start_time
+
+        # each collection thread runs in a copy of the caller's context so it records into the request's trace
+        futures = [
+            self._collection_executor.submit(contextvars.copy_context().run, retriever.invoke, input, hyde_chunks, filters, None, query_vectors)
+            for retriever in retrievers
+        ]
+
+        merged = self._merge_collections(retrievers, [future.result() for future in futures])
+        logger.info(f"Retrieved {len(merged)} chunks from {len(retrievers)} collections in {(time.perf_counter() - start_time) * 1000:.1f}ms (embed {embed_time * 1000:.1f}ms)")
+        return merged
+
+    @staticmethod
+    def _merge_collections(retrievers: List[EnsembleRetriever], chunk_lists: List[List[Dict]]) -> List[Dict]:
+        """Concatenate the chunk lists of retrievers, renumbering bundle_ids and tagging every chunk with its collection."""
+        merged = []
+        bundle_offset = 0
+        for retriever, chunk_list in zip(retrievers, chunk_lists):
+            for chunk in chunk_list:
+                chunk['bundle_id'] += bundle_offset
+                chunk['collection'] = retriever.collection_name
+            merged.extend(chunk_list)
+            bundle_offset = max((chunk['bundle_id'] for chunk in merged), default=-1) + 1
+        return merged
+
+    def get_chunk_vectors(self, chunks: List[str], doc_ids: Optional[List[str]] = None) -> np.ndarray:
+        """Normalised vectors of chunks from any collection, stored vectors are looked up by doc_id before embedding."""
+        retrievers = list(self._retrievers)
+        vectors = np.empty((len(chunks), retrievers[0].faiss_retriever.dimension), dtype=np.float32)
+        missing = list(range(len(chunks)))
+        if doc_ids is not None:
+            for retriever in retrievers:
+                rows = retriever.metadata_columns.rows_of([doc_ids[i] for i in missing]).tolist()
+                found = [i for i, row in zip(missing, rows) if row != -1]
+                if found:
+                    vectors[found] = retriever.faiss_retriever.get_vectors([row for row in rows if row != -1])
+                missing = [i for i, row in zip(missing, rows) if row == -1]
+        if missing:
+            vectors[missing] = retrievers[0].faiss_retriever.embed_queries([chunks[i] for i in missing])
+        return vectors
+
+    def compute_query_similarity(self, query: str, chunks: List[str], doc_ids: Optional[List[str]] = None) -> np.ndarray:
+        """Cosine similarity of query to chunks merged from several collections, see EnsembleRetriever.compute_query_similarity."""
+        query_vector = self._retrievers[0].faiss_retriever.embed_queries([query])[0]
+        return self.get_chunk_vectors(chunks, doc_ids) @ query_vector
+
+    def compute_similarity_mtx(self, chunks: List[str], doc_ids: Optional[List[str]] = None):
+        """Pairwise similarity of chunks merged from several collections, see EnsembleRetriever.compute_similarity_mtx."""
+        vectors = self.get_chunk_vectors(chunks, doc_ids)
+        return EnsembleRetriever._to_similarity_tensor(vectors, vectors)
+
+    def embedding_cache_stats(self) -> Optional[Dict[str, Any]]:
+        """Size, hits, misses and hit rate of the shared embedding cache, None if it is disabled."""
+        if isinstance(self.embeddings, CachedEmbeddings):
+            return self.embeddings.stats()
+        return None
+
+    def retrieval_cache_stats(self) -> Optional[Dict[str, Any]]:
+        """Size, memory use, hits, misses and hit rate of the retrieval result cache, None if it is disabled."""
+        if self.retrieval_cache is not None:
+            return self.retrieval_cache.stats()
+        return None
+
+    def create_retriever(self, k: int, collection_name: str, retriever_type: str = "chroma", previous: Optional[EnsembleRetriever] = None):
+        """Create a specific retriever for a collection.
+
+        previous is the served retriever it replaces, its FAISS index is updated instead of rebuilt
+        unless the collection was fully rebuilt (load_data.py, refresh_collection) since it was loaded.
+        """
         if collection_name not in self._collections:
             raise ValueError(f"Collection {collection_name} does not exist")
             
         bm25_dir = os.path.join(self._config['persist_directory'], "bm25_index", collection_name)
+        title_summary_dir = os.path.join(self._config['persist_directory'], "title_summary_index", collection_name)
+        chunk_store_dir = os.path.join(self._config['persist_directory'], "chunk_store", collection_name)
+        index_version = loaded_index_version(read_index_version(self._config['persist_directory'], collection_name))
+        rebuild_version = read_rebuild_version(self._config['persist_directory'], collection_name)
+        if previous is not None and previous.rebuild_version != rebuild_version:
+            previous = None
+        # re-scoring vectors are memory-mapped from disk, the system temp dir is often a tmpfs that keeps them in RAM
+        index_config = {'rescore_dir': os.path.join(self._config['persist_directory'], "rescore_vectors"), **(self._config.get('faiss_index') or {})}
+        os.makedirs(index_config['rescore_dir'], exist_ok=True)
 
-        retriver = EnsembleRetriever(bm25_dir, self._collections[collection_name], k, self.embeddings)
+        retriver = EnsembleRetriever(
+            bm25_dir,
+            self._collections[collection_name],
+            k,
+            self.embeddings,
+            embed_batch_size=self._config.get('embed_batch_size', 32),
+            expansion_mode=self._config.get('expansion_mode', 'targeted'),
+            index_config=index_config,
+            title_summary_dir=title_summary_dir,
+            embeddings_model_name=self.embeddings_model_name,
+            chunk_store_dir=chunk_store_dir,
+            parallel_paths=self._config.get('parallel_retrieval', False),
+            path_workers=self._config.get('retrieval_path_workers', 6),
+            result_cache=self.retrieval_cache,
+            collection_name=collection_name,
+            index_version=index_version,
+            rebuild_version=rebuild_version,
+            previous=previous,
+        )
             
         return retriver
 
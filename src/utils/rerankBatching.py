@@ -0,0 +1,74 @@
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+from typing import Dict, List, Optional, Sequence, Any
+
+
+class PairLengths:
+    """Token length of [question, passage] pairs, from the reranker's tokenizer if there is one, otherwise estimated from characters."""
+
+    def __init__(self, tokenizer=None, chars_per_token: float = 3.5):
+        self.tokenizer = tokenizer
+        self.chars_per_token = chars_per_token
+
+    def __call__(self, pairs: Sequence[Sequence[str]]) -> List[int]:
+        if len(pairs) == 0:
+            return []
+        if self.tokenizer is not None:
+            try:
+                questions = self.tokenizer([pair[0] for pair in pairs], add_special_tokens=False)['input_ids']
+                passages = self.tokenizer([pair[1] for pair in pairs], add_special_tokens=False)['input_ids']
+                return [len(q) + len(p) for q, p in zip(questions, passages)]
+            except Exception as e:
+                logger.warning(f"Tokenizing rerank pairs failed, estimating lengths from characters: {e}")
+        return [int((len(pair[0]) + len(pair[1])) / self.chars_per_token) + 1 for pair in pairs]
+
+
+def length_bucketed_batches(lengths: Sequence[int], max_pairs: Optional[int] = None, max_tokens: Optional[int] = None) -> List[List[int]]:
+    """Split pair indices into batches of similar length.
+
+    Pairs are sorted by length, so each batch pads to a length close to that of all its pairs. A batch holds at most
+    max_pairs pairs and at most max_tokens tokens after padding (its size times its longest pair); a pair longer
+    than max_tokens gets a batch of its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    batch = []
+    for i in order:
+        # sorted longest first, so the first pair of a batch sets its padded length
+        if batch and ((max_pairs and len(batch) >= max_pairs) or (max_tokens and (len(batch) + 1) * lengths[batch[0]] > max_tokens)):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class PaddingStats:
+    """Real and padded token counts of the batches sent to the reranker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.pairs = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def record(self, lengths: Sequence[int]):
+        with self._lock:
+            self.batches += 1
+            self.pairs += len(lengths)
+            self.tokens += sum(lengths)
+            self.padded_tokens += len(lengths) * max(lengths, default=0)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "pairs": self.pairs,
+                "tokens": self.tokens,
+                "padded_tokens": self.padded_tokens,
+                "padding_efficiency": self.tokens / self.padded_tokens if self.padded_tokens else 1.0,
+            }
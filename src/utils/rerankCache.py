@@ -0,0 +1,97 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from typing import List, Optional, Sequence
+
+from .lruCache import LRUCache
+from .filingLoader import hash_content
+from .rerankBatching import PairLengths, PaddingStats, length_bucketed_batches
+
+
+class CachedReranker:
+    """Reranker wrapper that caches scores by (model id, whitespace-normalised question, chunk doc_id).
+
+    One instance is shared by every session of a ChatService, so sub-question retries, collection loops,
+    eval reruns and popular questions only send the pairs that were never scored to the model.
+    Missing pairs are grouped by token length and go to the wrapped reranker in calls of at most batch_size pairs and
+    max_tokens padded tokens, or all in one call if both are None (e.g. a RerankExecutor that forms its own batches).
+    """
+
+    def __init__(self, reranker, model_id: str, max_size: int = 50000, ttl: Optional[float] = None, batch_size: Optional[int] = 8,
+                 max_tokens: Optional[int] = None, tokenizer=None, chars_per_token: float = 3.5):
+        """
+        Args:
+            reranker: the wrapped reranker, anything with compute_score(pairs) like FlagLLMReranker
+            model_id: id of the reranker model, part of every cache key
+            max_size: maximum number of cached scores, 0 disables caching
+            ttl: seconds a cached score stays valid, None to keep it until evicted
+            batch_size: max number of pairs per compute_score call of the wrapped reranker, None for no limit
+            max_tokens: max padded tokens (pairs times the longest pair) per call, None for no limit
+            tokenizer: tokenizer of the reranker model used to measure pair lengths, None to estimate them with chars_per_token
+        """
+        self.reranker = reranker
+        self.model_id = model_id
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pair_lengths = PairLengths(tokenizer, chars_per_token)
+        self.padding = PaddingStats()
+        self.cache = LRUCache(max_size=max_size, ttl=ttl) if max_size > 0 else None
+
+    def _key(self, question: str, doc_id: str):
+        return (self.model_id, " ".join(question.split()), doc_id)
+
+    def compute_score(self, sentence_pairs: Sequence[Sequence[str]], doc_ids: Optional[List[Optional[str]]] = None) -> List[float]:
+        """Scores of [question, passage] pairs, in order.
+
+        doc_ids identify the passages; missing ones are derived from the passage text the same way load_data does.
+        """
+        if doc_ids is None:
+            doc_ids = [None] * len(sentence_pairs)
+        keys = [
+            self._key(question, doc_id if doc_id is not None else hash_content(passage))
+            for (question, passage), doc_id in zip(sentence_pairs, doc_ids)
+        ]
+        scores = [self.cache.get(key) for key in keys] if self.cache is not None else [None] * len(keys)
+
+        # score each distinct missing pair once
+        missing = {}
+        for i, score in enumerate(scores):
+            if score is None:
+                missing.setdefault(keys[i], i)
+        if missing:
+            computed = dict(zip(missing.keys(), self._score_batches([sentence_pairs[i] for i in missing.values()])))
+            if self.cache is not None:
+                for key, score in computed.items():
+                    self.cache.put(key, score)
+            scores = [score if score is not None else computed[key] for key, score in zip(keys, scores)]
+        logger.info(f"Reranked {len(keys)} pairs, {len(keys) - len(missing)} from cache")
+        return scores
+
+    def _score_batches(self, pairs: List[Sequence[str]]) -> List[float]:
+        if self.batch_size is None and self.max_tokens is None:
+            return self._score([list(pair) for pair in pairs])
+        # short snippets and long table descriptions go to different batches, scores are put back in input order
+        lengths = self.pair_lengths(pairs)
+        scores = [None] * len(pairs)
+        for batch in length_bucketed_batches(lengths, self.batch_size, self.max_tokens):
+            self.padding.record([lengths[i] for i in batch])
+            for i, score in zip(batch, self._score([list(pairs[i]) for i in batch])):
+                scores[i] = score
+        return scores
+
+    def _score(self, pairs: List[List[str]]) -> List[float]:
+        scores = self.reranker.compute_score(pairs)
+        # FlagEmbedding returns a bare float for a single pair
+        if not isinstance(scores, (list, tuple)):
+            scores = [scores]
+        return [float(score) for score in scores]
+
+    def stats(self):
+        """Size, hits, misses and hit rate of the score cache, None if it is disabled."""
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def padding_stats(self):
+        """Batches, real and padded tokens and padding efficiency of the calls this wrapper batched itself."""
+        return self.padding.stats()
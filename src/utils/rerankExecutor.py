@@ -0,0 +1,135 @@
+import time
+import queue
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Sequence, Any
+
+from .rerankBatching import PairLengths, PaddingStats, length_bucketed_batches
+
+
+class _RerankJob:
+    """Pairs of one compute_score call, scores are filled in as their batches finish."""
+
+    def __init__(self, num_pairs: int):
+        self.scores = [None] * num_pairs
+        self.remaining = num_pairs
+        self.future = Future()
+
+class RerankExecutor:
+    """Dynamic batching of reranker calls from all sessions on one worker thread.
+
+    Pairs of every in-flight compute_score call go into one queue. The worker takes pairs from the queue
+    until it holds max_pairs pairs or max_wait_ms passed since the first one, groups them by token length
+    into model calls of at most max_tokens padded tokens and hands each caller its scores. Only this thread
+    touches the model, so concurrent requests no longer compete for the device with small batches.
+    """
+
+    def __init__(self, reranker, max_pairs: int = 64, max_wait_ms: float = 10.0, max_tokens: Optional[int] = None,
+                 tokenizer=None, chars_per_token: float = 3.5):
+        """
+        Args:
+            reranker: the wrapped reranker, anything with compute_score(pairs) like FlagLLMReranker
+            max_pairs: max number of pairs per model call
+            max_wait_ms: max time a batch waits for more pairs after its first one
+            max_tokens: optional budget of padded tokens (pairs times the longest pair) per model call
+            tokenizer: tokenizer of the reranker model used to measure pair lengths, None to estimate them with chars_per_token
+        """
+        self.reranker = reranker
+        self.max_pairs = max_pairs
+        self.max_wait = max_wait_ms / 1000
+        self.max_tokens = max_tokens
+        self.pair_lengths = PairLengths(tokenizer, chars_per_token)
+        self.padding = PaddingStats()
+        self._queue = queue.Queue()
+
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.pairs = 0
+        self.max_batch_size = 0
+        self.max_queue_depth = 0
+        self.queue_wait = 0.0
+        self.model_time = 0.0
+
+        self._worker = threading.Thread(target=self._run, name="rerank_executor", daemon=True)
+        self._worker.start()
+
+    def compute_score(self, sentence_pairs: Sequence[Sequence[str]]) -> List[float]:
+        """Scores of [question, passage] pairs in order, blocks until all of their batches have run."""
+        if len(sentence_pairs) == 0:
+            return []
+        job = _RerankJob(len(sentence_pairs))
+        # lengths are measured on the calling thread, the worker only sorts by them
+        lengths = self.pair_lengths(sentence_pairs)
+        enqueued_at = time.perf_counter()
+        for i, (pair, length) in enumerate(zip(sentence_pairs, lengths)):
+            self._queue.put((job, i, list(pair), enqueued_at, length))
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+        return job.future.result()
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(items) < self.max_pairs:
+                timeout = deadline - time.perf_counter()
+                try:
+                    # pairs already queued are taken without waiting, even past the deadline
+                    items.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # short snippets and long table descriptions go to different model calls
+            for batch in length_bucketed_batches([item[4] for item in items], self.max_pairs, self.max_tokens):
+                self._run_batch([items[i] for i in batch])
+
+    def _run_batch(self, batch: List[tuple]):
+        start_time = time.perf_counter()
+        try:
+            scores = self.reranker.compute_score([pair for _, _, pair, _, _ in batch])
+            # FlagEmbedding returns a bare float for a single pair
+            if not isinstance(scores, (list, tuple)):
+                scores = [scores]
+        except Exception as e:
+            logger.error(f"Reranking a batch of {len(batch)} pairs failed: {e}")
+            for job in {id(job): job for job, _, _, _, _ in batch}.values():
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+        end_time = time.perf_counter()
+
+        with self._stats_lock:
+            self.batches += 1
+            self.pairs += len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.queue_wait += sum(start_time - enqueued_at for _, _, _, enqueued_at, _ in batch)
+            self.model_time += end_time - start_time
+        self.padding.record([length for _, _, _, _, length in batch])
+
+        for (job, i, _, _, _), score in zip(batch, scores):
+            if job.future.done():
+                # an earlier batch of this job failed
+                continue
+            job.scores[i] = float(score)
+            job.remaining -= 1
+            if job.remaining == 0:
+                job.future.set_result(job.scores)
+
+    def stats(self) -> Dict[str, Any]:
+        padding = self.padding.stats()
+        with self._stats_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "batches": self.batches,
+                "pairs": self.pairs,
+                "mean_batch_size": self.pairs / self.batches if self.batches else 0.0,
+                "max_batch_size": self.max_batch_size,
+                "mean_queue_wait_ms": self.queue_wait / self.pairs * 1000 if self.pairs else 0.0,
+                "mean_batch_ms": self.model_time / self.batches * 1000 if self.batches else 0.0,
+                "padded_tokens": padding["padded_tokens"],
+                "padding_efficiency": padding["padding_efficiency"],
+            }
@@ -0,0 +1,179 @@
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+from typing import Dict, List, Optional, Sequence, Any
+
+import numpy as np
+import torch
+from FlagEmbedding import FlagLLMReranker
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from .rerankCache import CachedReranker
+from .rerankExecutor import RerankExecutor
+
+
+class CrossEncoderReranker:
+    """Sequence classification cross-encoder (e.g. bge-reranker-v2-m3) on CPU, int8 dynamically quantised unless quantize is False."""
+
+    def __init__(self, model_name: str, max_length: int = 512, quantize: bool = True, num_threads: Optional[int] = None):
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+        if quantize:
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.max_length = max_length
+
+    def compute_score(self, sentence_pairs: Sequence[Sequence[str]]) -> List[float]:
+        inputs = self.tokenizer(
+            [list(pair) for pair in sentence_pairs], padding=True, truncation=True, max_length=self.max_length, return_tensors='pt'
+        )
+        with torch.inference_mode():
+            return self.model(**inputs).logits.view(-1).float().tolist()
+
+
+class OnnxCrossEncoderReranker(CrossEncoderReranker):
+    """Cross-encoder run by ONNX Runtime on CPU, exported from the transformers checkpoint if the directory has no .onnx file.
+
+    file_name selects a pre-quantised graph in the model directory, e.g. model_quantized.onnx from optimum-cli onnxruntime quantize.
+    """
+
+    def __init__(self, model_name: str, max_length: int = 512, file_name: Optional[str] = None, num_threads: Optional[int] = None):
+        # optimum[onnxruntime] is only needed by this backend
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+
+        session_options = onnxruntime.SessionOptions()
+        if num_threads:
+            session_options.intra_op_num_threads = num_threads
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if file_name:
+            kwargs = {"file_name": file_name}
+        else:
+            kwargs = {"export": not (os.path.isdir(model_name) and any(name.endswith(".onnx") for name in os.listdir(model_name)))}
+        self.model = ORTModelForSequenceClassification.from_pretrained(
+            model_name, provider="CPUExecutionProvider", session_options=session_options, **kwargs
+        )
+        self.max_length = max_length
+
+
+class BiEncoderReranker:
+    """Cosine similarity of question and passage embeddings, no reranking model; the fallback for nodes without a GPU."""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def compute_score(self, sentence_pairs: Sequence[Sequence[str]]) -> List[float]:
+        questions = list(dict.fromkeys(pair[0] for pair in sentence_pairs))
+        question_vectors = dict(zip(questions, _normalize(np.array([self.embeddings.embed_query(q) for q in questions], dtype=np.float32))))
+        passage_vectors = _normalize(np.array(self.embeddings.embed_documents([pair[1] for pair in sentence_pairs]), dtype=np.float32))
+        return [float(question_vectors[pair[0]] @ vector) for pair, vector in zip(sentence_pairs, passage_vectors)]
+
+
+class QuerySimilarityReranker:
+    """bi_encoder scores computed where the embedding model lives, e.g. by a retrieval server through RetrievalClient.compute_query_similarity."""
+
+    def __init__(self, query_similarity):
+        self.query_similarity = query_similarity
+
+    def compute_score(self, sentence_pairs: Sequence[Sequence[str]]) -> List[float]:
+        rows_by_question = {}
+        for i, pair in enumerate(sentence_pairs):
+            rows_by_question.setdefault(pair[0], []).append(i)
+        scores = [0.0] * len(sentence_pairs)
+        for question, rows in rows_by_question.items():
+            for i, score in zip(rows, self.query_similarity(question, [sentence_pairs[i][1] for i in rows])):
+                scores[i] = float(score)
+        return scores
+
+
+class NoopReranker:
+    """Scores every pair 0, chunks keep their retrieval order apart from the time score."""
+
+    def compute_score(self, sentence_pairs: Sequence[Sequence[str]]) -> List[float]:
+        return [0.0] * len(sentence_pairs)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+RERANK_BACKENDS = ('flag_llm', 'cross_encoder', 'onnx', 'bi_encoder', 'none')
+
+
+def create_reranker_backend(config: Dict[str, Any], embeddings=None, query_similarity=None):
+    """The reranking model selected by rerank_backend, and the model id its cached scores are keyed by.
+
+    flag_llm (default) is FlagLLMReranker on rerank_model in fp16; cross_encoder and onnx run rerank_model as a
+    CPU cross-encoder (rerank_quantize, rerank_onnx_file, rerank_max_length, rerank_threads); bi_encoder scores
+    with the retrieval embedding model, the local embeddings or else query_similarity(question, passages)
+    (e.g. RetrievalClient.compute_query_similarity); none skips reranking.
+    """
+    backend = config.get('rerank_backend', 'flag_llm')
+    model_name = config.get('rerank_model')
+    if backend == 'flag_llm':
+        return FlagLLMReranker(model_name, use_fp16=True), model_name
+    if backend == 'cross_encoder':
+        quantize = config.get('rerank_quantize', True)
+        reranker = CrossEncoderReranker(
+            model_name,
+            max_length=config.get('rerank_max_length', 512),
+            quantize=quantize,
+            num_threads=config.get('rerank_threads', None),
+        )
+        return reranker, f"{backend}{'-int8' if quantize else ''}:{model_name}"
+    if backend == 'onnx':
+        file_name = config.get('rerank_onnx_file', None)
+        reranker = OnnxCrossEncoderReranker(
+            model_name,
+            max_length=config.get('rerank_max_length', 512),
+            file_name=file_name,
+            num_threads=config.get('rerank_threads', None),
+        )
+        return reranker, f"{backend}:{model_name}/{file_name or 'model.onnx'}"
+    if backend == 'bi_encoder':
+        model_id = f"{backend}:{config.get('embeddings_model_name')}"
+        if embeddings is not None:
+            return BiEncoderReranker(embeddings), model_id
+        if query_similarity is not None:
+            return QuerySimilarityReranker(query_similarity), model_id
+        # loading a second copy of the embedding model in every web worker is what the retrieval server avoids
+        raise ValueError("rerank_backend bi_encoder needs the retrieval embeddings or a retrieval server to score with")
+    if backend == 'none':
+        return NoopReranker(), backend
+    raise ValueError(f"Unknown rerank_backend {backend}, expected one of {RERANK_BACKENDS}")
+
+
+def create_reranker(config: Dict[str, Any], embeddings=None, query_similarity=None) -> CachedReranker:
+    """The reranker a ChatService shares between its sessions: the score cache, optionally in front of a batching executor.
+
+    The model comes from create_reranker_backend. With rerank_batching the pairs of all concurrent sessions
+    are batched by one RerankExecutor (rerank_max_pairs, rerank_max_wait_ms), otherwise each call runs the
+    model itself in batches of rerank_batch_size. Either way pairs are grouped by token length and batches
+    are limited to rerank_max_tokens padded tokens.
+    """
+    reranker, model_id = create_reranker_backend(config, embeddings, query_similarity)
+    logger.info(f"Reranker backend: {model_id}")
+    tokenizer = getattr(reranker, 'tokenizer', None)
+    batch_size = config.get('rerank_batch_size', 8)
+    max_tokens = config.get('rerank_max_tokens', None)
+    if config.get('rerank_batching', False):
+        reranker = RerankExecutor(
+            reranker,
+            max_pairs=config.get('rerank_max_pairs', 64),
+            max_wait_ms=config.get('rerank_max_wait_ms', 10),
+            max_tokens=max_tokens,
+            tokenizer=tokenizer,
+        )
+        # the executor forms the batches
+        batch_size = max_tokens = None
+    return CachedReranker(
+        reranker,
+        model_id,
+        max_size=config.get('rerank_cache_size', 50000),
+        ttl=config.get('rerank_cache_ttl', None),
+        batch_size=batch_size,
+        max_tokens=max_tokens,
+        tokenizer=tokenizer,
+    )
@@ -0,0 +1,257 @@
+import time
+import queue
+import threading
+import contextvars
+import logging
+import requests
+import torch
+import numpy as np
+logger = logging.getLogger(__name__)
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Any
+
+from .retrievalTrace import current_trace
+
+# every retrieval server response carries the index versions it serves, clients refresh their collection list when it changes
+INDEX_VERSIONS_HEADER = "X-Index-Versions"
+
+def served_versions(retrievers) -> str:
+    """Value of INDEX_VERSIONS_HEADER for the retrievers of a RAGManager, or the RemoteRetrievers of a RetrievalClient."""
+    return ",".join(f"{retriever.collection_name}={retriever.index_version}" for retriever in retrievers)
+
+class RetrievalBatcher:
+    """Collects concurrent retrieval requests of a retrieval server and handles them in batches.
+
+    A batch waits at most max_wait_ms for up to max_batch requests, embeds the distinct questions and
+    hyde chunks of all of them in one pass and then searches them against the same index snapshot with one
+    EnsembleRetriever.invoke_batch call per collection and filter.
+    """
+
+    def __init__(self, rag_manager, max_batch: int = 16, max_wait_ms: float = 5.0):
+        self.rag_manager = rag_manager
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_batch, thread_name_prefix="retrieval_batch")
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self._worker = threading.Thread(target=self._run, name="retrieval_batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, input: str, hyde_chunks: List[str], filters: Optional[Dict[str, Any]] = None, collection: Optional[str] = None) -> Future:
+        """Queue a request, the future resolves to the chunk list of collection, or the merged candidates of all collections if it is None."""
+        future = Future()
+        # the request is answered on a batch thread, keep the caller's context (retrieval trace)
+        self._queue.put((input, list(hyde_chunks), filters, collection, future, contextvars.copy_context()))
+        return future
+
+    def retrieve(self, input: str, hyde_chunks: List[str], filters: Optional[Dict[str, Any]] = None, collection: Optional[str] = None) -> List[Dict]:
+        return self.submit(input, hyde_chunks, filters, collection).result()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "requests": self.requests,
+                "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            }
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: List[tuple]):
+        start_time = time.perf_counter()
+        # every request of the batch searches the same index snapshot, see RAGManager.reload
+        retrievers = list(self.rag_manager._retrievers)
+        with self._stats_lock:
+            self.batches += 1
+            self.requests += len(batch)
+        if not retrievers:
+            for *_, future, _ in batch:
+                future.set_result([])
+            return
+
+        text_rows = {}
+        for input, hyde_chunks, *_ in batch:
+            for text in [input] + hyde_chunks:
+                text_rows.setdefault(text, len(text_rows))
+        try:
+            vectors = retrievers[0].faiss_retriever.embed_queries(list(text_rows))
+        except Exception as e:
+            logger.error(f"Embedding a batch of {len(batch)} retrieval requests failed: {e}")
+            for *_, future, _ in batch:
+                future.set_exception(e)
+            return
+        embed_time = time.perf_counter() - start_time
+
+        # requests to the same collection with the same filters are answered by one invoke_batch call,
+        # requests without a collection join the group of every collection and are merged afterwards
+        by_name = {retriever.collection_name: retriever for retriever in retrievers}
+        groups = {}
+        for i, (input, hyde_chunks, filters, collection, future, _) in enumerate(batch):
+            if collection is not None and collection not in by_name:
+                future.set_exception(ValueError(f"Collection {collection} is not served"))
+                continue
+            try:
+                keys = [
+                    (retriever.collection_name, retriever.metadata_columns.filter_key(filters))
+                    for retriever in (retrievers if collection is None else [by_name[collection]])
+                ]
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            for key in keys:
+                groups.setdefault(key, []).append(i)
+
+        query_vectors = [vectors[[text_rows[text] for text in [input] + hyde_chunks]] for input, hyde_chunks, *_ in batch]
+        group_futures = {
+            key: self._executor.submit(self._search_group, by_name[key[0]], [batch[i] for i in rows], [query_vectors[i] for i in rows])
+            for key, rows in groups.items()
+        }
+        results = [{} for _ in batch]
+        for key, rows in groups.items():
+            try:
+                chunk_lists = group_futures[key].result()
+            except Exception as e:
+                for i in rows:
+                    if not batch[i][4].done():
+                        batch[i][4].set_exception(e)
+                continue
+            for i, chunk_list in zip(rows, chunk_lists):
+                results[i][key[0]] = chunk_list
+
+        for (input, hyde_chunks, filters, collection, future, _), chunk_lists in zip(batch, results):
+            if future.done():
+                continue
+            if collection is None:
+                future.set_result(self.rag_manager._merge_collections(retrievers, [chunk_lists[retriever.collection_name] for retriever in retrievers]))
+            else:
+                future.set_result(chunk_lists[collection])
+        logger.info(f"Answered {len(batch)} retrieval requests with {len(groups)} batch searches in {(time.perf_counter() - start_time) * 1000:.1f}ms (embed {embed_time * 1000:.1f}ms)")
+
+    @staticmethod
+    def _search_group(retriever, requests: List[tuple], query_vectors: List[np.ndarray]) -> List[List[Dict]]:
+        """invoke_batch for requests sharing a collection and filters, traced in the context of each request."""
+        return retriever.invoke_batch(
+            [input for input, *_ in requests],
+            [hyde_chunks for _, hyde_chunks, *_ in requests],
+            requests[0][2],
+            query_vectors=query_vectors,
+            # a merged request is searched in several collections at once, a context can only be entered by one thread
+            contexts=[context.copy() for *_, context in requests],
+        )
+
+class RemoteRetriever:
+    """Stand-in for the EnsembleRetriever of one collection that is served by a retrieval server."""
+
+    def __init__(self, client: "RetrievalClient", collection_name: str, index_version: str, k: int):
+        self.client = client
+        self.collection_name = collection_name
+        self.index_version = index_version
+        self.k = k
+
+    def invoke(self, input: str, hyde_chunks: List[str], filters: Optional[Dict[str, Any]] = None) -> List[Dict]:
+        return self.client._request("POST", "/retrieve", {
+            "input": input,
+            "hyde_chunks": hyde_chunks,
+            "filters": filters,
+            "collection": self.collection_name,
+        })
+
+    def compute_similarity_mtx(self, chunks: List[str], doc_ids: Optional[List[str]] = None) -> torch.Tensor:
+        return self.client.compute_similarity_mtx(chunks, doc_ids)
+
+    def compute_query_similarity(self, query: str, chunks: List[str], doc_ids: Optional[List[str]] = None) -> np.ndarray:
+        return self.client.compute_query_similarity(query, chunks, doc_ids)
+
+class RetrievalClient:
+    """Thin replacement for RAGManager in web workers, retrieval runs in a shared local retrieval server (src/retrieval_server.py).
+
+    Exposes the parts of RAGManager that ChatService and app2.py use: _retrievers, retrieve, retrieve_all,
+    compute_similarity_mtx, compute_query_similarity, reload and index_status.
+    """
+
+    def __init__(self, base_url: str, timeout: float = 60, admin_token: Optional[str] = None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.admin_token = admin_token
+        # requests.Session is not thread safe, keep one keep-alive session per web worker thread
+        self._local = threading.local()
+        # collections served by the server, dropped when a response reports other index versions
+        self._served = None
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _request(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None):
+        headers = {"X-Admin-Token": self.admin_token} if self.admin_token else None
+        trace = current_trace()
+        if trace is not None and payload is not None:
+            # the server traces the retrieval of a traced request under the same request id
+            payload = {**payload, "trace": {"request_id": trace.request_id, "force": trace.forced}}
+        response = self._session().request(method, self.base_url + path, json=payload, headers=headers, timeout=self.timeout)
+        try:
+            body = response.json()
+        except ValueError:
+            body = {"status": "error", "message": response.text}
+        if response.status_code >= 400 or body.get("status") != "success":
+            raise RuntimeError(f"Retrieval server {method} {path} failed ({response.status_code}): {body.get('message')}")
+        served = self._served
+        versions = response.headers.get(INDEX_VERSIONS_HEADER)
+        if served is not None and versions is not None and versions != served_versions(served):
+            logger.info(f"Retrieval server now serves {versions}")
+            self._served = None
+        return body.get("data")
+
+    @property
+    def _retrievers(self) -> List[RemoteRetriever]:
+        """The collections currently served, in the server's retriever order.
+
+        Fetched once and again after a response of the server reports other index versions (e.g. after a reload).
+        """
+        served = self._served
+        if served is None:
+            served = [
+                RemoteRetriever(self, collection["collection_name"], collection["index_version"], collection["k"])
+                for collection in self._request("GET", "/collections")
+            ]
+            self._served = served
+        return list(served)
+
+    def retrieve(self, input: str, hyde_chunks: List[str], filters: Optional[Dict[str, Any]] = None) -> List[List[Dict]]:
+        return [retriever.invoke(input, hyde_chunks, filters) for retriever in self._retrievers]
+
+    def retrieve_all(self, input: str, hyde_chunks: List[str], filters: Optional[Dict[str, Any]] = None, retrievers=None) -> List[Dict]:
+        """See RAGManager.retrieve_all, the server searches one index snapshot per call so retrievers is not needed."""
+        return self._request("POST", "/retrieve", {"input": input, "hyde_chunks": hyde_chunks, "filters": filters})
+
+    def compute_similarity_mtx(self, chunks: List[str], doc_ids: Optional[List[str]] = None) -> torch.Tensor:
+        return torch.tensor(self._request("POST", "/similarity", {"chunks": chunks, "doc_ids": doc_ids}))
+
+    def compute_query_similarity(self, query: str, chunks: List[str], doc_ids: Optional[List[str]] = None) -> np.ndarray:
+        return np.array(self._request("POST", "/query_similarity", {"query": query, "chunks": chunks, "doc_ids": doc_ids}), dtype=np.float32)
+
+    def reload(self, collections: Optional[List[str]] = None, force: bool = False):
+        return self._request("POST", "/admin/reload", {"collections": collections, "force": force})
+
+    def index_status(self) -> Dict[str, Any]:
+        return self._request("GET", "/admin/index_version")
+
+    def stats(self) -> Dict[str, Any]:
+        """Batching and cache statistics of the server."""
+        return self._request("GET", "/stats")
@@ -0,0 +1,182 @@
+import json
+import time
+import queue
+import random
+import threading
+import contextvars
+import logging
+import numpy as np
+logger = logging.getLogger(__name__)
+
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Any
+
+class Trace:
+    """Retrieval and rerank events of one traced request, written as one JSON line when the request ends.
+
+    Events hold raw ids / scores (numpy arrays are fine), they are only serialised by the tracer's writer thread.
+    """
+
+    def __init__(self, request_id: str, forced: bool = False, include_content: bool = False):
+        self.request_id = request_id
+        self.forced = forced
+        # a forced trace is a debugging capture and always keeps chunk contents
+        self.include_content = include_content or forced
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.events = []
+
+    def add(self, event: str, **fields):
+        fields["event"] = event
+        fields["ms"] = round((time.perf_counter() - self._start) * 1000, 3)
+        # list.append is atomic, events may come from several retrieval threads of the same request
+        self.events.append(fields)
+
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            "time": self.start_time,
+            "forced": self.forced,
+            "events": self.events,
+        }
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    if hasattr(value, "tolist"):
+        # torch tensors
+        return value.tolist()
+    return str(value)
+
+class RetrievalTracer:
+    """Samples requests for tracing and appends their traces to a JSONL file from a background thread.
+
+    Disabled (no file) by default. sample_rate is the fraction of requests traced without chunk contents
+    (unless include_content), a forced request is always traced in full.
+    """
+
+    def __init__(self, path: Optional[str] = None, sample_rate: float = 0.0, include_content: bool = False, max_pending: int = 1000):
+        self.configure(path, sample_rate, include_content)
+        # created once, the writer thread keeps reading this queue across configure calls
+        self._pending = queue.Queue(maxsize=max_pending)
+        self.written = 0
+        self.dropped = 0
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def configure(self, path: Optional[str] = None, sample_rate: float = 0.0, include_content: bool = False):
+        """Change where and how much is traced, traces already queued are written to the new path."""
+        self.path = path
+        self.sample_rate = sample_rate
+        self.include_content = include_content
+
+    def start(self, request_id: str, force: bool = False, sampled: Optional[bool] = None) -> Optional[Trace]:
+        """A new Trace if the request is forced or sampled, None otherwise.
+
+        sampled is a sampling decision already taken upstream (e.g. by the web worker calling a retrieval server).
+        """
+        if self.path is None:
+            return None
+        if sampled is None:
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not (force or sampled):
+            return None
+        return Trace(request_id, forced=force, include_content=self.include_content)
+
+    def submit(self, trace: Trace):
+        """Queue a finished trace for writing, it is dropped if the writer falls behind by max_pending traces."""
+        if not trace.events:
+            return
+        self._ensure_writer()
+        try:
+            self._pending.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"path": self.path, "sample_rate": self.sample_rate, "written": self.written, "dropped": self.dropped}
+
+    def _ensure_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="retrieval_trace_writer", daemon=True)
+                self._writer.start()
+
+    def _run(self):
+        while True:
+            trace = self._pending.get()
+            path = self.path
+            if path is None:
+                # tracing was disabled after the trace was queued
+                continue
+            try:
+                line = json.dumps(trace.to_record(), ensure_ascii=False, default=_to_json)
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+                self.written += 1
+            except Exception as e:
+                logger.error(f"Failed to write retrieval trace {trace.request_id}: {e}")
+
+tracer = RetrievalTracer()
+_current_trace = contextvars.ContextVar("retrieval_trace", default=None)
+
+def configure_tracing(trace_config: Optional[Dict[str, Any]]):
+    """Configure the process wide tracer from the `retrieval_trace` config section (path, sample_rate, include_content)."""
+    trace_config = trace_config or {}
+    tracer.configure(
+        path=trace_config.get('path', None),
+        sample_rate=trace_config.get('sample_rate', 0.0),
+        include_content=trace_config.get('include_content', False),
+    )
+
+def current_trace() -> Optional[Trace]:
+    """Trace of the request being handled, None if it is not traced. Hot loops should only build events when this is not None."""
+    return _current_trace.get()
+
+@contextmanager
+def trace_request(request_id: str, force: bool = False, sampled: Optional[bool] = None):
+    """Trace everything retrieved and reranked inside the block under request_id if it is sampled or forced.
+
+    Work submitted to thread pools needs contextvars.copy_context().run to see the trace. Generators use trace_stream.
+    """
+    trace = tracer.start(request_id, force, sampled)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        # submit first, the trace must be written even if the reset below fails
+        if trace is not None:
+            tracer.submit(trace)
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # the block was left from another context than it was entered in
+            pass
+
+def trace_stream(request_id: str, stream: Iterator, force: bool = False, sampled: Optional[bool] = None) -> Iterator:
+    """Yield from the generator stream with everything it retrieves and reranks traced under request_id, see trace_request.
+
+    The trace is current only while stream computes its next item, never across a yield into the caller's
+    context, and it is submitted however the stream ends: exhausted, failed or closed by a client disconnect.
+    """
+    trace = tracer.start(request_id, force, sampled)
+    if trace is None:
+        yield from stream
+        return
+    try:
+        while True:
+            token = _current_trace.set(trace)
+            try:
+                item = next(stream)
+            except StopIteration:
+                return
+            finally:
+                _current_trace.reset(token)
+            yield item
+    finally:
+        stream.close()
+        tracer.submit(trace)
@@ -0,0 +1,96 @@
+import os
+import json
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from typing import List, Dict, Tuple, Optional
+from langchain_core.documents import Document
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from .versionedDir import new_version_dir, publish_version, resolve_version_dir
+
+VECTORS_FILE = "vectors.npy"
+KEYS_FILE = "keys.json"
+
+def hash_title_summary(title_summary: str) -> str:
+    """Generate a SHA-256 hash of the title summary."""
+    return hashlib.sha256(title_summary.encode('utf-8')).hexdigest()
+
+def save_title_summary_embeddings(
+    documents: List[Document],
+    embeddings: HuggingFaceEmbeddings,
+    save_dir: str,
+    model_name: str,
+    batch_size: int = 64,
+):
+    """Embed every unique title_summary of documents and save the vectors keyed by content hash.
+
+    Vectors already stored in save_dir for model_name are reused, so updating a collection only embeds new summaries.
+
+    Args:
+        documents: chunks of one collection, title_summary is read from their metadata
+        embeddings: embedding model used by the retriever
+        save_dir: output directory, usually next to the BM25 index of the collection; every save is a new version behind its CURRENT pointer
+        model_name: embedding model id, stored so vectors of another model are never reused
+        batch_size: number of title summaries per embed_documents call
+    """
+    title_summaries = list(dict.fromkeys(
+        doc.metadata['title_summary'] for doc in documents if doc.metadata.get('title_summary', '') != ''
+    ))
+    keys = [hash_title_summary(title_summary) for title_summary in title_summaries]
+
+    # vectors already stored for this model are reused, only new title summaries are embedded
+    key2row, stored_vectors = load_title_summary_embeddings(save_dir, model_name)
+    missing = [i for i, key in enumerate(keys) if key not in key2row]
+    missing_vectors = []
+    for i in range(0, len(missing), batch_size):
+        missing_vectors.extend(embeddings.embed_documents([title_summaries[j] for j in missing[i:i + batch_size]]))
+
+    if stored_vectors is not None:
+        vectors = np.empty((len(keys), stored_vectors.shape[1]), dtype=np.float32)
+        found = [i for i, key in enumerate(keys) if key in key2row]
+        vectors[found] = stored_vectors[[key2row[keys[i]] for i in found]]
+        if missing:
+            vectors[missing] = missing_vectors
+    else:
+        vectors = np.array(missing_vectors, dtype=np.float32)
+    del stored_vectors
+
+    # vectors and keys go into a new version directory and are swapped in together by the CURRENT pointer,
+    # readers may still have the old vectors memory-mapped
+    version_dir = new_version_dir(save_dir)
+    with open(os.path.join(version_dir, VECTORS_FILE), 'wb') as f:
+        np.save(f, vectors)
+    with open(os.path.join(version_dir, KEYS_FILE), 'w') as f:
+        json.dump({"model_name": model_name, "keys": keys}, f)
+    publish_version(save_dir, version_dir)
+
+    logger.info(f"{len(title_summaries)} title summary embeddings saved to {save_dir}, {len(missing)} embedded")
+
+def load_title_summary_embeddings(save_dir: str, model_name: str) -> Tuple[Dict[str, int], Optional[np.ndarray]]:
+    """Memory-map the title summary vectors saved by save_title_summary_embeddings.
+
+    Returns:
+        (hash -> row, vectors); ({}, None) if nothing usable is stored for model_name
+    """
+    version_dir = resolve_version_dir(save_dir)
+    keys_path = os.path.join(version_dir, KEYS_FILE)
+    vectors_path = os.path.join(version_dir, VECTORS_FILE)
+    if not os.path.exists(keys_path) or not os.path.exists(vectors_path):
+        logger.info(f"No stored title summary embeddings in {save_dir}")
+        return {}, None
+
+    with open(keys_path, 'r') as f:
+        stored = json.load(f)
+    if stored.get("model_name") != model_name:
+        logger.warning(f"Stored title summary embeddings in {save_dir} were built with {stored.get('model_name')}, not {model_name}, ignoring them")
+        return {}, None
+
+    vectors = np.load(vectors_path, mmap_mode='r')
+    if len(stored["keys"]) != len(vectors):
+        logger.warning(f"Stored title summary embeddings in {save_dir} are inconsistent, ignoring them")
+        return {}, None
+
+    return {key: row for row, key in enumerate(stored["keys"])}, vectors
@@ -0,0 +1,57 @@
+import os
+import time
+import shutil
+import logging
+logger = logging.getLogger(__name__)
+
+from typing import Optional, Tuple
+
+# name of the version directory an index directory currently serves
+CURRENT_FILE = "CURRENT"
+
+def new_version_dir(save_dir: str) -> str:
+    """Create and return an empty version directory inside save_dir, published with publish_version once written."""
+    os.makedirs(save_dir, exist_ok=True)
+    version_dir = os.path.join(save_dir, f"v-{time.time_ns()}-{os.getpid()}")
+    os.makedirs(version_dir)
+    return version_dir
+
+def publish_version(save_dir: str, version_dir: str):
+    """Atomically point save_dir at version_dir and delete all versions but it and the one it replaces.
+
+    Readers resolving the pointer see either the old or the new complete version, never a half-written one.
+    """
+    version = os.path.basename(version_dir)
+    previous = current_version(save_dir)
+    pointer_tmp = os.path.join(save_dir, f"{CURRENT_FILE}.tmp-{os.getpid()}")
+    with open(pointer_tmp, 'w') as f:
+        f.write(version)
+    os.replace(pointer_tmp, os.path.join(save_dir, CURRENT_FILE))
+    _remove_old_versions(save_dir, keep=(version, previous))
+
+def current_version(save_dir: str) -> Optional[str]:
+    try:
+        with open(os.path.join(save_dir, CURRENT_FILE), 'r') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def resolve_version_dir(save_dir: str) -> str:
+    """Directory of the version save_dir currently serves, save_dir itself for indexes saved before versioning."""
+    version = current_version(save_dir)
+    return os.path.join(save_dir, version) if version else save_dir
+
+def _remove_old_versions(save_dir: str, keep: Tuple):
+    """Delete versions other than keep, plus the files of the unversioned layout older indexes used.
+
+    The previous version is kept for readers that resolved the pointer just before the swap,
+    open memory maps of deleted files stay valid.
+    """
+    for name in os.listdir(save_dir):
+        path = os.path.join(save_dir, name)
+        if name in keep or name == CURRENT_FILE:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif not name.startswith(f"{CURRENT_FILE}.tmp-"):
+            os.remove(path)
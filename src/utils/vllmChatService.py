@@ -2,6 +2,7 @@ import re
 import sys
 import time
 import json
+import uuid
 import logging
 import pandas as pd
 # from transformers import AutoTokenizer
@@ -15,9 +16,11 @@ from typing import Dict
 # from .apiOllamaManager import ChatManager
 from .vllmManager import ChatManager
 from .ragManager import RAGManager
+from .rerankers import create_reranker
+from .rerankExecutor import RerankExecutor
+from .retrievalTrace import trace_request, trace_stream
 from gpu_log import log_gpu_usage
 from transformers import AutoModelForCausalLM, AutoTokenizer
-from FlagEmbedding import FlagLLMReranker
 
 
 
@@ -89,22 +92,46 @@ class ChatService:
         self.base_url: str = config.get('ollama_base_url')
         self.model_name: str = config.get('llm')
         self.rerank_topk = rerank_topk
+        # retrieve all collections concurrently with one HyDE pass and rerank the merged candidates once
+        self.merged_retrieval = config.get('merged_retrieval', False)
         
-        self.reranker = FlagLLMReranker(config.get('rerank_model'), use_fp16=True) 
+        # one score cache (and batching executor) in front of the reranker, shared by every session
+        # a RetrievalClient has no local embeddings, bi_encoder then scores through the retrieval server
+        self.reranker = create_reranker(
+            config, embeddings=getattr(rag_manager, 'embeddings', None), query_similarity=rag_manager.compute_query_similarity
+        )
+        # two-stage rerank: embedding similarity keeps the top bundles, only those go to the LLM reranker
+        self.rerank_prefilter_bundles = config.get('rerank_prefilter_bundles', None)
 
         if not self.model_name or not self.base_url:
             logging.error("LLM model name/base_url is not configured.")
             sys.exit(1)
         logging.info(f"Using model: {self.model_name}, URL: {self.base_url}")
 
+    def rerank_cache_stats(self):
+        """Size, hits, misses and hit rate of the shared reranker score cache, None if it is disabled."""
+        return self.reranker.stats()
+
+    def rerank_batching_stats(self):
+        """Batch size and padding efficiency of the reranker calls, with queue depth if rerank_batching is on."""
+        if isinstance(self.reranker.reranker, RerankExecutor):
+            return self.reranker.reranker.stats()
+        return self.reranker.padding_stats()
+
     def get_or_create_chat_manager(self, session_id: str) -> ChatManager:
         if session_id not in self.api_chat_manager:
-            self.api_chat_manager[session_id] = ChatManager(session_id, self.base_url, self.model_name, self.reranker, chunk_topk = self.rerank_topk)
+            self.api_chat_manager[session_id] = ChatManager(session_id, self.base_url, self.model_name, self.reranker, chunk_topk = self.rerank_topk,
+                                                                prefilter_bundles=self.rerank_prefilter_bundles)
         return self.api_chat_manager[session_id]
         
         
     
-    def generate_response_with_rag(self, question: str, session_id: str, internal_input=None, interrupt_index=None):
+    def generate_response_with_rag(self, question: str, session_id: str, internal_input=None, interrupt_index=None, filters=None, trace_id=None):
+        """trace_id forces a full retrieval trace of this request under that id, otherwise the request may be sampled."""
+        with trace_request(trace_id or uuid.uuid4().hex, force=trace_id is not None):
+            return self._generate_response_with_rag(question, session_id, internal_input, interrupt_index, filters)
+
+    def _generate_response_with_rag(self, question: str, session_id: str, internal_input=None, interrupt_index=None, filters=None):
         chat_manager = self.get_or_create_chat_manager(session_id)
         lang = '中文' if bool(re.search(r'[\u4e00-\u9fff]', question)) else 'English'
         user_input = question
@@ -116,6 +143,8 @@ class ChatService:
 
         
         chat_manager.reset_rag_info()
+        # pin the index snapshot, a hot reload during this request does not mix index versions
+        retrievers = self.rag_manager._retrievers
         answer = ""
         rewritten_q = ""
         if isinstance(rewritten, list):
@@ -131,25 +160,41 @@ class ChatService:
                 if chat_manager.need_rag:
                     log_gpu_usage('rag started')
                     timeinfo_list = []
-                    
-                    for retriever in self.rag_manager._retrievers:
-                        # hyDE rewrite the questions by generating documents
+
+                    if self.merged_retrieval:
                         hyde_start_time = time.perf_counter()
                         hyde_chunks = chat_manager.generate_hypo_chunks(rewritten_question)
                         hypo_chunk_content.append(hyde_chunks)
-                        # hyde_chunks = []
                         logger.info(f"hypo chunks: {hyde_chunks}")
                         logger.info("The time for hyde: {:.2f}".format(time.perf_counter()-hyde_start_time))
 
-                        retriever_content = retriever.invoke(user_input, hyde_chunks)
+                        retriever_content = self.rag_manager.retrieve_all(user_input, hyde_chunks, filters, retrievers)
                         all_retrieved_content.append(retriever_content)
                         rerank_start_time = time.perf_counter()
-                        current_context, timeinfo_list = get_rag_content(chat_manager, retriever_content, rewritten_question, query_time, retriever)
-                        rerank_end_time = time.perf_counter()
-                        logger.info("The time for rerank: {:.2f}".format(rerank_end_time-rerank_start_time))
+                        current_context, timeinfo_list = get_rag_content(chat_manager, retriever_content, rewritten_question, query_time, self.rag_manager)
+                        logger.info("The time for rerank: {:.2f}".format(time.perf_counter()-rerank_start_time))
                         log_gpu_usage('rag finished')
                         rag_context += current_context + '\n'
                         logger.info(f'Input Rag Context is: {rag_context}')
+                    else:
+                        for retriever in retrievers:
+                            # hyDE rewrite the questions by generating documents
+                            hyde_start_time = time.perf_counter()
+                            hyde_chunks = chat_manager.generate_hypo_chunks(rewritten_question)
+                            hypo_chunk_content.append(hyde_chunks)
+                            # hyde_chunks = []
+                            logger.info(f"hypo chunks: {hyde_chunks}")
+                            logger.info("The time for hyde: {:.2f}".format(time.perf_counter()-hyde_start_time))
+
+                            retriever_content = retriever.invoke(user_input, hyde_chunks, filters)
+                            all_retrieved_content.append(retriever_content)
+                            rerank_start_time = time.perf_counter()
+                            current_context, timeinfo_list = get_rag_content(chat_manager, retriever_content, rewritten_question, query_time, retriever)
+                            rerank_end_time = time.perf_counter()
+                            logger.info("The time for rerank: {:.2f}".format(rerank_end_time-rerank_start_time))
+                            log_gpu_usage('rag finished')
+                            rag_context += current_context + '\n'
+                            logger.info(f'Input Rag Context is: {rag_context}')
 
                     used_time = select_most_recent_time(timeinfo_list)
                     chat_manager.add_time_in_sys(used_time)
@@ -182,7 +227,15 @@ class ChatService:
 
 
 
-    def generate_response_stream(self, question: str, session_id: str, internal_input=None, interrupt_index=None):
+    def generate_response_stream(self, question: str, session_id: str, internal_input=None, interrupt_index=None, filters=None, trace_id=None):
+        """See generate_response_with_rag for trace_id."""
+        return trace_stream(
+            trace_id or uuid.uuid4().hex,
+            self._generate_response_stream(question, session_id, internal_input, interrupt_index, filters),
+            force=trace_id is not None,
+        )
+
+    def _generate_response_stream(self, question: str, session_id: str, internal_input=None, interrupt_index=None, filters=None):
         start_time = time.perf_counter()
         chat_manager = self.get_or_create_chat_manager(session_id)
         lang = '中文' if bool(re.search(r'[\u4e00-\u9fff]', question)) else 'English'
@@ -191,6 +244,8 @@ class ChatService:
         rewritten = chat_manager.if_query_rag(user_input, qa_history)
 
         chat_manager.reset_rag_info()
+        # pin the index snapshot, a hot reload during this request does not mix index versions
+        retrievers = self.rag_manager._retrievers
         answer = ""
         rewritten_q = ""
         for rewritten_question in rewritten:
@@ -206,14 +261,21 @@ class ChatService:
             if chat_manager.need_rag:
                 log_gpu_usage('rag started')
                 timeinfo_list = []
-                
-                for retriever in self.rag_manager._retrievers:
-                    # hyDE rewrite the questions by generating documents
+
+                if self.merged_retrieval:
                     hyde_chunks = chat_manager.generate_hypo_chunks(rewritten_question)
-                    retriever_content = retriever.invoke(user_input, hyde_chunks)
-                    current_context, timeinfo_list = get_rag_content(chat_manager, retriever_content, rewritten_question, query_time,retriever)
+                    retriever_content = self.rag_manager.retrieve_all(user_input, hyde_chunks, filters, retrievers)
+                    current_context, timeinfo_list = get_rag_content(chat_manager, retriever_content, rewritten_question, query_time, self.rag_manager)
                     log_gpu_usage('rag finished')
                     rag_context += current_context + '\n'
+                else:
+                    for retriever in retrievers:
+                        # hyDE rewrite the questions by generating documents
+                        hyde_chunks = chat_manager.generate_hypo_chunks(rewritten_question)
+                        retriever_content = retriever.invoke(user_input, hyde_chunks, filters)
+                        current_context, timeinfo_list = get_rag_content(chat_manager, retriever_content, rewritten_question, query_time,retriever)
+                        log_gpu_usage('rag finished')
+                        rag_context += current_context + '\n'
 
                 used_time = select_most_recent_time(timeinfo_list)
                 chat_manager.add_time_in_sys(used_time)
@@ -15,8 +15,10 @@ import pandas as pd
 from gpu_log import log_gpu_usage
 from typing import List, Dict, Tuple
 
+from .retrievalTrace import current_trace
+
 class ChatManager:
-    def __init__(self, session_id, base_url, model_name, reranker, chunk_topk = 5, history_limit=20):
+    def __init__(self, session_id, base_url, model_name, reranker, chunk_topk = 5, history_limit=20, prefilter_bundles=None):
         assert history_limit % 2 == 0, "history_limit must be an even number"
         self.session_id = session_id
         self.base_url = base_url
@@ -31,6 +33,8 @@ class ChatManager:
         #self.rerank_model = rerank_model
         self.reranker = reranker
         self.similar_threshhold = 0.9
+        # only the top prefilter_bundles bundles by embedding similarity go to the reranker, None reranks all
+        self.prefilter_bundles = prefilter_bundles
         #self.rerank_model = SentenceTransformer(rerank_model_name, trust_remote_code=True)
 
         self.messages = []               # This is the complete input of current question, including sys_ptompt, question, history_summary, rag content
@@ -475,6 +479,18 @@ DO NOT INCLUDE ANY DETAILS THAT ARE NOT DIRECTLY RELATED TO THE QUESTION.
         return flag == "YES"
 
 
+    def prefilter_candidates(self, chunks: List[Dict], question: str, bundle_map: Dict, retriever):
+        """Indices of the chunks of the prefilter_bundles bundles most similar to the question, None to rerank every chunk.
+
+        A bundle scores the best cosine similarity of its chunks, computed from the stored chunk embeddings.
+        """
+        if not self.prefilter_bundles or len(bundle_map) <= self.prefilter_bundles:
+            return None
+        similarity = retriever.compute_query_similarity(question, [chunk['page_content'] for chunk in chunks], [chunk['metadata'].get('doc_id') for chunk in chunks])
+        bundle_scores = {bundle_id: max(similarity[idx] for idx in indices) for bundle_id, indices in bundle_map.items()}
+        top_bundles = sorted(bundle_scores, key=bundle_scores.get, reverse=True)[:self.prefilter_bundles]
+        return sorted(idx for bundle_id in top_bundles for idx in bundle_map[bundle_id])
+
     def rank_chunk(self, chunks: List[Dict], question: str, query_time: datetime, retriever):
         
         bundle_map = {}
@@ -482,9 +498,6 @@ DO NOT INCLUDE ANY DETAILS THAT ARE NOT DIRECTLY RELATED TO THE QUESTION.
             bundle_map.setdefault(chunk['bundle_id'], []).append(idx)
 
         pairs = [[question, chunk['page_content']] for chunk in chunks]
-        # Batch the pairs for reranker
-        BATCH_SIZE = 8
-        reranker_scores = []
         time_scores = []
 
         #只有chunk content的 list
@@ -497,24 +510,32 @@ DO NOT INCLUDE ANY DETAILS THAT ARE NOT DIRECTLY RELATED TO THE QUESTION.
             score = max(0, 1 - score / 365)
             time_scores.append(score)
 
-        for i in range(0, len(pairs), BATCH_SIZE):
-            batch_pairs = pairs[i:i+BATCH_SIZE]
-            batch_scores = self.reranker.compute_score(batch_pairs)
-            reranker_scores.extend(batch_scores)
-        
-        reranker_scores = torch.tensor(reranker_scores)
+        doc_ids = [chunk['metadata'].get('doc_id') for chunk in chunks]
+        candidates = self.prefilter_candidates(chunks, question, bundle_map, retriever)
+
+        # the CachedReranker shared by all sessions only sends unscored pairs to the model, in batches
+        if candidates is None:
+            reranker_scores = torch.tensor(self.reranker.compute_score(pairs, doc_ids=doc_ids))
+        else:
+            # chunks dropped by the prefilter rank below every candidate and are never selected
+            reranker_scores = torch.full((len(chunks),), float('-inf'))
+            reranker_scores[candidates] = torch.tensor(
+                self.reranker.compute_score([pairs[idx] for idx in candidates], doc_ids=[doc_ids[idx] for idx in candidates])
+            )
         time_scores = torch.tensor(time_scores)
         scores = reranker_scores + time_scores
 
         ranked_indices = torch.argsort(scores, descending=True).tolist()
+        if candidates is not None:
+            ranked_indices = ranked_indices[:len(candidates)]
 
         # 根据 chunks_num 选择合适数量的 chunk，确保总大小不超过 topk
         selected_indices = []
+        similar_skipped = []
         current_size = 0
-        similar_mtx = retriever.compute_similarity_mtx(chunk_content_list)
+        similar_mtx = retriever.compute_similarity_mtx(chunk_content_list, doc_ids)
 
         for idx in ranked_indices:
-            logger.info(f"chunk {idx} bundle {chunks[idx]['bundle_id']} score: {scores[idx].item()}")
             bundle_id = chunks[idx]['bundle_id']
             bundle = bundle_map[bundle_id]
             # if bunleid is selected, skip
@@ -527,13 +548,26 @@ DO NOT INCLUDE ANY DETAILS THAT ARE NOT DIRECTLY RELATED TO THE QUESTION.
             #     print(f"chunk{idx} is skip due to similarity")
             #     continue
             if torch.any(similar_mtx[idx, selected_indices] > self.similar_threshhold):
-                logger.info(f"chunk{idx} is skip due to similarity")
+                similar_skipped.append(idx)
                 continue
 
             selected_indices.append(bundle_id)
             current_size += len(bundle)
             
         logger.info(f"reverse ranked bundle indices: {selected_indices[::-1]}")
+        trace = current_trace()
+        if trace is not None:
+            trace.add(
+                "rerank",
+                question=question,
+                doc_ids=doc_ids,
+                bundle_ids=[chunk['bundle_id'] for chunk in chunks],
+                prefilter_candidates=candidates,
+                reranker_scores=reranker_scores,
+                time_scores=time_scores,
+                similar_skipped=similar_skipped,
+                selected_bundles=selected_indices[::-1],
+            )
         torch.cuda.empty_cache()
         return selected_indices[::-1]
 